@@ -3,7 +3,6 @@ import os
 from typing import Callable
 import numpy as np
 import pandas as pd
-import xarray as xr
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 import imageio
@@ -19,26 +18,31 @@ import src.time_wrapper as twr
 def animate_imetric(
     video_path: str = "output.gif",
     k_clusters: int = cst.K_CLUSTERS,
+    threshold: float = cst.I_METRIC_THRESHOLD,
 ) -> None:
     """Animate an `xr.DataArray`.
 
     Args:
         video_path (str, optional): Video path. Defaults to "output.mp4".
         k_clusters (int, opitonal): k clusters. Defaults to cst.K_CLUSTERS.
+        threshold (float, optional): threshold to nan out below.
+            Defaults to cst.I_METRIC_THRESHOLD.
 
     """
     mpl_params(use_tex=False, dpi=800)
 
     file_name = io.return_name(k_clusters, cst.D_PCS) + "pair.nc"
+    if threshold != cst.I_METRIC_THRESHOLD:
+        file_name = file_name.replace("pair.nc", "pair-" + str(threshold) + ".nc")
 
     if not os.path.exists(file_name):
         print("making", file_name)
         link_to_netcdf = io.return_name(k_clusters, cst.D_PCS) + ".nc"
-        ds = xr.open_dataset(link_to_netcdf)
-        da = tpi.pair_i_metric(ds, threshold=0.05)
-        da.to_netcdf(file_name)
+        da = tpi.chunked_pair_i_metric(
+            link_to_netcdf, file_name, k_clusters, threshold=threshold
+        )
     else:
-        da = xr.open_dataarray(file_name)
+        da = tpi.PairIMetric.open(file_name)
 
     def gen_frame_func() -> Callable:
         """Create imageio frame function for `xarray.DataArray` visualisation.
@@ -62,7 +66,9 @@ def animate_imetric(
             xp.plot_single_i_metric(da.isel(time=index))
             fig = plt.gcf()
             fig.suptitle(
-                pd.to_datetime(str(da.time.values[index])).strftime("%Y-%m-%d")
+                pd.to_datetime(str(da.coords[cst.T_COORD].values[index])).strftime(
+                    "%Y-%m-%d"
+                )
             )
             plt.tight_layout()
             plt.savefig("temp.png", bbox_inches="tight")
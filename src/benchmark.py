@@ -0,0 +1,354 @@
+"""Benchmarks for the slow stages of the pipeline, run on synthetic data.
+
+Each benchmark returns a `pd.DataFrame`, which is printed and saved as a
+csv in `cst.DATA_PATH` when this is run as a script.
+
+Peak memory is measured as the peak resident set size (RSS) of a fresh
+spawned process which runs just the case being measured, so that the
+cases do not see each other's high water marks.
+
+Example:
+    Usage::
+        python3 -m src.benchmark
+"""
+import os
+import sys
+import resource
+import tempfile
+import contextlib
+import io as sio
+import time
+from typing import Callable, Tuple
+import numpy as np
+import pandas as pd
+import xarray as xr
+import gsw
+import src.constants as cst
+import src.parallel as par
+import src.data_loading.synthetic as syn
+import src.data_loading.encoding as enc
+import src.data_loading.xr_loader as xvl
+import src.models.make_pair_metric as tpi
+import src.preprocessing.gsw_transformations as gtr
+
+
+def _peak_rss_bytes() -> int:
+    """Peak resident set size of this process in bytes."""
+    if os.path.isfile("/proc/self/status"):
+        # VmHWM starts again for each new process image, whereas ru_maxrss
+        # carries over the parent's peak through fork and exec.
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux, but in bytes on macos.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_and_measure(func: Callable, args: tuple) -> Tuple[any, int]:
+    """Run func(*args) quietly, return its result and the peak RSS."""
+    with contextlib.redirect_stdout(sio.StringIO()):
+        result = func(*args)
+    return result, _peak_rss_bytes()
+
+
+def peak_rss(func: Callable, *args) -> Tuple[any, int]:
+    """Run a function in a fresh process and record its peak RSS.
+
+    Args:
+        func (Callable): importable function to run.
+
+    Returns:
+        Tuple[any, int]: the function's result, peak RSS in bytes.
+    """
+    with par.spawn_pool(1) as executor:
+        return executor.submit(_run_and_measure, func, args).result()
+
+
+def _pair_i_metric_in_memory(link_to_netcdf: str, months: int) -> None:
+    """Compact pair i metric with the whole record loaded at once."""
+    with xr.open_dataset(link_to_netcdf) as ds:
+        tpi.compact_pair_i_metric(
+            ds.isel({cst.T_COORD: slice(0, months)}).load(), threshold=0.05
+        )
+
+
+def _pair_i_metric_chunked(
+    link_to_netcdf: str, out_path: str, months: int, memory_budget: float
+) -> None:
+    """Compact pair i metric streamed to disk in blocks of months."""
+    tpi.chunked_pair_i_metric(
+        link_to_netcdf,
+        out_path,
+        cst.K_CLUSTERS,
+        threshold=0.05,
+        memory_budget=memory_budget,
+        months=months,
+    ).ds.close()
+
+
+def benchmark_pair_i_metric_memory(
+    months_list: tuple = (1, 2, 4, 8, 16),
+    yc: int = 588,
+    xc: int = 2160,
+    memory_budget: float = 5e8,
+) -> pd.DataFrame:
+    """Peak RSS of the pair i metric against the number of months processed.
+
+    Args:
+        months_list (tuple, optional): numbers of months to process.
+            Defaults to (1, 2, 4, 8, 16).
+        yc (int, optional): number of latitudes. Defaults to 588 (BSOSE).
+        xc (int, optional): number of longitudes. Defaults to 2160 (BSOSE).
+        memory_budget (float, optional): bytes for the chunked mode.
+            Defaults to 5e8.
+
+    Returns:
+        pd.DataFrame: peak RSS (MB) for the in memory and chunked modes.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as direc:
+        link_to_netcdf = os.path.join(direc, "i-metric.nc")
+        syn.make_i_metric_dataset(
+            k_clusters=cst.K_CLUSTERS, time=max(months_list), yc=yc, xc=xc
+        ).to_netcdf(link_to_netcdf)
+        for months in months_list:
+            _, in_memory = peak_rss(_pair_i_metric_in_memory, link_to_netcdf, months)
+            _, chunked = peak_rss(
+                _pair_i_metric_chunked,
+                link_to_netcdf,
+                os.path.join(direc, "pair.nc"),
+                months,
+                memory_budget,
+            )
+            rows.append(
+                {
+                    "months": months,
+                    "in_memory_peak_rss_mb": in_memory / 1e6,
+                    "chunked_peak_rss_mb": chunked / 1e6,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def benchmark_bsose_month_loading(
+    months: int = 12, yc: int = 60, xc: int = 120
+) -> pd.DataFrame:
+    """Time to load each month of SALT and THETA, reopening or opening once.
+
+    Args:
+        months (int, optional): number of months to load. Defaults to 12.
+        yc (int, optional): number of latitudes. Defaults to 60.
+        xc (int, optional): number of longitudes. Defaults to 120.
+
+    Returns:
+        pd.DataFrame: total and per month load time (s) for each approach.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as direc:
+        salt_file, theta_file = syn.make_bsose_files(direc, time=months, yc=yc, xc=xc)
+        files = {"salt_file": salt_file, "theta_file": theta_file}
+
+        start = time.perf_counter()
+        for time_i in range(months):
+            xvl.open_salt_theta(time_i=time_i, **files).load().close()
+        rows.append(
+            {"approach": "reopen_each_month", "total_s": time.perf_counter() - start}
+        )
+
+        start = time.perf_counter()
+        bsose_ds = xvl.open_salt_theta(chunks={cst.T_COORD: 1}, **files)
+        for time_i in range(months):
+            bsose_ds.isel({cst.T_COORD: time_i}).load()
+        bsose_ds.close()
+        rows.append({"approach": "open_once", "total_s": time.perf_counter() - start})
+    result_df = pd.DataFrame(rows)
+    result_df["per_month_s"] = result_df["total_s"] / months
+    return result_df
+
+
+def benchmark_depth_band(months: int = 12, yc: int = 60, xc: int = 120) -> pd.DataFrame:
+    """Bytes and time to load SALT and THETA with every level or just the band.
+
+    The two stages are the year that the pcm is trained on, and a single
+    month of the batch inference.
+
+    Args:
+        months (int, optional): months in the training stage. Defaults to 12.
+        yc (int, optional): number of latitudes. Defaults to 60.
+        xc (int, optional): number of longitudes. Defaults to 120.
+
+    Returns:
+        pd.DataFrame: MB loaded and seconds taken for each stage and approach.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as direc:
+        salt_file, theta_file = syn.make_bsose_files(direc, time=months, yc=yc, xc=xc)
+        files = {"salt_file": salt_file, "theta_file": theta_file}
+        for stage, time_i in [("train", slice(0, months)), ("month", 0)]:
+            for levels, min_depth in [("all", None), ("band", cst.MIN_DEPTH)]:
+                start = time.perf_counter()
+                ds = xvl.open_salt_theta(
+                    time_i=time_i, min_depth=min_depth, **files
+                ).load()
+                rows.append(
+                    {
+                        "stage": stage,
+                        "levels": levels,
+                        "z_levels": ds.sizes[cst.Z_COORD],
+                        "loaded_mb": ds.nbytes / 1e6,
+                        "load_s": time.perf_counter() - start,
+                    }
+                )
+                ds.close()
+    return pd.DataFrame(rows)
+
+
+def _mean_read_s(path: str, selections: list) -> float:
+    """Mean time to open a file and load each selection from it."""
+    start = time.perf_counter()
+    for selection in selections:
+        with xr.open_dataset(path) as ds:
+            ds.isel(selection).load()
+    return (time.perf_counter() - start) / len(selections)
+
+
+def benchmark_encoding(
+    months: int = 60, yc: int = 200, xc: int = 600, reads: int = 5
+) -> pd.DataFrame:
+    """File size and read latency of the i metric for each encoding policy.
+
+    Args:
+        months (int, optional): number of months. Defaults to 60.
+        yc (int, optional): number of latitudes. Defaults to 200.
+        xc (int, optional): number of longitudes. Defaults to 600.
+        reads (int, optional): reads to average over. Defaults to 5.
+
+    Returns:
+        pd.DataFrame: size (MB), write time (s), mean time (s) to read one
+            month (time slice) and one point's record (point series).
+    """
+    ds = syn.make_i_metric_dataset(time=months, yc=yc, xc=xc)
+    rng = np.random.default_rng(cst.SEED)
+    time_slices = [{cst.T_COORD: i} for i in rng.integers(0, months, reads)]
+    points = [
+        {cst.Y_COORD: j, cst.X_COORD: i}
+        for j, i in zip(rng.integers(0, yc, reads), rng.integers(0, xc, reads))
+    ]
+    rows = []
+    with tempfile.TemporaryDirectory() as direc:
+        for access in enc.CHUNK_POLICIES:
+            path = os.path.join(direc, access + ".nc")
+            start = time.perf_counter()
+            enc.to_netcdf(ds, path, access=access)
+            write_s = time.perf_counter() - start
+            rows.append(
+                {
+                    "access": access,
+                    "size_mb": os.path.getsize(path) / 1e6,
+                    "write_s": write_s,
+                    "time_slice_read_s": _mean_read_s(path, time_slices),
+                    "point_series_read_s": _mean_read_s(path, points),
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def _return_density_full_grids(
+    pt_values: np.ndarray,
+    practical_salt_values: np.ndarray,
+    lon_values: np.ndarray,
+    lat_values: np.ndarray,
+    z_values: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """`gtr.return_density` as it was, with field sized pressure, lat and lon."""
+    lat_mesh, z_mesh = np.meshgrid(lat_values, z_values)
+    # pylint: disable=no-value-for-parameter
+    pressure_mesh = gsw.p_from_z(z_mesh, lat_mesh)
+    pressure_values = np.zeros(np.shape(pt_values))
+    lat_grid = np.zeros(np.shape(pt_values))
+    lon_grid = np.zeros(np.shape(pt_values))
+    for i in range(np.shape(pt_values)[2]):
+        pressure_values[:, :, i] = pressure_mesh[:, :]
+        lat_grid[:, :, i] = lat_mesh[:, :]
+    for i in range(np.shape(pt_values)[0]):
+        for j in range(np.shape(pt_values)[1]):
+            lon_grid[i, j, :] = lon_values[:]
+    absolute_salinity = gsw.SA_from_SP(
+        practical_salt_values, pressure_values, lon_grid, lat_grid
+    )
+    ct_values = gsw.conversions.CT_from_pt(absolute_salinity, pt_values)
+    rho_values = gsw.density.rho(absolute_salinity, ct_values, pressure_values)
+    return rho_values, ct_values, pressure_values
+
+
+def _density_month(approach: str, z: int, yc: int, xc: int) -> float:
+    """Make one month of THETA and SALT and time the density from it."""
+    rng = np.random.default_rng(cst.SEED)
+    pt_values = rng.uniform(-1.5, 15.0, size=(z, yc, xc))
+    practical_salt_values = rng.uniform(33.5, 35.0, size=(z, yc, xc))
+    args = (
+        pt_values,
+        practical_salt_values,
+        np.linspace(0.0, 360.0, xc, endpoint=False),
+        np.linspace(-78.0, -30.0, yc),
+        -np.linspace(2.0, 5500.0, z),
+    )
+    func = {
+        "full_grids": _return_density_full_grids,
+        "broadcast": gtr.return_density,
+    }[approach]
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def benchmark_density(z: int = 52, yc: int = 294, xc: int = 1080) -> pd.DataFrame:
+    """Time and peak RSS of one month of density, with full grids or broadcasting.
+
+    The inputs (two float64 fields) are made in the measured process, so
+    the peak RSS includes them.
+
+    Args:
+        z (int, optional): number of levels. Defaults to 52, as in BSOSE.
+        yc (int, optional): number of latitudes. Defaults to 294, half of BSOSE.
+        xc (int, optional): number of longitudes. Defaults to 1080, half of BSOSE.
+
+    Returns:
+        pd.DataFrame: seconds and peak RSS (MB) for each approach.
+    """
+    rows = []
+    for approach in ["full_grids", "broadcast"]:
+        density_s, peak = peak_rss(_density_month, approach, z, yc, xc)
+        rows.append(
+            {
+                "approach": approach,
+                "field_mb": z * yc * xc * 8 / 1e6,
+                "density_s": density_s,
+                "peak_rss_mb": peak / 1e6,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+BENCHMARKS = {
+    "pair_i_metric_memory": benchmark_pair_i_metric_memory,
+    "bsose_month_loading": benchmark_bsose_month_loading,
+    "depth_band": benchmark_depth_band,
+    "encoding": benchmark_encoding,
+    "density": benchmark_density,
+}
+
+
+if __name__ == "__main__":
+    # python3 -m src.benchmark [name ...]
+    for bench_name in sys.argv[1:] or list(BENCHMARKS):
+        result_df = BENCHMARKS[bench_name]()
+        print(bench_name)
+        print(result_df.to_string(index=False))
+        os.makedirs(cst.DATA_PATH, exist_ok=True)
+        result_df.to_csv(
+            os.path.join(cst.DATA_PATH, "benchmark_" + bench_name + ".csv"),
+            index=False,
+        )
@@ -63,16 +63,33 @@ T_COORD: str = "time"
 # COORDS created in my variables
 P_COORD: str = "pair" # the name for the paired i metric dimension/coordinate
 CLUST_COORD: str = "cluster" # the name for the cluster coordinate/ dimension
+PAIR_ID_NAME: str = "PAIR_ID" # int8 layer, index of the pair at each cell (-1 for none)
+PAIR_VALUE_NAME: str = "PAIR_IMETRIC" # float32 layer, the i metric at each cell
+THRESHOLD_COORD: str = "threshold" # the name for the i metric threshold dimension
 
 # Particular names within BSOSE-i106
 DEPTH_NAME: str = D_COORD
 USELESS_LIST: list = ["iter", "Depth", "rA", "drF", "hFacC"] # list of variables from BSOSE to discard before processing
 VAR_NAME_LIST: list = ["SALT", "THETA"] # variables used in to fit the pcm model on
 FEATURES_D: dict = {"THETA": "THETA", "SALT": "SALT"} # Mapping for within pyxpcm
+EARTH_RADIUS: float = 6371e3 # mean radius of the earth (m), for the distances between grid cells
 
 # Naming of intermediate files
-INTERP_FILE_NAME: str = os.path.join(DATA_PATH, "interp.nc")
+INTERP_CACHE_DIR: str = os.path.join(DATA_PATH, "interp_cache")  # interpolated training data, by parameter hash
+INTERP_CACHE_BUDGET: float = 2e10  # bytes to keep in INTERP_CACHE_DIR before evicting
+PCM_DIR: str = os.path.join(DATA_PATH, "pcm")  # trained pcm objects, by parameter hash
+REGRID_CACHE_DIR: str = os.path.join(DATA_PATH, "regrid_cache")  # horizontal regridding weights, by grid hash
+METRICS_CACHE_DIR: str = os.path.join(DATA_PATH, "metrics_cache")  # distances between grid cells, by grid hash
+REGISTRY_CACHE_DIR: str = os.path.join(DATA_PATH, "derived_cache")  # derived variable hyperslabs shared between processes, see preprocessing/registry.py
+REGISTRY_CACHE_BUDGET: float = 2e10  # bytes to keep in REGISTRY_CACHE_DIR before evicting
+REGISTRY_MEMORY_BUDGET: float = 2e9  # bytes of derived variables each registry keeps in memory
+DENSITY_FILE: str = os.path.join(DATA_PATH, "density.nc")  # density over the whole record, from preprocessing/gsw_transformations.py
+DERIVED_FILE: str = os.path.join(DATA_PATH, "derived.nc")  # SA, CT, density and its gradients over the whole record, from preprocessing/gsw_transformations.py
+MANIFEST_FILE_NAME: str = os.path.join(DATA_PATH, "batch-manifest.json")  # finished months, for --resume
 REMAKE: bool = False  # whether or not to prefer remaking the interp
+MEMORY_BUDGET: float = 4e9  # bytes to aim for in the out-of-core (chunked) steps
+DENSITY_MEMORY_BUDGET: float = 5e8  # bytes per worker for a (time, Z, YC) block of the derived variables.
+ENCODING_ACCESS: str = "time_slice"  # chunking of derived NetCDF files, see data_loading/encoding.py
 
 # Chosen hyperparameters in the model run:
 RUN_NAME: str = "010"  # the seed as a string
@@ -87,7 +104,19 @@ K_CLUSTERS: int = 5  # number of clusters for the main example figure.
 D_PCS: int = 3  # number of principal components to be used.
 EXAMPLE_TIME_INDEX: int = 40  # the default time to go for.
 EXAMPLE_Z_INDEX: int = 0  # Surface layer.
+I_METRIC_THRESHOLD: float = 0.05  # i metric below which the pair i metric is nan.
 ALL_NAME: str = "all"  # starting combination script.
+N_WORKERS: int = 1  # processes for the monthly batch inference (16+ on JASMIN).
+N_SAMPLES: int = None  # profiles to fit the pcm on, stratified subsample (None for all).
+SUBSAMPLE_BAND_WIDTH: float = 5.0  # degrees of latitude in each stratum of the subsample.
+SUBSAMPLE_SIZES: list = [1000, 3000, 10000, 30000, 100000]  # sizes to check convergence at.
+INFERENCE_DTYPE: str = "float64"  # precision of the numpy inference, "float32" is faster.
+INFERENCE_CHUNK_SIZE: int = 200000  # profiles per chunk in the numpy inference.
+INFERENCE_ENGINE: str = "numpy"  # "numpy" (models/inference.py) or "pyxpcm" for the monthly batch.
+INFERENCE_ATOL: float = 1e-3  # largest difference from pyxpcm allowed before falling back to it.
+N_ENSEMBLE: int = 8  # GMM seeds in the ensemble, from SEED upwards (models/ensemble.py).
+K_SELECTION_LIST: list = list(range(2, 16))  # K's to compare in models/select_k.py.
+HELD_OUT_EVERY: int = 4  # every 4th month of the training year is held out for the likelihood.
 
 # plotting specifications
 # This is for diverging colormaps.
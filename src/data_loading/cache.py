@@ -0,0 +1,111 @@
+"""Content-addressed file cache for intermediate datasets.
+
+Each entry is named by a hash of every parameter that went into making it
+(including the source files' modification times, see `mfs.hash_files`), so
+entries for different parameters live side by side and a stale entry is
+never reused. Reading an entry marks it as used, and the least recently
+used entries are removed once the cache is over its disk budget.
+
+Example:
+    Usage::
+        import src.data_loading.cache as cch
+        path = cch.entry_path("interp", {"time_i": 42, ...})
+        if cch.has_entry(path):
+            ds = xr.open_dataset(path)
+        else:
+            with cch.writing(path) as tmp_path:
+                ds.to_netcdf(tmp_path)
+"""
+import os
+import contextlib
+from typing import Iterator
+import src.constants as cst
+import src.data_loading.manifest as mfs
+
+
+def entry_path(
+    name: str, params: dict, cache_dir: str = cst.INTERP_CACHE_DIR, suffix=".nc"
+) -> str:
+    """File name of the cache entry for a set of parameters.
+
+    Args:
+        name (str): prefix, e.g. "interp".
+        params (dict): json serialisable parameters that the entry depends on.
+        cache_dir (str, optional): Defaults to cst.INTERP_CACHE_DIR.
+        suffix (str, optional): Defaults to ".nc".
+
+    Returns:
+        str: file name.
+    """
+    return os.path.join(cache_dir, name + "-" + mfs.hash_config(**params)[:16] + suffix)
+
+
+def has_entry(path: str) -> bool:
+    """Whether an entry exists, marking it as used if it does.
+
+    Args:
+        path (str): entry file name.
+
+    Returns:
+        bool: True if it can be read.
+    """
+    if not os.path.isfile(path):
+        return False
+    # the modification time records the last use, as atime is often off.
+    os.utime(path)
+    return True
+
+
+@contextlib.contextmanager
+def writing(path: str, budget: float = cst.INTERP_CACHE_BUDGET) -> Iterator[str]:
+    """Write an entry to a temporary name, then move it into the cache.
+
+    A run that dies while writing leaves no half written entry. Once it is
+    in place, old entries are evicted to keep the cache under budget.
+
+    Args:
+        path (str): entry file name.
+        budget (float, optional): bytes. Defaults to cst.INTERP_CACHE_BUDGET.
+
+    Yields:
+        str: temporary file name to write to.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    evict(os.path.dirname(path), budget, keep=path)
+
+
+def evict(cache_dir: str, budget: float, keep: str = None) -> list:
+    """Remove the least recently used entries until the cache fits the budget.
+
+    Args:
+        cache_dir (str): cache directory.
+        budget (float): bytes.
+        keep (str, optional): entry never to remove. Defaults to None.
+
+    Returns:
+        list: file names removed.
+    """
+    entries = [
+        os.path.join(cache_dir, name)
+        for name in os.listdir(cache_dir)
+        if not name.endswith(".tmp")
+    ]
+    entries.sort(key=os.path.getmtime)
+    total = sum(os.path.getsize(entry) for entry in entries)
+    removed = []
+    for entry in entries:
+        if total <= budget:
+            break
+        if keep is not None and os.path.abspath(entry) == os.path.abspath(keep):
+            continue
+        total -= os.path.getsize(entry)
+        os.remove(entry)
+        removed.append(entry)
+    return removed
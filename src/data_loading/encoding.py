@@ -0,0 +1,110 @@
+"""NetCDF4 encoding policy for the derived outputs.
+
+Every derived file (i metric, pair i metric, density and its gradients,
+interpolated training data) is written with the same per-variable dtypes
+and compression, and with chunk shapes picked for how it will be read:
+
+- "time_slice": one chunk per month holding the whole map, for maps and
+  animations.
+- "point_series": the whole record for small tiles of the map, for time
+  series at a point or over a region.
+- "none": xarray's default (uncompressed, contiguous), for comparison.
+
+Example:
+    Usage::
+        import src.data_loading.encoding as enc
+        enc.to_netcdf(ds, "out.nc", access="point_series")
+"""
+from typing import Union
+import xarray as xr
+import src.constants as cst
+
+# dtype to store each known variable in. Class indices are small integers,
+# with NaN on land encoded as -1.
+VAR_DTYPES: dict = {
+    "IMETRIC": {"dtype": "float32"},
+    "PCA_VALUES": {"dtype": "float32"},
+    "A_B": {"dtype": "int8", "_FillValue": -1},
+    "PCM_LABELS": {"dtype": "int8", "_FillValue": -1},
+    "Density": {"dtype": "float32"},
+    "ct": {"dtype": "float32"},
+    "SA": {"dtype": "float32"},
+    "x_grad": {"dtype": "float32"},
+    "y_grad": {"dtype": "float32"},
+}
+
+# chunk length along each dimension, for each access pattern. Dimensions
+# that are not listed are kept whole in each chunk.
+CHUNK_POLICIES: dict = {
+    "time_slice": {cst.T_COORD: 1, cst.Z_COORD: 1},
+    "point_series": {cst.T_COORD: 60, cst.Y_COORD: 24, cst.X_COORD: 24},
+    "none": None,
+}
+
+COMPRESSION: dict = {"zlib": True, "complevel": 1, "shuffle": True}
+
+
+def encoding_for(
+    ds: xr.Dataset,
+    access: str = cst.ENCODING_ACCESS,
+    unlimited_dims: tuple = (),
+) -> dict:
+    """Encoding for every data variable of a dataset, to pass to `to_netcdf`.
+
+    Args:
+        ds (xr.Dataset): dataset about to be written.
+        access (str, optional): "time_slice", "point_series" or "none".
+            Defaults to cst.ENCODING_ACCESS.
+        unlimited_dims (tuple, optional): dimensions that will grow after the
+            file is made, whose chunks can be longer than they are now.
+            Defaults to ().
+
+    Returns:
+        dict: encoding for each data variable.
+    """
+    if access not in CHUNK_POLICIES:
+        raise ValueError(access + " is not one of " + ", ".join(list(CHUNK_POLICIES)))
+    policy = CHUNK_POLICIES[access]
+    if policy is None:
+        return {}
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        var_encoding = dict(COMPRESSION)
+        var_encoding.update(VAR_DTYPES.get(name, {}))
+        if var.ndim > 0:
+            var_encoding["chunksizes"] = tuple(
+                (
+                    policy.get(dim, size)
+                    if dim in unlimited_dims
+                    else min(policy.get(dim, size), size)
+                )
+                for dim, size in zip(var.dims, var.shape)
+            )
+        if var.dtype.kind in "OSU":
+            # variable length strings cannot be compressed or chunked.
+            var_encoding = {}
+        encoding[name] = var_encoding
+    return encoding
+
+
+def to_netcdf(
+    data: Union[xr.Dataset, xr.DataArray],
+    path: str,
+    access: str = cst.ENCODING_ACCESS,
+    **kwargs,
+) -> None:
+    """Write a dataset or data array as NetCDF4 with the encoding policy.
+
+    Args:
+        data (Union[xr.Dataset, xr.DataArray]): what to write.
+        path (str): file name.
+        access (str, optional): "time_slice", "point_series" or "none".
+            Defaults to cst.ENCODING_ACCESS.
+        **kwargs: passed on to `xr.Dataset.to_netcdf`.
+    """
+    ds = data.to_dataset() if isinstance(data, xr.DataArray) else data
+    encoding = encoding_for(
+        ds, access=access, unlimited_dims=tuple(kwargs.get("unlimited_dims", ()))
+    )
+    encoding.update(kwargs.pop("encoding", None) or {})
+    ds.to_netcdf(path, format="NETCDF4", encoding=encoding, **kwargs)
@@ -12,9 +12,13 @@ def return_pair_i_metric(
     pca: int = cst.D_PCS,
     save_nc: bool = True,
     t_index: int = cst.EXAMPLE_TIME_INDEX,
-) -> xr.DataArray:
+    threshold: float = cst.I_METRIC_THRESHOLD,
+) -> tpi.PairIMetric:
     """Return pair i metric.
 
+    The pair i metric is kept in the compact label-coded format, which
+    indexes like the dense `xr.DataArray` (e.g. `.isel(time=0).isel(pair=1)`).
+
     Args:
         k_clusters (int, optional): Number of
                clusters. Defaults to cst.K_CLUSTERS.
@@ -22,9 +26,11 @@ def return_pair_i_metric(
         save_nc (bool, optional): Whether or not to save the resulting dataset.
             Defaults to True.
         t_index (int, optional): time index cst.EXAMPLE_TIME_INDEX.
+        threshold (float, optional): threshold to nan out below.
+            Defaults to cst.I_METRIC_THRESHOLD.
 
     Returns:
-        xr.DataArray: pair i metric.
+        tpi.PairIMetric: pair i metric.
     """
     link_to_netcdf = return_name(k_clusters, pca) + ".nc"
     ds = xr.open_dataset(link_to_netcdf)
@@ -33,20 +39,50 @@ def return_pair_i_metric(
     for i in range(t_index, t_index + batch_size, batch_size):
         print("running", i)
         if save_nc:
-            da = tpi.pair_i_metric(
-                ds.isel(time=slice(i, i + batch_size)), threshold=0.05
+            da = tpi.compact_pair_i_metric(
+                ds.isel(time=slice(i, i + batch_size)), threshold=threshold
             )
             print("not saving")
         else:
-            da = (
-                xr.open_dataset(_return_pair_name(k_clusters, pca) + ".nc")
-                .to_array()
-                .isel(time=slice(i, i + batch_size))
-            )
+            da = tpi.PairIMetric.open(
+                _return_pair_name(k_clusters, pca, threshold=threshold) + ".nc"
+            ).isel(time=slice(i, i + batch_size))
 
     return da
 
 
+@twr.timeit
+def save_pair_i_metric(
+    k_clusters: int = cst.K_CLUSTERS,
+    pca: int = cst.D_PCS,
+    threshold: float = cst.I_METRIC_THRESHOLD,
+    memory_budget: float = cst.MEMORY_BUDGET,
+) -> tpi.PairIMetric:
+    """Save the pair i metric for the whole record, a block of months at a time.
+
+    This makes the file that `return_pair_i_metric(save_nc=False)` reads.
+
+    Args:
+        k_clusters (int, optional): Number of
+               clusters. Defaults to cst.K_CLUSTERS.
+        pca (int, optional): Number of principal components. Defaults to cst.D_PCS.
+        threshold (float, optional): threshold to nan out below.
+            Defaults to cst.I_METRIC_THRESHOLD.
+        memory_budget (float, optional): bytes to aim for.
+            Defaults to cst.MEMORY_BUDGET.
+
+    Returns:
+        tpi.PairIMetric: pair i metric, lazily opened from the new file.
+    """
+    return tpi.chunked_pair_i_metric(
+        return_name(k_clusters, pca) + ".nc",
+        _return_pair_name(k_clusters, pca, threshold=threshold) + ".nc",
+        k_clusters,
+        threshold=threshold,
+        memory_budget=memory_budget,
+    )
+
+
 def return_name(k_clusters: int, pca_components: int) -> str:
     """Return name.
 
@@ -106,24 +142,37 @@ def return_folder(k_clusters: int, pca_components: int) -> str:
     return folder
 
 
-def _return_pair_name(k_clusters: int, pca_components: int) -> str:
+def _return_pair_name(
+    k_clusters: int,
+    pca_components: int,
+    threshold: float = cst.I_METRIC_THRESHOLD,
+) -> str:
     """Return pair name.
 
+    As in `animate.animate_imetric`, a threshold other than the default is
+    added to the name, so files made with different thresholds are kept
+    apart.
+
     Args:
         k_clusters (int): The number of classes.
         pca_components (int): The number of pcas.
+        threshold (float, optional): threshold the pair i metric was made
+            with. Defaults to cst.I_METRIC_THRESHOLD.
 
     Returns:
         str: file names.
 
     """
-    return (
+    name = (
         str(cst.GWS_DATA_DIR)
         + "nc/pair-i-metric-k-"
         + str(k_clusters)
         + "-d-"
         + str(pca_components)
     )
+    if threshold != cst.I_METRIC_THRESHOLD:
+        name += "-" + str(threshold)
+    return name
 
 
 def _return_pair_folder(k_clusters: int, pca_components: int) -> str:
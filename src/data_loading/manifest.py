@@ -0,0 +1,203 @@
+"""Checkpoint manifest, so that batch runs can be resumed.
+
+The manifest is a json file recording which (K, pca, time_i) units are
+finished, with a hash of the model and a hash of the inputs each one was
+made from. A unit is only skipped on restart if both hashes still match
+and its month is in the store, so anything stale or missing is redone.
+
+Example:
+    Usage::
+        import src.data_loading.manifest as mfs
+        manifest = mfs.Manifest("batch-manifest.json")
+        for time_i in manifest.pending_months(models, pca, inputs, paths, months):
+            ...
+            manifest.mark_done(k_clusters, pca, time_i, models[k_clusters], inputs)
+"""
+import os
+import json
+import hashlib
+from typing import Dict, List, Sequence
+import numpy as np
+import src.data_loading.store as sto
+
+
+def hash_files(paths: Sequence[str]) -> str:
+    """Hash the names, sizes and modification times of some input files.
+
+    The contents are not read, as the BSOSE files are several GB each.
+
+    Args:
+        paths (Sequence[str]): file names.
+
+    Returns:
+        str: hex digest.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(
+            (os.path.abspath(path) + str(stat.st_size) + str(stat.st_mtime_ns)).encode()
+        )
+    return digest.hexdigest()
+
+
+def _update_state(digest: "hashlib._Hash", obj: any) -> None:
+    """Add an object's state to a hash, recursing into containers."""
+    if isinstance(obj, np.ndarray):
+        digest.update(str((obj.dtype, obj.shape)).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            digest.update(str(key).encode())
+            _update_state(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _update_state(digest, item)
+    elif hasattr(obj, "__dict__"):
+        # fitted estimator: its learnt attributes end with an underscore.
+        digest.update(type(obj).__name__.encode())
+        _update_state(
+            digest,
+            {
+                key: value
+                for key, value in vars(obj).items()
+                if key.endswith("_") and not key.startswith("_")
+            },
+        )
+    else:
+        digest.update(repr(obj).encode())
+
+
+def hash_state(*objects: any) -> str:
+    """Hash the fitted state of some estimators, arrays or containers of them.
+
+    Returns:
+        str: hex digest.
+    """
+    digest = hashlib.sha256()
+    for obj in objects:
+        _update_state(digest, obj)
+    return digest.hexdigest()
+
+
+def hash_config(**config: any) -> str:
+    """Hash some json serialisable settings.
+
+    Returns:
+        str: hex digest.
+    """
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+class Manifest:
+    """Completed (K, pca, time_i) units of a batch run, saved after every change."""
+
+    def __init__(self, path: str) -> None:
+        """Load the manifest, or start an empty one.
+
+        Args:
+            path (str): json file name.
+        """
+        self.path = path
+        self.units: Dict[str, dict] = {}
+        if os.path.isfile(path):
+            with open(path) as json_file:
+                self.units = json.load(json_file)
+
+    @staticmethod
+    def _key(k_clusters: int, pca: int, time_i: int) -> str:
+        return "k-" + str(k_clusters) + "-d-" + str(pca) + "-t-" + str(time_i)
+
+    def save(self) -> None:
+        """Write the manifest, replacing the old one in a single step."""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(self.units, json_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def mark_done(
+        self, k_clusters: int, pca: int, time_i: int, model: str, inputs: str
+    ) -> None:
+        """Record a unit as finished, once its month has been written.
+
+        Args:
+            k_clusters (int): number of clusters.
+            pca (int): number of principal components.
+            time_i (int): time index.
+            model (str): hash of the model.
+            inputs (str): hash of the inputs.
+        """
+        self.units[self._key(k_clusters, pca, time_i)] = {
+            "k_clusters": k_clusters,
+            "pca": pca,
+            "time_i": time_i,
+            "model": model,
+            "inputs": inputs,
+        }
+        self.save()
+
+    def forget(self, k_clusters: int, pca: int) -> None:
+        """Remove every unit for one K and pca, to start them again.
+
+        Args:
+            k_clusters (int): number of clusters.
+            pca (int): number of principal components.
+        """
+        self.units = {
+            key: unit
+            for key, unit in self.units.items()
+            if (unit["k_clusters"], unit["pca"]) != (k_clusters, pca)
+        }
+        self.save()
+
+    def is_done(
+        self, k_clusters: int, pca: int, time_i: int, model: str, inputs: str
+    ) -> bool:
+        """Whether a unit was finished with the same model and inputs.
+
+        Args:
+            k_clusters (int): number of clusters.
+            pca (int): number of principal components.
+            time_i (int): time index.
+            model (str): hash of the model.
+            inputs (str): hash of the inputs.
+
+        Returns:
+            bool: True if it can be skipped.
+        """
+        unit = self.units.get(self._key(k_clusters, pca, time_i))
+        return unit is not None and unit["model"] == model and unit["inputs"] == inputs
+
+    def pending_months(
+        self,
+        models: Dict[int, str],
+        pca: int,
+        inputs: str,
+        store_paths: Dict[int, str],
+        months: Sequence[int],
+    ) -> List[int]:
+        """The months that still need to be run for at least one K.
+
+        Args:
+            models (Dict[int, str]): hash of the model for each K.
+            pca (int): number of principal components.
+            inputs (str): hash of the inputs.
+            store_paths (Dict[int, str]): store for each K.
+            months (Sequence[int]): every time index in the run.
+
+        Returns:
+            List[int]: time indices that are missing or stale, in order.
+        """
+        lengths = {
+            k_clusters: sto.time_length(path)
+            for k_clusters, path in store_paths.items()
+        }
+        return [
+            time_i
+            for time_i in months
+            if not all(
+                time_i < lengths[k_clusters]
+                and self.is_done(k_clusters, pca, time_i, model, inputs)
+                for k_clusters, model in models.items()
+            )
+        ]
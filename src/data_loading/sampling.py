@@ -0,0 +1,161 @@
+"""Stratified subsamples of the training profiles.
+
+Neighbouring profiles on the training grid are nearly the same, so the pcm
+can be fitted on a subsample of them. The profiles are split into strata
+by month and by band of latitude, each stratum gets a share of the sample
+in proportion to the ocean area it covers, and within a stratum profiles
+are drawn without replacement with probability proportional to their cell
+area (`rA`). The subsample therefore represents the ocean by area, and
+every month and band of latitude is in it.
+
+Example:
+    Usage::
+        import src.data_loading.sampling as smp
+        ds_sample = smp.stratified_sample(ds, n_samples=20000)
+        pcm_object.fit(ds_sample, features=cst.FEATURES_D, dim=cst.Z_COORD)
+"""
+import numpy as np
+import xarray as xr
+import src.constants as cst
+
+SAMPLE_DIM: str = "sample"
+
+
+def area_weights(ds: xr.Dataset, area: xr.DataArray = None) -> xr.DataArray:
+    """Cell area at each point of the grid of `ds`.
+
+    Args:
+        ds (xr.Dataset): dataset on a (YC, XC) grid.
+        area (xr.DataArray, optional): cell areas on any (YC, XC) grid, which
+            are interpolated onto the grid of `ds`. Defaults to `ds.rA` if
+            it is there, and to `rA` from cst.SALT_FILE otherwise.
+
+    Returns:
+        xr.DataArray: (YC, XC) weights, only their ratios matter.
+    """
+    if area is None:
+        if "rA" in ds:
+            area = ds["rA"]
+        else:
+            area = xr.open_dataset(cst.SALT_FILE)["rA"]
+    area = area.reset_coords(drop=True).astype("float64")
+    if not (
+        np.array_equal(area[cst.Y_COORD].values, ds[cst.Y_COORD].values)
+        and np.array_equal(area[cst.X_COORD].values, ds[cst.X_COORD].values)
+    ):
+        area = area.interp(
+            {cst.Y_COORD: ds[cst.Y_COORD], cst.X_COORD: ds[cst.X_COORD]},
+            kwargs={"fill_value": None},
+        )
+    return area.transpose(cst.Y_COORD, cst.X_COORD)
+
+
+def allocate(totals: np.ndarray, counts: np.ndarray, n_samples: int) -> np.ndarray:
+    """Share `n_samples` between strata in proportion to `totals`.
+
+    No stratum gets more than its count, and what it cannot take is shared
+    between the others. The shares are rounded by largest remainder.
+
+    Args:
+        totals (np.ndarray): size of each stratum (e.g. its area).
+        counts (np.ndarray): number of profiles in each stratum.
+        n_samples (int): total to share out.
+
+    Returns:
+        np.ndarray: number of profiles to draw from each stratum.
+    """
+    totals = np.asarray(totals, dtype="float64")
+    counts = np.asarray(counts, dtype="int64")
+    alloc = np.zeros(len(counts), dtype="int64")
+    remaining = min(int(n_samples), int(counts.sum()))
+    while remaining > 0:
+        open_strata = (alloc < counts) & (totals > 0)
+        if not np.any(open_strata):
+            break
+        share = np.where(open_strata, totals, 0.0)
+        share = remaining * share / share.sum()
+        add = np.minimum(np.floor(share).astype("int64"), counts - alloc)
+        left = remaining - add.sum()
+        if left > 0:
+            # largest remainder, among the strata with room.
+            room = (alloc + add < counts) & open_strata
+            order = np.argsort(-np.where(room, share - np.floor(share), -1.0))
+            add[order[: min(left, int(room.sum()))]] += 1
+        alloc += add
+        remaining -= int(add.sum())
+    return alloc
+
+
+def stratified_sample(
+    ds: xr.Dataset,
+    n_samples: int,
+    band_width: float = cst.SUBSAMPLE_BAND_WIDTH,
+    area: xr.DataArray = None,
+    area_weighted: bool = True,
+    seed: int = cst.SEED,
+) -> xr.Dataset:
+    """Draw a subsample of the profiles, stratified by month and latitude.
+
+    Args:
+        ds (xr.Dataset): SALT and THETA (time, Z, YC, XC), e.g. from
+            `tim.interpolated_training_data`.
+        n_samples (int): number of profiles to draw (at most all the ocean
+            profiles).
+        band_width (float, optional): degrees of latitude in each band.
+            Defaults to cst.SUBSAMPLE_BAND_WIDTH.
+        area (xr.DataArray, optional): cell areas, see `area_weights`.
+            Defaults to None.
+        area_weighted (bool, optional): share out and draw by area, rather
+            than by number of profiles. Defaults to True.
+        seed (int, optional): random seed. Defaults to cst.SEED.
+
+    Returns:
+        xr.Dataset: SALT and THETA (sample, Z), with the time, YC and XC of
+            each profile as coordinates along sample.
+    """
+    ds = ds[cst.VAR_NAME_LIST].transpose(
+        cst.T_COORD, cst.Z_COORD, cst.Y_COORD, cst.X_COORD
+    )
+    valid = np.ones(
+        (ds.sizes[cst.T_COORD], ds.sizes[cst.Y_COORD], ds.sizes[cst.X_COORD]),
+        dtype=bool,
+    )
+    for var in cst.VAR_NAME_LIST:
+        valid &= np.all(np.isfinite(ds[var].values), axis=1)
+
+    if area_weighted:
+        weights = area_weights(ds, area=area).values
+    else:
+        weights = np.ones((ds.sizes[cst.Y_COORD], ds.sizes[cst.X_COORD]))
+    lats = ds[cst.Y_COORD].values
+    band = np.floor((lats - lats.min()) / band_width).astype("int64")
+    n_bands = int(band.max()) + 1
+
+    t_i, y_i, x_i = np.nonzero(valid)
+    point_weights = weights[y_i, x_i]
+    keep = np.isfinite(point_weights) & (point_weights > 0)
+    t_i, y_i, x_i, point_weights = t_i[keep], y_i[keep], x_i[keep], point_weights[keep]
+    strata = t_i * n_bands + band[y_i]
+    n_strata = ds.sizes[cst.T_COORD] * n_bands
+    alloc = allocate(
+        np.bincount(strata, weights=point_weights, minlength=n_strata),
+        np.bincount(strata, minlength=n_strata),
+        n_samples,
+    )
+
+    # weighted draw without replacement: keep the largest u ** (1 / w) in
+    # each stratum (Efraimidis and Spirakis, 2006).
+    rng = np.random.default_rng(seed)
+    keys = np.log(rng.random(len(strata))) / point_weights
+    order = np.lexsort((-keys, strata))
+    starts = np.searchsorted(strata[order], np.arange(n_strata))
+    rank = np.arange(len(order)) - starts[strata[order]]
+    chosen = np.sort(order[rank < alloc[strata[order]]])
+
+    return ds.isel(
+        {
+            cst.T_COORD: xr.DataArray(t_i[chosen], dims=SAMPLE_DIM),
+            cst.Y_COORD: xr.DataArray(y_i[chosen], dims=SAMPLE_DIM),
+            cst.X_COORD: xr.DataArray(x_i[chosen], dims=SAMPLE_DIM),
+        }
+    ).transpose(SAMPLE_DIM, cst.Z_COORD)
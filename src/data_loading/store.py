@@ -0,0 +1,157 @@
+"""Write time blocks straight into a single NetCDF4 file.
+
+The file is made with an unlimited time dimension, so that each block can
+be written into its own region of the time axis as soon as it is ready,
+without holding the whole record in memory or merging files afterwards.
+The file is closed after every write, so it can be read while it is still
+being filled.
+
+A block can also cover only part of the other dimensions (e.g. a few Z
+levels of one month), if the file was first made at its full size with
+`create_store`.
+
+Example:
+    Usage::
+        import src.data_loading.store as sto
+        for block in blocks:
+            sto.write_time_block(block, "out.nc")
+"""
+import os
+import numpy as np
+import xarray as xr
+import netCDF4
+import src.constants as cst
+import src.data_loading.encoding as enc
+
+
+def time_length(path: str, dim: str = cst.T_COORD) -> int:
+    """Current length of the time dimension in a store.
+
+    Args:
+        path (str): NetCDF4 file name.
+        dim (str, optional): unlimited dimension. Defaults to cst.T_COORD.
+
+    Returns:
+        int: length, 0 if the file does not exist yet.
+    """
+    if not os.path.isfile(path):
+        return 0
+    with netCDF4.Dataset(path, "r") as nc_file:
+        return len(nc_file.dimensions[dim])
+
+
+def create_store(
+    template: xr.Dataset,
+    path: str,
+    dim: str = cst.T_COORD,
+    encoding: dict = None,
+    access: str = cst.ENCODING_ACCESS,
+) -> None:
+    """Make an empty store with the variables and other dimensions of a template.
+
+    Args:
+        template (xr.Dataset): a block like the ones to be written, e.g. a
+            lazily opened month. Only its first `dim` step is looked at.
+        path (str): NetCDF4 file name, replaced if it exists.
+        dim (str, optional): unlimited dimension, made with length 0.
+            Defaults to cst.T_COORD.
+        encoding (dict, optional): per variable encoding. Defaults to None,
+            which uses the encoding policy for `access`.
+        access (str, optional): access pattern to chunk the file for, see
+            `enc.encoding_for`. Defaults to cst.ENCODING_ACCESS.
+    """
+    if dim not in template.dims:
+        template = template.expand_dims(dim)
+    if os.path.isfile(path):
+        os.remove(path)
+    enc.to_netcdf(
+        template.isel({dim: slice(0, 0)}),
+        path,
+        access=access,
+        unlimited_dims=[dim],
+        encoding=encoding,
+    )
+
+
+def write_time_block(
+    ds: xr.Dataset,
+    path: str,
+    start: int = None,
+    dim: str = cst.T_COORD,
+    encoding: dict = None,
+    access: str = cst.ENCODING_ACCESS,
+    region: dict = None,
+) -> None:
+    """Write a block of time steps into a region of a NetCDF4 file.
+
+    The first call creates the file (with `dim` unlimited) from `ds`, and
+    sets the encoding. Later calls encode `ds` in the same way and write it
+    into the time indices [start, start + len(ds[dim])).
+
+    Args:
+        ds (xr.Dataset): block to write, must contain `dim`.
+        path (str): NetCDF4 file name.
+        start (int, optional): first time index to write to. Defaults to None,
+            which appends to the end of the file.
+        dim (str, optional): unlimited dimension. Defaults to cst.T_COORD.
+        encoding (dict, optional): per variable encoding used when creating the
+            file. Defaults to None, which uses the encoding policy for `access`.
+        access (str, optional): access pattern to chunk the file for, see
+            `enc.encoding_for`. Defaults to cst.ENCODING_ACCESS.
+        region (dict, optional): slice of each other dimension that `ds`
+            covers, e.g. {cst.Z_COORD: slice(0, 10)}. The file must already
+            exist (see `create_store`). Defaults to None, the whole of them.
+    """
+    if dim not in ds.dims:
+        ds = ds.expand_dims(dim)
+    region = region or {}
+
+    if not os.path.isfile(path):
+        if region:
+            raise ValueError("Make " + path + " with create_store first.")
+        if start not in [None, 0]:
+            raise ValueError("The first block must start at time index 0.")
+        enc.to_netcdf(
+            ds, path, access=access, unlimited_dims=[dim], encoding=encoding
+        )
+        return
+
+    with netCDF4.Dataset(path, "a") as nc_file:
+        # values are encoded by xarray below, so write them as they are.
+        nc_file.set_auto_maskandscale(False)
+        if start is None:
+            start = len(nc_file.dimensions[dim])
+        ds = ds.copy()
+        for name in ds.variables:
+            if name not in nc_file.variables:
+                raise KeyError(name + " is not in " + path)
+            # encode in the same way as when the file was created.
+            file_var = nc_file.variables[name]
+            ds.variables[name].encoding = {
+                key: file_var.getncattr(key)
+                for key in [
+                    "units",
+                    "calendar",
+                    "scale_factor",
+                    "add_offset",
+                    "_FillValue",
+                ]
+                if key in file_var.ncattrs()
+            }
+            if file_var.dtype != str:
+                ds.variables[name].encoding["dtype"] = file_var.dtype
+        variables, _ = xr.conventions.cf_encoder(ds.variables, ds.attrs)
+        stop = start + ds.sizes[dim]
+        for name, var in variables.items():
+            if dim not in var.dims:
+                continue
+            file_var = nc_file.variables[name]
+            index = tuple(
+                (
+                    slice(start, stop)
+                    if var_dim == dim
+                    else region.get(var_dim, slice(None))
+                )
+                for var_dim in var.dims
+            )
+            file_var[index] = np.asarray(var.values).astype(file_var.dtype)
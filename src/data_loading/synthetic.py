@@ -0,0 +1,138 @@
+"""Small synthetic datasets shaped like the real model outputs.
+
+These are used by the unit tests and benchmarks so that they can run
+without access to BSOSE on JASMIN.
+
+Example:
+    Usage::
+        import src.data_loading.synthetic as syn
+        ds = syn.make_i_metric_dataset(k_clusters=5, time=3, yc=20, xc=40)
+"""
+import os
+from typing import Tuple
+import numpy as np
+import pandas as pd
+import xarray as xr
+import src.constants as cst
+
+
+def make_i_metric_dataset(
+    k_clusters: int = cst.K_CLUSTERS,
+    time: int = 3,
+    yc: int = 20,
+    xc: int = 40,
+    seed: int = cst.SEED,
+    land_fraction: float = 0.1,
+) -> xr.Dataset:
+    """Make a dataset laid out like `i-metric-joint-k-*-d-*.nc`.
+
+    Args:
+        k_clusters (int, optional): Number of classes. Defaults to cst.K_CLUSTERS.
+        time (int, optional): Number of months. Defaults to 3.
+        yc (int, optional): Number of latitudes. Defaults to 20.
+        xc (int, optional): Number of longitudes. Defaults to 40.
+        seed (int, optional): Random seed. Defaults to cst.SEED.
+        land_fraction (float, optional): Fraction of columns set to NaN.
+            Defaults to 0.1.
+
+    Returns:
+        xr.Dataset: dataset with `A_B` (time, rank, YC, XC) and
+            `IMETRIC` (time, Imetric, YC, XC), both float64 with NaN on land.
+    """
+    rng = np.random.default_rng(seed)
+    first = rng.integers(0, k_clusters, size=(time, yc, xc))
+    offset = rng.integers(1, k_clusters, size=(time, yc, xc))
+    second = (first + offset) % k_clusters
+    a_b = np.stack([first, second], axis=1).astype("float64")
+    i_metric = rng.random((time, 1, yc, xc))
+    # put some mass exactly on and either side of the usual threshold.
+    i_metric[rng.random((time, 1, yc, xc)) < 0.05] = 0.05
+    land = rng.random((yc, xc)) < land_fraction
+    a_b[:, :, land] = np.nan
+    i_metric[:, :, land] = np.nan
+
+    return xr.Dataset(
+        {
+            "IMETRIC": ((cst.T_COORD, "Imetric", cst.Y_COORD, cst.X_COORD), i_metric),
+            "A_B": ((cst.T_COORD, "rank", cst.Y_COORD, cst.X_COORD), a_b),
+        },
+        coords={
+            cst.T_COORD: pd.date_range("2008-01-31", periods=time, freq="30D"),
+            cst.Y_COORD: np.linspace(-78, -30, yc),
+            cst.X_COORD: np.linspace(0.08333, 359.9, xc),
+        },
+    )
+
+
+def make_bsose_files(
+    direc: str,
+    time: int = 3,
+    z: int = 52,
+    yc: int = 20,
+    xc: int = 40,
+    seed: int = cst.SEED,
+) -> Tuple[str, str]:
+    """Make a pair of files laid out like the BSOSE monthly Salt and Theta files.
+
+    The profiles are smooth in depth with fronts in latitude, zero below the
+    sea floor as in BSOSE, and the grid variables that BSOSE carries
+    (`Depth`, `rA`, `drF`, `hFacC` and `iter`) are included.
+
+    Args:
+        direc (str): directory to write to.
+        time (int, optional): Number of months. Defaults to 3.
+        z (int, optional): Number of levels. Defaults to 52, as in BSOSE.
+        yc (int, optional): Number of latitudes. Defaults to 20.
+        xc (int, optional): Number of longitudes. Defaults to 40.
+        seed (int, optional): Random seed. Defaults to cst.SEED.
+
+    Returns:
+        Tuple[str, str]: salt file name, theta file name.
+    """
+    rng = np.random.default_rng(seed)
+    z_values = -np.geomspace(2.1, 5800, z).astype("float32")
+    lats = np.linspace(-78, -30, yc)
+    lons = np.linspace(0.08333, 359.9, xc)
+    depth = rng.uniform(0, 5800, size=(yc, xc)).astype("float32")
+    depth[rng.random((yc, xc)) < 0.3] = 5000.0
+    wet = -z_values[:, None, None] < depth[None, :, :]
+
+    # warmer, saltier water to the north, with a step at a wandering front.
+    front = -55 + 5 * np.sin(np.radians(lons))[None, :]
+    north = np.tanh((lats[:, None] - front) / 2.0)
+    decay = np.exp(z_values / 1000.0)[:, None, None]
+    wobble = rng.normal(0, 0.05, size=(time, 1, yc, xc))
+    theta = 2 + (1 + 3 * north[None, None]) * decay[None] + wobble
+    salt = 34.5 + 0.2 * north[None, None] * decay[None] + 0.1 * wobble
+    theta = np.where(wet[None], theta, 0.0).astype("float32")
+    salt = np.where(wet[None], salt, 0.0).astype("float32")
+
+    coords = {
+        cst.T_COORD: pd.date_range("2008-01-31", periods=time, freq="30D"),
+        cst.Z_COORD: (cst.Z_COORD, z_values, {"units": "m", "positive": "up"}),
+        cst.Y_COORD: (cst.Y_COORD, lats, {"units": "degrees_north"}),
+        cst.X_COORD: (cst.X_COORD, lons, {"units": "degrees_east"}),
+        cst.D_COORD: ((cst.Y_COORD, cst.X_COORD), depth, {"units": "m"}),
+        "rA": (
+            (cst.Y_COORD, cst.X_COORD),
+            np.repeat(
+                (1.0e8 * np.cos(np.radians(lats)))[:, None], xc, axis=1
+            ).astype("float32"),
+            {"units": "m2"},
+        ),
+        "drF": (cst.Z_COORD, -np.diff(z_values, prepend=0).astype("float32")),
+        "hFacC": ((cst.Z_COORD, cst.Y_COORD, cst.X_COORD), wet.astype("float32")),
+        "iter": (cst.T_COORD, np.arange(time) * 2190),
+    }
+    dims = (cst.T_COORD, cst.Z_COORD, cst.Y_COORD, cst.X_COORD)
+    salt_file = os.path.join(direc, "bsose_i106_2008to2012_monthly_Salt.nc")
+    theta_file = os.path.join(direc, "bsose_i106_2008to2012_monthly_Theta.nc")
+    xr.Dataset(
+        {"SALT": (dims, salt, {"units": "psu", "long_name": "Salinity"})},
+        coords=coords,
+    ).to_netcdf(salt_file)
+    xr.Dataset(
+        {"THETA": (dims, theta, {"units": "degC", "long_name": "Potential Temp"})},
+        coords=coords,
+    ).to_netcdf(theta_file)
+    return salt_file, theta_file
@@ -1,7 +1,90 @@
 """Xarray values."""
+from typing import Union
 import numpy as np
 import xarray as xr
 import collections
+import src.constants as cst
+
+
+def depth_band(
+    z_values: np.ndarray,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    margin: int = 1,
+) -> slice:
+    """Index slice of the Z levels that cover [min_depth, max_depth].
+
+    `margin` extra levels are kept on either side, so that interpolating
+    onto any depth in the band has a level above and below it.
+
+    Args:
+        z_values (np.ndarray): level heights, negative downwards, as in BSOSE.
+        min_depth (float, optional): top of the band (m). Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): bottom of the band (m).
+            Defaults to cst.MAX_DEPTH.
+        margin (int, optional): levels to keep either side. Defaults to 1.
+
+    Returns:
+        slice: indices of the levels to read.
+    """
+    depths = np.abs(np.asarray(z_values))
+    first = int(np.searchsorted(depths, min_depth, side="left"))
+    last = int(np.searchsorted(depths, max_depth, side="right")) - 1
+    return slice(max(first - margin, 0), min(last + 1 + margin, len(depths)))
+
+
+def open_salt_theta(
+    time_i: Union[int, slice] = None,
+    max_depth: float = cst.MAX_DEPTH,
+    chunks: dict = None,
+    salt_file: str = cst.SALT_FILE,
+    theta_file: str = cst.THETA_FILE,
+    min_depth: float = cst.MIN_DEPTH,
+) -> xr.Dataset:
+    """Open the BSOSE SALT and THETA files as one dataset.
+
+    The two files are merged, the columns shallower than max_depth are
+    masked and the variables in cst.USELESS_LIST are dropped. Only the Z
+    levels between min_depth and max_depth (plus one level either side)
+    are kept, so that levels the model never sees are not read.
+
+    With chunks set (e.g. {cst.T_COORD: 1}) nothing is read until it is
+    needed, so this can be opened once per batch and then indexed by month.
+
+    Args:
+        time_i (Union[int, slice], optional): time index or slice to select.
+            Defaults to None, which keeps the whole record.
+        max_depth (float, optional): columns with Depth shallower than this
+            are masked, and levels deeper than it are not read.
+            Defaults to cst.MAX_DEPTH.
+        chunks (dict, optional): dask chunks to open with. Defaults to None.
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
+        min_depth (float, optional): levels shallower than this are not read.
+            None keeps every level. Defaults to cst.MIN_DEPTH.
+
+    Returns:
+        xr.Dataset: SALT and THETA.
+    """
+    salt_nc = xr.open_dataset(salt_file, chunks=chunks)
+    theta_nc = xr.open_dataset(theta_file, chunks=chunks)
+    select = {}
+    if time_i is not None:
+        select[cst.T_COORD] = time_i
+    if min_depth is not None:
+        select[cst.Z_COORD] = depth_band(
+            salt_nc.coords[cst.Z_COORD].values, min_depth, max_depth
+        )
+    salt_nc = salt_nc.isel(select)
+    # the grid variables are the same in both files, and merging would load
+    # and compare them (hFacC is as big as a month), so they come from SALT.
+    theta_nc = theta_nc.isel(select).drop_vars(
+        [name for name in cst.USELESS_LIST if name in theta_nc.variables]
+    )
+    big_nc = xr.merge([salt_nc, theta_nc])
+    return big_nc.where(big_nc.coords[cst.DEPTH_NAME] > max_depth).drop(
+        cst.USELESS_LIST
+    )
 
 
 def order_indexes(dataarray: xr.DataArray, index_list: list) -> np.ndarray:
@@ -18,6 +18,7 @@ import src.plot.i_map as imap
 import src.plot.profiles as prof
 import src.plot.preprocessing_profiles as prep
 import src.data_loading.io_names as io
+import src.data_loading.encoding as enc
 from src.models.sobel import sobel_np
 import src.time_wrapper as twr
 
@@ -87,12 +88,12 @@ def make_all_figures():
 
         temp_name = data_prefix + "_temp.nc"
         profiles_name = data_prefix + "_profiles_temp.nc"
-        ds.to_netcdf(path=temp_name)
+        enc.to_netcdf(ds, temp_name)
 
         # MAKE/PLOT PROFILES
         ds = xr.open_dataset(temp_name)
         profile_ds = prof.make_profiles(ds)
-        profile_ds.to_netcdf(path=profiles_name)
+        enc.to_netcdf(profile_ds, profiles_name)
         profile_ds = xr.open_dataset(profiles_name)
 
         print(profile_ds)
@@ -3,16 +3,28 @@
 Example:
     Usage::
         python3 src/models/batch_i_metric.py
+        python3 src/models/batch_i_metric.py --resume
 """
+import os
+import argparse
+from concurrent.futures import as_completed
+from typing import Tuple, Dict, List, Sequence, Union
 import xarray as xr
 import pyxpcm
 import src.constants as cst
+import src.parallel as par
+import src.time_wrapper as twr
 import src.data_loading.io_names as io
+import src.data_loading.manifest as mfs
+import src.data_loading.store as sto
+import src.data_loading.xr_loader as xvl
+import src.models.inference as inf
 import src.models.train_pyxpcm as tim
 
 xr.set_options(keep_attrs=True)
 
 
+@twr.timeit
 def pca_from_interpolated_year(
     pcm_object: pyxpcm.pcm,
     pca: int = cst.D_COORD,
@@ -20,11 +32,11 @@ def pca_from_interpolated_year(
     time_i: int = cst.EXAMPLE_TIME_INDEX,
     max_depth: float = cst.MAX_DEPTH,
     remove_init_var: bool = True,
-) -> None:
+    bsose_ds: xr.Dataset = None,
+    store_path: str = None,
+) -> xr.Dataset:
     """
-    [summary]
-
-    [extended_summary]
+    Find the i metric and pca values for one month.
 
     Args:
         pcm_object (pyxpcm.pcm): the pcm object which has already been trained.
@@ -37,30 +49,75 @@ def pca_from_interpolated_year(
             is fitted to. Defaults to cst.MAX_DEPTH.
         remove_init_var (bool, optional): Whether or not to remove the initial
             variables. Defaults to True.
+        bsose_ds (xr.Dataset, optional): SALT and THETA for the whole record,
+            lazily opened once per batch with `open_bsose_once`. Defaults to
+            None, which opens the BSOSE files just for this month.
+        store_path (str, optional): NetCDF4 store to write the month into, at
+            index time_i. Defaults to None, which just returns it.
+
+    Returns:
+        xr.Dataset: IMETRIC, A_B and PCA_VALUES for this month.
     """
+    if bsose_ds is None:
+        both_nc = xvl.open_salt_theta(time_i=time_i, max_depth=max_depth)
+    else:
+        both_nc = bsose_ds.isel({cst.T_COORD: time_i}).load()
+    ds = i_metric_month(pcm_object, both_nc, remove_init_var=remove_init_var)
+    if store_path is not None:
+        sto.write_time_block(ds, store_path, start=time_i)
+    return ds
+
+
+def i_metric_month(
+    pcm_object: Union[pyxpcm.pcm, inf.Inference],
+    both_nc: xr.Dataset,
+    remove_init_var: bool = True,
+    pca_values: xr.DataArray = None,
+) -> xr.Dataset:
+    """
+    Find the i metric and pca values for one month that is already loaded.
+
+    Args:
+        pcm_object (Union[pyxpcm.pcm, inf.Inference]): the pcm object which has
+            already been trained, or the same compiled with `inf.Inference`.
+        both_nc (xr.Dataset): SALT and THETA for one month.
+        remove_init_var (bool, optional): Whether or not to remove the initial
+            variables. Defaults to True.
+        pca_values (xr.DataArray, optional): PCA_VALUES already found for this
+            month by a pcm object with the same preprocessing. Defaults to
+            None, which finds them with pcm_object.
+
+    Returns:
+        xr.Dataset: IMETRIC, A_B and PCA_VALUES for this month.
+    """
+    time_coord = both_nc.coords[cst.T_COORD]
 
-    salt_nc = xr.open_dataset(cst.SALT_FILE).isel(time=time_i)
-    theta_nc = xr.open_dataset(cst.THETA_FILE).isel(time=time_i)
-    big_nc = xr.merge([salt_nc, theta_nc])
-    both_nc = big_nc.where(big_nc.coords[cst.DEPTH_NAME] > max_depth).drop(
-        cst.USELESS_LIST
-    )
     attr_d = {}
     for coord in both_nc.coords:
         attr_d[coord] = both_nc.coords[coord].attrs
 
-    ds = both_nc
-    ds = pcm_object.find_i_metric(ds, inplace=True)
-    ds = pcm_object.add_pca_to_xarray(
-        ds, features=cst.FEATURES_D, dim=cst.Z_COORD, inplace=True
-    )
+    ds = both_nc.copy()
+    if isinstance(pcm_object, inf.Inference):
+        ds = ds.merge(
+            pcm_object.dataset(
+                both_nc, pca_values=pca_values, names=("IMETRIC", "A_B", "PCA_VALUES")
+            )
+        )
+    else:
+        ds = pcm_object.find_i_metric(ds, inplace=True)
+        if pca_values is None:
+            ds = pcm_object.add_pca_to_xarray(
+                ds, features=cst.FEATURES_D, dim=cst.Z_COORD, inplace=True
+            )
+            del ds.PCA_VALUES.attrs["_pyXpcm_cleanable"]
+        else:
+            ds["PCA_VALUES"] = pca_values
 
-    def sanitize() -> None:
-        del ds.IMETRIC.attrs["_pyXpcm_cleanable"]
-        del ds.A_B.attrs["_pyXpcm_cleanable"]
-        del ds.PCA_VALUES.attrs["_pyXpcm_cleanable"]
+        def sanitize() -> None:
+            del ds.IMETRIC.attrs["_pyXpcm_cleanable"]
+            del ds.A_B.attrs["_pyXpcm_cleanable"]
 
-    sanitize()
+        sanitize()
 
     for coord in attr_d:
         ds.coords[coord].attrs = attr_d[coord]
@@ -69,61 +126,419 @@ def pca_from_interpolated_year(
         ds = ds.drop(cst.VAR_NAME_LIST)
 
     ds = ds.expand_dims(dim=cst.T_COORD, axis=None)
-    ds = ds.assign_coords(
-        {cst.T_COORD: (cst.T_COORD, [salt_nc.coords[cst.T_COORD].values])}
+    ds = ds.assign_coords({cst.T_COORD: (cst.T_COORD, [time_coord.values])})
+    ds.coords[cst.T_COORD].attrs = time_coord.attrs
+    return ds
+
+
+@twr.timeit
+def i_metric_month_multi_k(
+    pcm_dict: Dict[int, Union[pyxpcm.pcm, inf.Inference]],
+    time_i: int = cst.EXAMPLE_TIME_INDEX,
+    max_depth: float = cst.MAX_DEPTH,
+    remove_init_var: bool = True,
+    bsose_ds: xr.Dataset = None,
+    store_paths: Dict[int, str] = None,
+) -> Dict[int, xr.Dataset]:
+    """
+    Find the i metric for every K in one month, reading BSOSE once.
+
+    The pcm objects are expected to share their preprocessing (as from
+    `tim.train_multi_k_on_interpolated_year`), so the PCA values are only
+    found once, with the first of them.
+
+    Args:
+        pcm_dict (Dict[int, Union[pyxpcm.pcm, inf.Inference]]): trained pcm
+            object (or its `inf.Inference`) for each K.
+        time_i (int, optional): time index. Defaults to cst.EXAMPLE_TIME_INDEX.
+        max_depth (float, optional): The maximum_depth (in pcm_object) that the data
+            is fitted to. Defaults to cst.MAX_DEPTH.
+        remove_init_var (bool, optional): Whether or not to remove the initial
+            variables. Defaults to True.
+        bsose_ds (xr.Dataset, optional): SALT and THETA for the whole record.
+            Defaults to None, which opens the BSOSE files just for this month.
+        store_paths (Dict[int, str], optional): NetCDF4 store for each K to
+            write the month into. Defaults to None, which just returns them.
+
+    Returns:
+        Dict[int, xr.Dataset]: IMETRIC, A_B and PCA_VALUES for each K.
+    """
+    if bsose_ds is None:
+        both_nc = xvl.open_salt_theta(time_i=time_i, max_depth=max_depth)
+    else:
+        both_nc = bsose_ds.isel({cst.T_COORD: time_i}).load()
+    ds_dict = {}
+    pca_values = None
+    for k_clusters, pcm_object in pcm_dict.items():
+        ds_dict[k_clusters] = i_metric_month(
+            pcm_object,
+            both_nc,
+            remove_init_var=remove_init_var,
+            pca_values=pca_values,
+        )
+        pca_values = ds_dict[k_clusters].PCA_VALUES.isel({cst.T_COORD: 0})
+        if store_paths is not None:
+            sto.write_time_block(
+                ds_dict[k_clusters], store_paths[k_clusters], start=time_i
+            )
+    return ds_dict
+
+
+def open_bsose_once(
+    max_depth: float = cst.MAX_DEPTH,
+    salt_file: str = cst.SALT_FILE,
+    theta_file: str = cst.THETA_FILE,
+) -> xr.Dataset:
+    """Open, merge and mask the BSOSE SALT and THETA files for a whole batch.
+
+    Nothing is read until a month is selected, so the metadata parsing and
+    file handle setup happen once per batch rather than once per month.
+
+    Args:
+        max_depth (float, optional): The maximum_depth (in pcm_object) that the
+            data is fitted to. Defaults to cst.MAX_DEPTH.
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
+
+    Returns:
+        xr.Dataset: lazy SALT and THETA, chunked by month.
+    """
+    return xvl.open_salt_theta(
+        max_depth=max_depth,
+        chunks={cst.T_COORD: 1},
+        salt_file=salt_file,
+        theta_file=theta_file,
     )
-    ds.coords[cst.T_COORD].attrs = salt_nc.coords[cst.T_COORD].attrs
-    ds.to_netcdf(
-        io.return_folder(k_clusters, pca) + str(time_i) + ".nc", format="NETCDF4"
+
+
+def _init_worker(
+    pcm_dict: Dict[int, Union[pyxpcm.pcm, inf.Inference]],
+    salt_file: str = cst.SALT_FILE,
+    theta_file: str = cst.THETA_FILE,
+) -> None:
+    """Keep the trained pcm objects in the worker, so they are sent once per process.
+
+    Args:
+        pcm_dict (Dict[int, Union[pyxpcm.pcm, inf.Inference]]): trained pcm
+            object (or its `inf.Inference`) for each K.
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
+    """
+    par.set_worker_state(
+        {
+            "pcm_dict": pcm_dict,
+            "bsose_ds": open_bsose_once(salt_file=salt_file, theta_file=theta_file),
+        }
     )
 
 
-def run_through_sep(k_clusters: int = cst.K_CLUSTERS, pca: int = cst.D_PCS) -> None:
+def _i_metric_month_worker(time_i: int) -> Tuple[int, Dict[int, xr.Dataset]]:
+    """Run `i_metric_month_multi_k` on the worker's pcm objects.
+
+    Args:
+        time_i (int): time index.
+
+    Returns:
+        Tuple[int, Dict[int, xr.Dataset]]: time_i, the month for each K for
+            the parent to write.
+    """
+    return time_i, i_metric_month_multi_k(
+        par.worker_state("pcm_dict"),
+        time_i=time_i,
+        bsose_ds=par.worker_state("bsose_ds"),
+    )
+
+
+def model_hash(pcm_object: Union[pyxpcm.pcm, inf.Inference]) -> str:
+    """Hash of everything a trained pcm object has learnt.
+
+    Args:
+        pcm_object (Union[pyxpcm.pcm, inf.Inference]): the pcm object which
+            has already been trained, or the same compiled with `inf.Inference`.
+
+    Returns:
+        str: hex digest.
+    """
+    if isinstance(pcm_object, inf.Inference):
+        return mfs.hash_state(
+            pcm_object.axes,
+            pcm_object.matrix,
+            pcm_object.offset,
+            pcm_object.centres_in,
+            pcm_object.precisions,
+            pcm_object.centres,
+            pcm_object.log_norm,
+        )
+    # pylint: disable=protected-access
+    return mfs.hash_state(
+        pcm_object._props,
+        pcm_object._scaler,
+        pcm_object._reducer,
+        pcm_object._homogeniser,
+        pcm_object._classifier,
+    )
+
+
+def checked_model(
+    model: inf.Inference, pcm_object: pyxpcm.pcm, both_nc: xr.Dataset
+) -> Union[pyxpcm.pcm, inf.Inference]:
+    """
+    The compiled model if it agrees with pyxpcm on one month, else the pcm object.
+
+    Args:
+        model (inf.Inference): compiled from `pcm_object`.
+        pcm_object (pyxpcm.pcm): the pcm object which has already been trained.
+        both_nc (xr.Dataset): one month of SALT and THETA to check on.
+
+    Returns:
+        Union[pyxpcm.pcm, inf.Inference]: the model to run the months with.
+    """
+    if inf.matches_pcm(model, pcm_object, both_nc):
+        return model
+    return pcm_object
+
+
+def inference_models(
+    pcm_dict: Dict[int, Union[pyxpcm.pcm, inf.Inference]],
+    both_nc: xr.Dataset,
+    engine: str = cst.INFERENCE_ENGINE,
+) -> Dict[int, Union[pyxpcm.pcm, inf.Inference]]:
+    """
+    The models to run the months with.
+
+    With the "numpy" engine each pcm object is compiled with `inf.Inference`,
+    and checked against pyxpcm on one month. If they do not agree the pcm
+    object is used as it is. Models that are already compiled are kept.
+
+    Args:
+        pcm_dict (Dict[int, Union[pyxpcm.pcm, inf.Inference]]): trained pcm
+            object (or its `inf.Inference`) for each K.
+        both_nc (xr.Dataset): one month of SALT and THETA to check on.
+        engine (str, optional): "numpy" or "pyxpcm".
+            Defaults to cst.INFERENCE_ENGINE.
+
+    Returns:
+        Dict[int, Union[pyxpcm.pcm, inf.Inference]]: model for each K.
+    """
+    if engine == "pyxpcm":
+        return pcm_dict
+    if engine != "numpy":
+        raise ValueError(engine + " is not one of numpy, pyxpcm")
+    models = {}
+    for k_clusters, pcm_object in pcm_dict.items():
+        if isinstance(pcm_object, inf.Inference):
+            models[k_clusters] = pcm_object
+            continue
+        models[k_clusters] = checked_model(
+            inf.Inference.from_pcm(pcm_object), pcm_object, both_nc
+        )
+        if models[k_clusters] is pcm_object:
+            print("K =", k_clusters, "does not match pyxpcm, so pyxpcm is used.")
+    return models
+
+
+def run_months(
+    pcm_dict: Dict[int, Union[pyxpcm.pcm, inf.Inference]],
+    pca: int = cst.D_PCS,
+    workers: int = cst.N_WORKERS,
+    resume: bool = False,
+    months: Sequence[int] = range(60),
+    engine: str = cst.INFERENCE_ENGINE,
+    salt_file: str = cst.SALT_FILE,
+    theta_file: str = cst.THETA_FILE,
+    store_paths: Dict[int, str] = None,
+    manifest_path: str = cst.MANIFEST_FILE_NAME,
+) -> List[int]:
+    """
+    Run the trained pcm objects through every month.
+
+    Each month is written straight into a store for each K, which has an
+    unlimited time dimension, so the months already written can be read
+    while the batch is still running. The months are written in order
+    whatever the number of workers, so the stores are the same byte for byte.
+
+    Every month written is recorded in the manifest, with hashes of the
+    model and the BSOSE files. With resume, the months already recorded for
+    the same model and inputs are skipped.
+
+    Args:
+        pcm_dict (Dict[int, Union[pyxpcm.pcm, inf.Inference]]): trained pcm
+            object (or its `inf.Inference`) for each K.
+        pca (int, optional): How many principal components were chosen to be
+            fitted. Defaults to cst.D_PCS.
+        workers (int, optional): number of processes to run the months on.
+            1 runs them one after another in this process. Defaults to
+            cst.N_WORKERS.
+        resume (bool, optional): skip the months that are already done.
+            Defaults to False, which starts the stores again.
+        months (Sequence[int], optional): time indices to run.
+            Defaults to range(60).
+        engine (str, optional): "numpy" to run the months with the compiled
+            `inf.Inference` models, or "pyxpcm". Defaults to cst.INFERENCE_ENGINE.
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
+        store_paths (Dict[int, str], optional): NetCDF4 store for each K.
+            Defaults to None, which uses `io.return_name(k_clusters, pca)
+            + ".nc"`.
+        manifest_path (str, optional): json file of the months done.
+            Defaults to cst.MANIFEST_FILE_NAME.
+
+    Returns:
+        List[int]: the time indices that were run.
+
+    Raises:
+        ValueError: if a store would be started from a month other than 0.
+    """
+    if store_paths is None:
+        store_paths = {
+            k_clusters: io.return_name(k_clusters, pca) + ".nc"
+            for k_clusters in pcm_dict
+        }
+    if len(months) > 0 and min(months) > 0:
+        for store_path in store_paths.values():
+            if not resume or not os.path.isfile(store_path):
+                raise ValueError(
+                    "months start at "
+                    + str(min(months))
+                    + ", but "
+                    + store_path
+                    + " is started again, and a store has to start at time "
+                    "index 0. Run from month 0, or resume a store that has it."
+                )
+    models = {
+        k_clusters: model_hash(pcm_object)
+        for k_clusters, pcm_object in pcm_dict.items()
+    }
+    inputs = mfs.hash_files([salt_file, theta_file])
+    manifest = mfs.Manifest(manifest_path)
+    if not resume:
+        for k_clusters, store_path in store_paths.items():
+            manifest.forget(k_clusters, pca)
+            if os.path.isfile(store_path):
+                os.remove(store_path)
+    todo = manifest.pending_months(models, pca, inputs, store_paths, months)
+    print("months to run: ", len(todo), "of", len(months))
+    if not todo:
+        return todo
+    bsose_ds = open_bsose_once(salt_file=salt_file, theta_file=theta_file)
+    run_dict = inference_models(
+        pcm_dict, bsose_ds.isel({cst.T_COORD: todo[0]}).load(), engine=engine
+    )
+
+    def write_month(time_i: int, ds_dict: Dict[int, xr.Dataset]) -> None:
+        for k_clusters, ds in ds_dict.items():
+            sto.write_time_block(ds, store_paths[k_clusters], start=time_i)
+            manifest.mark_done(k_clusters, pca, time_i, models[k_clusters], inputs)
+
+    if workers <= 1:
+        for time_i in todo:
+            ds_dict = i_metric_month_multi_k(run_dict, time_i=time_i, bsose_ds=bsose_ds)
+            write_month(time_i, ds_dict)
+    else:
+        # every month is independent once the pcm is trained. Only this
+        # process writes to the stores, and it writes the months in order,
+        # so each store always holds a complete run of months from the start.
+        pending = {}
+        next_j = 0
+        with par.spawn_pool(
+            workers, _init_worker, (run_dict, salt_file, theta_file)
+        ) as executor:
+            futures = [
+                executor.submit(_i_metric_month_worker, time_i) for time_i in todo
+            ]
+            for future in as_completed(futures):
+                time_i, pending[time_i] = future.result()
+                print("finished time_i", time_i)
+                while next_j < len(todo) and todo[next_j] in pending:
+                    write_month(todo[next_j], pending.pop(todo[next_j]))
+                    next_j += 1
+    return todo
+
+
+def run_through_sep(
+    k_clusters: int = cst.K_CLUSTERS,
+    pca: int = cst.D_PCS,
+    workers: int = cst.N_WORKERS,
+    resume: bool = False,
+) -> None:
     """
     Run through joint.
 
     Args:
         k_clusters (int, optional): [description]. Defaults to 5.
         pca (int, optional): [description]. Defaults to 3.
+        workers (int, optional): number of processes to run the months on.
+            1 runs them one after another in this process. Defaults to
+            cst.N_WORKERS.
+        resume (bool, optional): skip the months finished by the last run.
+            Defaults to False.
     """
-    pcm_object, _ = tim.train_on_interpolated_year(
+    pcm_dict = tim.train_multi_k_on_interpolated_year(
+        k_list=[k_clusters],
         time_i=cst.EXAMPLE_TIME_INDEX,
-        k_clusters=k_clusters,
         maxvar=pca,
         min_depth=cst.MIN_DEPTH,
         max_depth=cst.MAX_DEPTH,
         separate_pca=False,
+        workers=1,
     )
-    for time_i in range(60):
-        pca_from_interpolated_year(
-            pcm_object, k_clusters=k_clusters, pca=pca, time_i=time_i
-        )
+    run_months(pcm_dict, pca=pca, workers=workers, resume=resume)
 
 
-def merge_and_save(k_clusters: int = 5, pca: int = 3) -> None:
-    """Merge and save joint."""
+def run_through_multi_k(
+    k_list: Sequence[int] = cst.K_LIST,
+    pca: int = cst.D_PCS,
+    workers: int = cst.N_WORKERS,
+    resume: bool = False,
+) -> None:
+    """
+    Run through joint for several K, sharing the preprocessing between them.
 
-    pca_ds = xr.open_mfdataset(
-        io.return_folder(k_clusters, pca) + "*.nc",
-        concat_dim=cst.T_COORD,
-        combine="by_coords",
-        chunks={cst.T_COORD: 1},
-        data_vars="minimal",
-        coords="minimal",
-        compat="override",
-    )
-    xr.save_mfdataset(
-        [pca_ds], [io.return_name(k_clusters, pca) + ".nc"], format="NETCDF4"
+    The interpolation, scaling and PCA are fitted once, only the Gaussian
+    mixtures are fitted for each K, and each month of BSOSE is read and
+    projected once for all of them.
+
+    Args:
+        k_list (Sequence[int], optional): numbers of clusters.
+            Defaults to cst.K_LIST.
+        pca (int, optional): How many principal components were chosen to be
+            fitted. Defaults to cst.D_PCS.
+        workers (int, optional): number of processes to fit and run the months
+            on. Defaults to cst.N_WORKERS.
+        resume (bool, optional): skip the months finished by the last run.
+            Defaults to False.
+    """
+    pcm_dict = tim.train_multi_k_on_interpolated_year(
+        k_list=k_list,
+        time_i=cst.EXAMPLE_TIME_INDEX,
+        maxvar=pca,
+        min_depth=cst.MIN_DEPTH,
+        max_depth=cst.MAX_DEPTH,
+        separate_pca=False,
+        workers=workers,
     )
+    run_months(pcm_dict, pca=pca, workers=workers, resume=resume)
+
 
+def run_through(workers: int = cst.N_WORKERS, resume: bool = False) -> None:
+    """Run through.
 
-def run_through() -> None:
-    """Run through."""
-    k_list = cst.K_LIST
-    for k_clusters in k_list:
-        run_through_sep(k_clusters=k_clusters)
-        merge_and_save(k_clusters=k_clusters)
+    Args:
+        workers (int, optional): number of processes for the training and
+            the monthly inference. Defaults to cst.N_WORKERS.
+        resume (bool, optional): carry on from where the last run stopped.
+            Defaults to False.
+    """
+    run_through_multi_k(k_list=cst.K_LIST, workers=workers, resume=resume)
 
 
 if __name__ == "__main__":
-    run_through()
+    parser = argparse.ArgumentParser(description="Make the i metric for every K.")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the months already finished with the same model and inputs",
+    )
+    parser.add_argument("--workers", type=int, default=cst.N_WORKERS)
+    args = parser.parse_args()
+    run_through(workers=args.workers, resume=args.resume)
@@ -0,0 +1,213 @@
+"""How the fitted pcm changes with the size of the training subsample.
+
+The pcm is fitted on stratified subsamples of the training year of
+increasing size (see `smp.stratified_sample`), and each fit is compared
+with the fit on every profile:
+
+- the class mean SALT and THETA profiles, after matching the class numbers,
+- the i metric map, and
+- the fraction of profiles given the same class.
+
+If these stop changing well below the full size, the subsample can be used
+to fit in seconds without changing the answer.
+
+Example:
+    Usage::
+        python3 src/models/convergence.py
+"""
+import os
+import time
+from typing import Dict, Sequence, Tuple
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pyxpcm
+import src.constants as cst
+import src.time_wrapper as twr
+import src.data_loading.sampling as smp
+import src.models.labels as lab
+import src.models.train_pyxpcm as tim
+
+
+def posteriors(pcm_object: pyxpcm.pcm, ds: xr.Dataset) -> np.ndarray:
+    """Class probabilities of every profile in a (time, Z, YC, XC) dataset.
+
+    Args:
+        pcm_object (pyxpcm.pcm): trained pcm object.
+        ds (xr.Dataset): SALT and THETA.
+
+    Returns:
+        np.ndarray: (time, YC, XC, K), NaN where the profile is not defined.
+    """
+    return (
+        pcm_object.predict_proba(ds, features=cst.FEATURES_D, dim=cst.Z_COORD)
+        .transpose(cst.T_COORD, cst.Y_COORD, cst.X_COORD, "pcm_class")
+        .values
+    )
+
+
+def labels_and_i_metric(proba: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Most likely class and i metric, 1 - (p_A - p_B), from the probabilities.
+
+    Args:
+        proba (np.ndarray): (..., K) class probabilities.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: labels and i metric, both float with NaN
+            where the probabilities are not defined.
+    """
+    valid = np.all(np.isfinite(proba), axis=-1)
+    filled = np.where(valid[..., None], proba, 0.0)
+    top_two = -np.partition(-filled, 1, axis=-1)[..., :2]
+    labels = np.where(valid, np.argmax(filled, axis=-1), np.nan)
+    i_metric = np.where(valid, 1 - (top_two[..., 0] - top_two[..., 1]), np.nan)
+    return labels, i_metric
+
+
+def class_means(
+    ds: xr.Dataset, labels: np.ndarray, k_clusters: int
+) -> Dict[str, np.ndarray]:
+    """Mean profile of each class.
+
+    Args:
+        ds (xr.Dataset): SALT and THETA (time, Z, YC, XC).
+        labels (np.ndarray): (time, YC, XC) labels, NaN where not defined.
+        k_clusters (int): number of classes.
+
+    Returns:
+        Dict[str, np.ndarray]: (K, Z) for each variable, NaN for empty classes.
+    """
+    valid = np.isfinite(labels)
+    flat_labels = labels[valid].astype("int64")
+    counts = np.bincount(flat_labels, minlength=k_clusters).astype("float64")
+    means = {}
+    for var in cst.VAR_NAME_LIST:
+        profiles = (
+            ds[var]
+            .transpose(cst.T_COORD, cst.Y_COORD, cst.X_COORD, cst.Z_COORD)
+            .values[valid]
+        )
+        sums = np.zeros((k_clusters, profiles.shape[-1]))
+        np.add.at(sums, flat_labels, np.nan_to_num(profiles))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means[var] = sums / counts[:, None]
+    return means
+
+
+def _rms(diff: np.ndarray) -> float:
+    return float(np.sqrt(np.nanmean(np.square(diff))))
+
+
+def compare_fit(
+    ds: xr.Dataset,
+    proba: np.ndarray,
+    ref_proba: np.ndarray,
+    k_clusters: int,
+) -> Dict[str, float]:
+    """Compare a fit with the reference fit, after matching the class numbers.
+
+    Args:
+        ds (xr.Dataset): SALT and THETA (time, Z, YC, XC).
+        proba (np.ndarray): (time, YC, XC, K) class probabilities of the fit.
+        ref_proba (np.ndarray): the same from the reference fit.
+        k_clusters (int): number of classes.
+
+    Returns:
+        Dict[str, float]: RMS difference of the class mean SALT and THETA
+            profiles, RMS and largest difference of the i metric, and the
+            fraction of profiles with the same class.
+    """
+    ref_labels, ref_i_metric = labels_and_i_metric(ref_proba)
+    ref_means = class_means(ds, ref_labels, k_clusters)
+    labels, i_metric = labels_and_i_metric(proba)
+    labels = lab.relabel(labels, lab.match_labels(ref_labels, labels, k_clusters))
+    means = class_means(ds, labels, k_clusters)
+    row = {}
+    for var in cst.VAR_NAME_LIST:
+        row[var + "_mean_rms"] = _rms(means[var] - ref_means[var])
+    row["imetric_rms"] = _rms(i_metric - ref_i_metric)
+    row["imetric_max"] = float(np.nanmax(np.abs(i_metric - ref_i_metric)))
+    row["agreement"] = lab.agreement(ref_labels, labels)
+    return row
+
+
+@twr.timeit
+def convergence(
+    ds: xr.Dataset,
+    sizes: Sequence[int] = cst.SUBSAMPLE_SIZES,
+    k_clusters: int = cst.K_CLUSTERS,
+    maxvar: int = cst.D_PCS,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    separate_pca: bool = False,
+    area: xr.DataArray = None,
+    seed: int = cst.SEED,
+) -> pd.DataFrame:
+    """Fit on subsamples of increasing size and compare with the full fit.
+
+    Args:
+        ds (xr.Dataset): training SALT and THETA (time, Z, YC, XC).
+        sizes (Sequence[int], optional): subsample sizes.
+            Defaults to cst.SUBSAMPLE_SIZES.
+        k_clusters (int, optional): clusters. Defaults to cst.K_CLUSTERS.
+        maxvar (int, optional): num pca. Defaults to cst.D_PCS.
+        min_depth (float, optional): minimum depth for column.
+            Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): maximum depth for column.
+            Defaults to cst.MAX_DEPTH.
+        separate_pca (bool, optional): separate the pca. Defaults to False.
+        area (xr.DataArray, optional): cell areas, see `smp.area_weights`.
+            Defaults to None.
+        seed (int, optional): random seed for the subsamples.
+            Defaults to cst.SEED.
+
+    Returns:
+        pd.DataFrame: for each size (the last row is the full fit): the
+            fit time, RMS difference of the class mean SALT and THETA
+            profiles, RMS and largest difference of the i metric, and the
+            fraction of profiles with the same class.
+    """
+    ds = ds[cst.VAR_NAME_LIST].load()
+
+    def fit(ds_fit: xr.Dataset) -> Tuple[pyxpcm.pcm, float]:
+        pcm_object = tim.make_pcm(
+            k_clusters=k_clusters,
+            maxvar=maxvar,
+            min_depth=min_depth,
+            max_depth=max_depth,
+            separate_pca=separate_pca,
+        )
+        start = time.perf_counter()
+        pcm_object.fit(ds_fit, features=cst.FEATURES_D, dim=cst.Z_COORD)
+        return pcm_object, time.perf_counter() - start
+
+    pcm_full, full_s = fit(ds)
+    ref_proba = posteriors(pcm_full, ds)
+
+    rows = []
+    for n_samples in sorted(sizes):
+        ds_sample = smp.stratified_sample(ds, n_samples, area=area, seed=seed)
+        pcm_object, fit_s = fit(ds_sample)
+        row = {"n_samples": ds_sample.sizes[smp.SAMPLE_DIM], "fit_s": fit_s}
+        row.update(compare_fit(ds, posteriors(pcm_object, ds), ref_proba, k_clusters))
+        rows.append(row)
+        print(row)
+
+    full_row = {
+        "n_samples": int(np.all(np.isfinite(ref_proba), axis=-1).sum()),
+        "fit_s": full_s,
+    }
+    full_row.update(compare_fit(ds, ref_proba, ref_proba, k_clusters))
+    rows.append(full_row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    convergence_df = convergence(tim.interpolated_training_data())
+    print(convergence_df.to_string(index=False))
+    convergence_df.to_csv(
+        os.path.join(
+            cst.DATA_PATH,
+            "subsample-convergence-k-" + str(cst.K_CLUSTERS) + ".csv",
+        )
+    )
@@ -0,0 +1,273 @@
+"""Ensemble of pcm fits that differ only in the seed of the Gaussian mixture.
+The fronts come from the class boundaries of one Gaussian mixture fit, and
+that fit depends on its random initialisation. Here the same pcm is fitted
+from several seeds:
+- the interpolation, scaling and PCA are fitted once, and every member's
+  Gaussian mixture is fitted on that one reduced matrix, in parallel,
+- the members' class numbers are matched to the first member's by their
+  class means in the shared reduced space (Hungarian algorithm),
+- the PCA values of every profile are found once, and each member only
+  classifies them.
+
+The outputs are each member's (matched) labels and i metric, and per cell
+the most common label, the fraction of members that agree with it, and
+the mean and spread of the i metric.
+
+Example:
+    Usage::
+        python3 src/models/ensemble.py --members 8 --workers 8
+"""
+import os
+import argparse
+from typing import Dict, Sequence
+import numpy as np
+import xarray as xr
+from sklearn.base import clone
+import pyxpcm
+import src.constants as cst
+import src.time_wrapper as twr
+import src.data_loading.encoding as enc
+import src.models.inference as inf
+import src.models.labels as lab
+import src.models.train_pyxpcm as tim
+
+MEMBER_DIM: str = "member"
+
+
+def member_seeds(n_members: int = cst.N_ENSEMBLE, seed: int = cst.SEED) -> list:
+    """Seeds of the ensemble members, the first is the usual run's.
+
+    Args:
+        n_members (int, optional): number of members. Defaults to cst.N_ENSEMBLE.
+        seed (int, optional): first seed. Defaults to cst.SEED.
+
+    Returns:
+        list: `n_members` consecutive seeds.
+    """
+    return [seed + i for i in range(n_members)]
+
+
+@twr.timeit
+def fit_ensemble(
+    pcm_object: pyxpcm.pcm,
+    ds: xr.Dataset,
+    seeds: Sequence[int] = None,
+    features: dict = cst.FEATURES_D,
+    dim: str = cst.Z_COORD,
+    workers: int = cst.N_WORKERS,
+) -> Dict[int, pyxpcm.pcm]:
+    """Fit the classifier of one pcm from several seeds, sharing the rest.
+
+    Args:
+        pcm_object (pyxpcm.pcm): untrained pcm object, which sets the
+            preprocessing and the classifier settings.
+        ds (xr.Dataset): training data.
+        seeds (Sequence[int], optional): a member for each. Defaults to
+            `member_seeds()`.
+        features (dict, optional): features mapping. Defaults to cst.FEATURES_D.
+        dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+        workers (int, optional): processes to fit the classifiers on.
+            Defaults to cst.N_WORKERS.
+
+    Returns:
+        Dict[int, pyxpcm.pcm]: a trained pcm object for each seed.
+    """
+    # pylint: disable=protected-access
+    if seeds is None:
+        seeds = member_seeds()
+    x_values = tim.reduced_features(pcm_object, ds, features=features, dim=dim)
+    classifiers = [
+        clone(pcm_object._classifier).set_params(random_state=seed) for seed in seeds
+    ]
+    fits = tim.fit_classifiers(classifiers, x_values, workers=workers)
+    return {
+        seed: tim.with_classifier(pcm_object, classifier, llh, x_values.shape[0])
+        for seed, (classifier, llh) in zip(seeds, fits)
+    }
+
+
+def alignments(pcm_dict: Dict[int, pyxpcm.pcm]) -> Dict[int, np.ndarray]:
+    """Match each member's class numbers to the first member's.
+
+    Args:
+        pcm_dict (Dict[int, pyxpcm.pcm]): from `fit_ensemble`.
+
+    Returns:
+        Dict[int, np.ndarray]: mapping for each seed (see `lab.match_means`),
+            the identity for the first.
+    """
+    # pylint: disable=protected-access
+    reference = next(iter(pcm_dict.values()))._classifier.means_
+    return {
+        seed: lab.match_means(reference, pcm_object._classifier.means_)
+        for seed, pcm_object in pcm_dict.items()
+    }
+
+
+def ensemble_statistics(
+    labels: np.ndarray, i_metric: np.ndarray, k_clusters: int
+) -> Dict[str, np.ndarray]:
+    """Agreement of matched labels and spread of the i metric across members.
+
+    Args:
+        labels (np.ndarray): (member, ...) matched labels, NaN where not
+            defined.
+        i_metric (np.ndarray): (member, ...) i metric.
+        k_clusters (int): number of classes.
+
+    Returns:
+        Dict[str, np.ndarray]: over (...), "ENSEMBLE_LABELS" the most common
+            label, "LABEL_AGREEMENT" the fraction of members with it,
+            "IMETRIC_MEAN" and "IMETRIC_SPREAD" (standard deviation), all NaN
+            where any member is not defined.
+    """
+    valid = np.all(np.isfinite(labels), axis=0)
+    counts = np.stack([np.sum(labels == k, axis=0) for k in range(k_clusters)], axis=0)
+    with np.errstate(invalid="ignore"):
+        i_mean = np.mean(i_metric, axis=0)
+        i_spread = np.std(i_metric, axis=0)
+    return {
+        "ENSEMBLE_LABELS": np.where(valid, np.argmax(counts, axis=0), np.nan),
+        "LABEL_AGREEMENT": np.where(valid, counts.max(axis=0) / len(labels), np.nan),
+        "IMETRIC_MEAN": np.where(valid, i_mean, np.nan),
+        "IMETRIC_SPREAD": np.where(valid, i_spread, np.nan),
+    }
+
+
+@twr.timeit
+def ensemble_dataset(
+    pcm_dict: Dict[int, pyxpcm.pcm],
+    ds: xr.Dataset,
+    dim: str = cst.Z_COORD,
+    dtype: str = cst.INFERENCE_DTYPE,
+) -> xr.Dataset:
+    """Run every member on a dataset and compare them.
+
+    Args:
+        pcm_dict (Dict[int, pyxpcm.pcm]): from `fit_ensemble`.
+        ds (xr.Dataset): SALT and THETA, e.g. the training year.
+        dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+        dtype (str, optional): precision of the inference.
+            Defaults to cst.INFERENCE_DTYPE.
+
+    Returns:
+        xr.Dataset: PCM_LABELS and IMETRIC (member, ...), with the labels
+            matched to the first member, and the fields of
+            `ensemble_statistics` over (...).
+    """
+    models = {
+        seed: inf.Inference.from_pcm(pcm_object, dtype=dtype)
+        for seed, pcm_object in pcm_dict.items()
+    }
+    first = next(iter(models.values()))
+    # the members share their preprocessing, so the PCA values are found once.
+    pca_values = first.dataset(ds, dim=dim, names=["PCA_VALUES"]).PCA_VALUES
+    mappings = alignments(pcm_dict)
+    members = []
+    for seed, model in models.items():
+        ds_member = model.dataset(
+            ds, dim=dim, pca_values=pca_values, names=["IMETRIC", "PCM_LABELS"]
+        ).isel(Imetric=0, drop=True).drop_vars(["rank", "pca"])
+        ds_member["PCM_LABELS"].values = lab.relabel(
+            ds_member["PCM_LABELS"].values, mappings[seed]
+        )
+        members.append(ds_member)
+    ds_out = xr.concat(members, dim=MEMBER_DIM).assign_coords(
+        {MEMBER_DIM: list(pcm_dict)}
+    )
+    sampling_dims = ds_out.PCM_LABELS.dims[1:]
+    stats = ensemble_statistics(
+        ds_out.PCM_LABELS.values,
+        ds_out.IMETRIC.values,
+        first.k_clusters,
+    )
+    for name, values in stats.items():
+        ds_out[name] = (sampling_dims, values)
+    return ds_out
+
+
+@twr.timeit
+def run_ensemble(
+    n_members: int = cst.N_ENSEMBLE,
+    k_clusters: int = cst.K_CLUSTERS,
+    time_i: int = cst.EXAMPLE_TIME_INDEX,
+    maxvar: int = cst.D_PCS,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    separate_pca: bool = False,
+    interp: bool = True,
+    remake: bool = cst.REMAKE,
+    workers: int = cst.N_WORKERS,
+    n_samples: int = cst.N_SAMPLES,
+) -> xr.Dataset:
+    """Fit the ensemble on the training year and save how much it agrees.
+
+    Args:
+        n_members (int, optional): number of seeds. Defaults to cst.N_ENSEMBLE.
+        k_clusters (int, optional): clusters. Defaults to cst.K_CLUSTERS.
+        time_i (int, optional): time index. Defaults to cst.EXAMPLE_TIME_INDEX.
+        maxvar (int, optional): num pca. Defaults to cst.D_PCS.
+        min_depth (float, optional): minimum depth for column.
+            Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): maximum depth for column.
+            Defaults to cst.MAX_DEPTH.
+        separate_pca (bool, optional): separate the pca. Defaults to False.
+        interp (bool, optional): interpolate the training data onto a coarser
+            grid. Defaults to True.
+        remake (bool, optional): remake the training data. Defaults to cst.REMAKE.
+        workers (int, optional): processes to fit the members on.
+            Defaults to cst.N_WORKERS.
+        n_samples (int, optional): fit on a stratified subsample of this many
+            profiles, None for every profile. Defaults to cst.N_SAMPLES.
+
+    Returns:
+        xr.Dataset: from `ensemble_dataset`, over the training year.
+    """
+    ds = tim.interpolated_training_data(
+        time_i=time_i,
+        min_depth=min_depth,
+        max_depth=max_depth,
+        interp=interp,
+        remake=remake,
+    )
+    pcm_object = tim.make_pcm(
+        k_clusters=k_clusters,
+        maxvar=maxvar,
+        min_depth=min_depth,
+        max_depth=max_depth,
+        separate_pca=separate_pca,
+    )
+    pcm_dict = fit_ensemble(
+        pcm_object,
+        tim.fitting_data(ds, n_samples=n_samples),
+        seeds=member_seeds(n_members),
+        workers=workers,
+    )
+    ds_out = ensemble_dataset(pcm_dict, ds)
+    reference = ds_out.PCM_LABELS.isel({MEMBER_DIM: 0}).values
+    for seed in pcm_dict:
+        print(
+            "seed",
+            seed,
+            "agreement with first member:",
+            lab.agreement(reference, ds_out.PCM_LABELS.sel({MEMBER_DIM: seed}).values),
+        )
+    enc.to_netcdf(
+        ds_out,
+        os.path.join(
+            cst.DATA_PATH,
+            "ensemble-k-" + str(k_clusters) + "-n-" + str(n_members) + ".nc",
+        ),
+    )
+    return ds_out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fit the pcm from several seeds and compare them."
+    )
+    parser.add_argument("--members", type=int, default=cst.N_ENSEMBLE)
+    parser.add_argument("--k", type=int, default=cst.K_CLUSTERS)
+    parser.add_argument("--workers", type=int, default=cst.N_WORKERS)
+    args = parser.parse_args()
+    run_ensemble(n_members=args.members, k_clusters=args.k, workers=args.workers)
@@ -0,0 +1,524 @@
+"""Fast inference with a trained pcm, on plain NumPy arrays.
+
+`pcm.find_i_metric`, `pcm.add_pca_to_xarray` and `pcm.predict` each stack
+the dataset, redo the preprocessing and unstack it again with their own
+attribute bookkeeping. Here the fitted parts of the pcm are compiled once
+into a few arrays:
+
+- the vertical interpolation onto the feature axis, as the index of the
+  level above and below each feature depth and a weight,
+- the scaling, PCA and homogenisation, which are all affine, folded into
+  one matrix and offset,
+- the Gaussian mixture, as the precision Cholesky factors of all the
+  classes side by side, so each class's log density comes from one
+  matrix product.
+
+The profiles are then pushed through in chunks, and the PCA values, the
+two most likely classes (`A_B`), the i metric, 1 - (p_A - p_B), and the
+labels all come out of the one pass.
+
+Example:
+    Usage::
+        import src.models.inference as inf
+        model = inf.Inference.from_pcm(pcm_object, dtype="float32")
+        ds_out = model.dataset(both_nc)
+"""
+from typing import Dict, Sequence, Tuple
+import numpy as np
+import xarray as xr
+import pyxpcm
+from sklearn.mixture import GaussianMixture
+import src.constants as cst
+
+OUTPUT_NAMES: tuple = ("PCA_VALUES", "A_B", "IMETRIC", "PCM_LABELS")
+
+
+def interpolation_indices(
+    z_values: np.ndarray, axis: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Linear interpolation from the levels `z_values` onto `axis`.
+
+    Args:
+        z_values (np.ndarray): input level heights (negative downwards).
+        axis (np.ndarray): feature axis, within the range of `z_values`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: index of the level on
+            either side of each axis point, and the weight of the second.
+            Where an axis point is on a level both indices are that level.
+    """
+    z_values = np.asarray(z_values, dtype="float64")
+    axis = np.asarray(axis, dtype="float64")
+    if axis.min() < z_values.min() or axis.max() > z_values.max():
+        raise ValueError(
+            "The feature axis [%0.2f, %0.2f] is not inside the levels [%0.2f, %0.2f]"
+            % (axis.min(), axis.max(), z_values.min(), z_values.max())
+        )
+    order = np.argsort(z_values)
+    z_sorted = z_values[order]
+    upper = np.clip(np.searchsorted(z_sorted, axis, side="left"), 1, len(z_sorted) - 1)
+    lower = upper - 1
+    weight = (axis - z_sorted[lower]) / (z_sorted[upper] - z_sorted[lower])
+    on_upper = weight == 1.0
+    on_lower = weight == 0.0
+    lower = np.where(on_upper, upper, lower)
+    upper = np.where(on_lower, lower, upper)
+    weight = np.where(on_upper | on_lower, 0.0, weight)
+    return order[lower], order[upper], weight
+
+
+def _affine(estimator: any, n_in: int) -> Tuple[np.ndarray, np.ndarray]:
+    """`estimator.transform(x)` as `x @ matrix + offset`.
+
+    Args:
+        estimator (any): a fitted StandardScaler or PCA, or anything without
+            either (e.g. pyxpcm's NoTransform), which is taken as the identity.
+        n_in (int): number of inputs.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (n_in, n_out) matrix and (n_out,) offset.
+    """
+    if hasattr(estimator, "components_"):
+        matrix = np.array(estimator.components_.T, dtype="float64")
+        if getattr(estimator, "whiten", False):
+            matrix = matrix / np.sqrt(estimator.explained_variance_)[None, :]
+        mean = np.zeros(n_in) if estimator.mean_ is None else estimator.mean_
+        return matrix, -np.asarray(mean, dtype="float64") @ matrix
+    if hasattr(estimator, "n_features_in_") and hasattr(estimator, "scale_"):
+        scale = np.ones(n_in) if estimator.scale_ is None else estimator.scale_
+        mean = np.zeros(n_in) if estimator.mean_ is None else estimator.mean_
+        return np.diag(1.0 / scale), -np.asarray(mean) / scale
+    return np.eye(n_in), np.zeros(n_in)
+
+
+class Inference:
+    """
+    A trained pcm, compiled to run on (profiles, levels) NumPy arrays.
+
+    Example:
+        Usage::
+            model = Inference.from_pcm(pcm_object)
+            out = model.predict({"SALT": salt, "THETA": theta}, z_values)
+            out["IMETRIC"]  # (profiles,)
+    """
+
+    def __init__(
+        self,
+        axes: Dict[str, np.ndarray],
+        scalers: Dict[str, any],
+        reducers: Dict[str, any],
+        homogeniser: Dict[str, dict],
+        classifier: GaussianMixture,
+        dtype: str = cst.INFERENCE_DTYPE,
+        chunk_size: int = cst.INFERENCE_CHUNK_SIZE,
+    ) -> None:
+        """
+        Compile the fitted parts of a pcm.
+
+        Args:
+            axes (Dict[str, np.ndarray]): feature name to its depth axis, in
+                the order the features are joined.
+            scalers (Dict[str, any]): fitted scaler for each feature.
+            reducers (Dict[str, any]): fitted PCA for each feature, or a
+                single PCA under another name which is applied to all the
+                scaled features joined together.
+            homogeniser (Dict[str, dict]): "mean" and "std" of each
+                feature's reduced values, used when there is more than one
+                feature and one PCA each.
+            classifier (GaussianMixture): fitted, with full covariances.
+            dtype (str, optional): "float32" or "float64" to compute in.
+                Defaults to cst.INFERENCE_DTYPE.
+            chunk_size (int, optional): profiles per chunk.
+                Defaults to cst.INFERENCE_CHUNK_SIZE.
+        """
+        if classifier.covariance_type != "full":
+            raise ValueError(
+                "Only full covariances are compiled, not "
+                + str(classifier.covariance_type)
+            )
+        self.axes = {feature: np.asarray(axis) for feature, axis in axes.items()}
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = int(chunk_size)
+
+        blocks = []
+        for feature, axis in self.axes.items():
+            blocks.append(_affine(scalers[feature], len(axis)))
+        separate = set(reducers) == set(self.axes)
+        if separate:
+            reduced = []
+            for (matrix, offset), feature in zip(blocks, self.axes):
+                pca_matrix, pca_offset = _affine(reducers[feature], matrix.shape[1])
+                matrix, offset = matrix @ pca_matrix, offset @ pca_matrix + pca_offset
+                if len(self.axes) > 1:
+                    mean = float(homogeniser[feature]["mean"])
+                    std = float(homogeniser[feature]["std"])
+                    matrix, offset = matrix / std, (offset - mean) / std
+                reduced.append((matrix, offset))
+            blocks = reduced
+        n_in = sum(matrix.shape[0] for matrix, _ in blocks)
+        n_out = sum(matrix.shape[1] for matrix, _ in blocks)
+        matrix = np.zeros((n_in, n_out))
+        row, col = 0, 0
+        for block, _ in blocks:
+            matrix[row : row + block.shape[0], col : col + block.shape[1]] = block
+            row, col = row + block.shape[0], col + block.shape[1]
+        offset = np.concatenate([offset for _, offset in blocks])
+        if not separate:
+            (joint,) = reducers.values()
+            pca_matrix, pca_offset = _affine(joint, n_out)
+            matrix, offset = matrix @ pca_matrix, offset @ pca_matrix + pca_offset
+        self.matrix = matrix
+        self.offset = offset
+        # a typical value of each feature, that the inputs are moved by
+        # before the product so that float32 does not lose the small
+        # differences to cancellation.
+        self.centres_in = {}
+        for feature in self.axes:
+            mean = getattr(scalers[feature], "mean_", None)
+            self.centres_in[feature] = 0.0 if mean is None else float(np.mean(mean))
+        self.n_pca = self.matrix.shape[1]
+
+        # log N(x | mu_k, Sigma_k) = -0.5 * |x P_k - mu_k P_k|^2 + c_k, where
+        # P_k is the Cholesky factor of the precision.
+        precisions = np.asarray(classifier.precisions_cholesky_, dtype="float64")
+        self.k_clusters = precisions.shape[0]
+        self.precisions = (
+            np.transpose(precisions, (1, 0, 2))
+            .reshape(self.n_pca, self.k_clusters * self.n_pca)
+            .astype(self.dtype)
+        )
+        self.centres = np.einsum("kd,kde->ke", classifier.means_, precisions).astype(
+            self.dtype
+        )
+        self.log_norm = (
+            np.log(classifier.weights_)
+            + np.sum(np.log(np.diagonal(precisions, axis1=1, axis2=2)), axis=1)
+            - 0.5 * self.n_pca * np.log(2 * np.pi)
+        ).astype(self.dtype)
+        self._compiled = {}
+
+    def __repr__(self) -> str:
+        return "<Inference K=%i, %i features -> %i pca, %s, chunks of %i>" % (
+            self.k_clusters,
+            len(self.axes),
+            self.n_pca,
+            self.dtype.name,
+            self.chunk_size,
+        )
+
+    @classmethod
+    def from_pcm(
+        cls,
+        pcm_object: pyxpcm.pcm,
+        dtype: str = cst.INFERENCE_DTYPE,
+        chunk_size: int = cst.INFERENCE_CHUNK_SIZE,
+    ) -> "Inference":
+        """
+        Compile a trained pcm object.
+
+        Args:
+            pcm_object (pyxpcm.pcm): the pcm object which has already been trained.
+            dtype (str, optional): "float32" or "float64".
+                Defaults to cst.INFERENCE_DTYPE.
+            chunk_size (int, optional): profiles per chunk.
+                Defaults to cst.INFERENCE_CHUNK_SIZE.
+
+        Returns:
+            Inference: the compiled model.
+        """
+        # pylint: disable=protected-access
+        return cls(
+            pcm_object._props["features"],
+            pcm_object._scaler,
+            pcm_object._reducer,
+            pcm_object._homogeniser,
+            pcm_object._classifier,
+            dtype=dtype,
+            chunk_size=chunk_size,
+        )
+
+    def compile_levels(self, z_values: np.ndarray) -> dict:
+        """
+        Fold the interpolation from a set of levels into the affine map.
+
+        The interpolation is linear, so with the scaling, PCA and
+        homogenisation it is one matrix from the levels that it uses to the
+        PCA values. These are kept for each set of levels seen.
+
+        Args:
+            z_values (np.ndarray): the levels of the input profiles.
+
+        Returns:
+            dict: for each feature, the level indices used and their
+                (levels used, pca) matrix, and the offset.
+        """
+        key = np.asarray(z_values, dtype="float64").tobytes()
+        if key in self._compiled:
+            return self._compiled[key]
+        z_values = np.asarray(z_values, dtype="float64")
+        compiled = {"levels": {}, "matrices": {}}
+        offset = self.offset.copy()
+        row = 0
+        for feature, axis in self.axes.items():
+            lower, upper, weight = interpolation_indices(z_values, axis)
+            in_band = np.nonzero((z_values >= axis.min()) & (z_values <= axis.max()))[0]
+            levels = np.unique(np.concatenate([lower, upper, in_band]))
+            interp = np.zeros((len(levels), len(axis)))
+            columns = np.arange(len(axis))
+            np.add.at(interp, (np.searchsorted(levels, lower), columns), 1 - weight)
+            np.add.at(interp, (np.searchsorted(levels, upper), columns), weight)
+            matrix = interp @ self.matrix[row : row + len(axis)]
+            row += len(axis)
+            offset = offset + self.centres_in[feature] * matrix.sum(axis=0)
+            compiled["levels"][feature] = levels
+            compiled["matrices"][feature] = matrix.astype(self.dtype)
+        compiled["offset"] = offset.astype(self.dtype)
+        self._compiled[key] = compiled
+        return compiled
+
+    def reduce(
+        self, profiles: Dict[str, np.ndarray], z_values: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        PCA values of the profiles that are defined where the pcm needs them.
+
+        A profile is used if it is finite on every level inside the feature
+        axis (as in pyxpcm's mask) and on the levels either side that the
+        interpolation reads.
+
+        Args:
+            profiles (Dict[str, np.ndarray]): (profiles, levels) for each
+                feature.
+            z_values (np.ndarray): the levels.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (valid profiles, pca) values, and
+                which profiles are valid.
+        """
+        compiled = self.compile_levels(z_values)
+        used = {}
+        valid = None
+        for feature in self.axes:
+            used[feature] = np.asarray(profiles[feature])[
+                :, compiled["levels"][feature]
+            ]
+            defined = np.all(np.isfinite(used[feature]), axis=1)
+            valid = defined if valid is None else valid & defined
+        reduced = np.broadcast_to(
+            compiled["offset"], (int(valid.sum()), self.n_pca)
+        ).copy()
+        for feature in self.axes:
+            values = used[feature][valid].astype(self.dtype)
+            values -= self.dtype.type(self.centres_in[feature])
+            reduced += values @ compiled["matrices"][feature]
+        return reduced, valid
+
+    def classify(self, pca_values: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Class probabilities and what is made from them.
+
+        Args:
+            pca_values (np.ndarray): (profiles, pca), all finite.
+
+        Returns:
+            Dict[str, np.ndarray]: "A_B" (profiles, 2) most and second most
+                likely class, "IMETRIC" (profiles,) and "PCM_LABELS" (profiles,).
+        """
+        n_profiles = pca_values.shape[0]
+        projected = (pca_values @ self.precisions).reshape(
+            n_profiles, self.k_clusters, self.n_pca
+        )
+        projected -= self.centres[None]
+        log_prob = self.log_norm[None] - 0.5 * np.einsum(
+            "nkd,nkd->nk", projected, projected
+        )
+        log_prob -= log_prob.max(axis=1, keepdims=True)
+        prob = np.exp(log_prob)
+        prob /= prob.sum(axis=1, keepdims=True)
+        a_b = np.argsort(-prob, axis=1, kind="stable")[:, :2]
+        top_two = np.take_along_axis(prob, a_b, axis=1)
+        return {
+            "A_B": a_b,
+            "IMETRIC": 1 - (top_two[:, 0] - top_two[:, 1]),
+            "PCM_LABELS": a_b[:, 0],
+        }
+
+    def predict(
+        self,
+        profiles: Dict[str, np.ndarray],
+        z_values: np.ndarray,
+        pca_values: np.ndarray = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Everything for a batch of profiles, one chunk at a time.
+
+        Args:
+            profiles (Dict[str, np.ndarray]): (profiles, levels) for each
+                feature, e.g. {"SALT": salt, "THETA": theta}.
+            z_values (np.ndarray): the levels.
+            pca_values (np.ndarray, optional): (profiles, pca) already found by
+                a model with the same preprocessing (e.g. another K), NaN
+                where not defined. Defaults to None, which finds them.
+
+        Returns:
+            Dict[str, np.ndarray]: "PCA_VALUES" (profiles, pca), "A_B"
+                (profiles, 2), "IMETRIC" (profiles,) and "PCM_LABELS"
+                (profiles,), as float64 with NaN where the profile is not
+                defined.
+        """
+        n_profiles = len(next(iter(profiles.values())))
+        out = {
+            "PCA_VALUES": np.full((n_profiles, self.n_pca), np.nan),
+            "A_B": np.full((n_profiles, 2), np.nan),
+            "IMETRIC": np.full(n_profiles, np.nan),
+            "PCM_LABELS": np.full(n_profiles, np.nan),
+        }
+        for start in range(0, n_profiles, self.chunk_size):
+            chunk = slice(start, min(start + self.chunk_size, n_profiles))
+            if pca_values is None:
+                reduced, valid = self.reduce(
+                    {feature: profiles[feature][chunk] for feature in self.axes},
+                    z_values,
+                )
+            else:
+                reduced = np.asarray(pca_values[chunk])
+                valid = np.all(np.isfinite(reduced), axis=1)
+                reduced = reduced[valid].astype(self.dtype)
+            rows = np.arange(chunk.start, chunk.stop)[valid]
+            out["PCA_VALUES"][rows] = reduced
+            for name, values in self.classify(reduced).items():
+                out[name][rows] = values
+        return out
+
+    def dataset(
+        self,
+        ds: xr.Dataset,
+        dim: str = cst.Z_COORD,
+        pca_values: xr.DataArray = None,
+        names: Sequence[str] = OUTPUT_NAMES,
+    ) -> xr.Dataset:
+        """
+        Run on a dataset, laid out like the pyxpcm outputs.
+
+        Args:
+            ds (xr.Dataset): SALT and THETA, e.g. (Z, YC, XC) for one month.
+            dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+            pca_values (xr.DataArray, optional): PCA_VALUES already found by a
+                model with the same preprocessing. Defaults to None.
+            names (Sequence[str], optional): which outputs to keep.
+                Defaults to all of OUTPUT_NAMES.
+
+        Returns:
+            xr.Dataset: IMETRIC (Imetric, ...), A_B (rank, ...), PCA_VALUES
+                (pca, ...) and PCM_LABELS (...), over the other dimensions of
+                `ds`.
+        """
+        first = ds[next(iter(self.axes))]
+        sampling_dims = [d for d in first.dims if d != dim]
+        shape = [first.sizes[d] for d in sampling_dims]
+        profiles = {
+            feature: ds[feature]
+            .transpose(*sampling_dims, dim)
+            .values.reshape(-1, ds.sizes[dim])
+            for feature in self.axes
+        }
+        if pca_values is not None:
+            pca_values = pca_values.transpose(*sampling_dims, "pca").values.reshape(
+                -1, self.n_pca
+            )
+        out = self.predict(profiles, ds[dim].values, pca_values=pca_values)
+        data_vars = {
+            "IMETRIC": (["Imetric"] + sampling_dims, out["IMETRIC"].reshape(1, *shape)),
+            "A_B": (["rank"] + sampling_dims, out["A_B"].T.reshape(2, *shape)),
+            "PCA_VALUES": (
+                ["pca"] + sampling_dims,
+                out["PCA_VALUES"].T.reshape(self.n_pca, *shape),
+            ),
+            "PCM_LABELS": (sampling_dims, out["PCM_LABELS"].reshape(shape)),
+        }
+        coords = {
+            name: coord for name, coord in ds.coords.items() if dim not in coord.dims
+        }
+        coords.update(
+            {
+                "Imetric": [0],
+                "rank": [0, 1],
+                "pca": np.arange(self.n_pca),
+            }
+        )
+        return xr.Dataset({name: data_vars[name] for name in names}, coords=coords)
+
+
+def same_outputs(
+    out: xr.Dataset, expected: xr.Dataset, atol: float = cst.INFERENCE_ATOL
+) -> bool:
+    """
+    Whether two sets of outputs, laid out as by `Inference.dataset`, agree.
+
+    Args:
+        out (xr.Dataset): PCA_VALUES, IMETRIC, A_B and PCM_LABELS.
+        expected (xr.Dataset): the same, with the dimensions in any order.
+        atol (float, optional): largest difference allowed in the PCA values
+            and i metric. Defaults to cst.INFERENCE_ATOL.
+
+    Returns:
+        bool: True if the PCA values and i metric agree, the two most likely
+            classes (A_B) and the labels are the same, with NaN in the same
+            places.
+    """
+    # the classes are exact, so a profile near a tie in float32 is a mismatch.
+    for name, exact in [
+        ("PCA_VALUES", False),
+        ("IMETRIC", False),
+        ("A_B", True),
+        ("PCM_LABELS", True),
+    ]:
+        try:
+            values = expected[name].transpose(*out[name].dims).values
+        except ValueError:
+            print(name, "has dimensions", expected[name].dims, "in pyxpcm")
+            return False
+        values = values.astype("float64")
+        if exact:
+            same = np.array_equal(out[name].values, values, equal_nan=True)
+        else:
+            same = np.allclose(out[name].values, values, atol=atol, equal_nan=True)
+        if not same:
+            print(
+                name,
+                "differs from pyxpcm by up to",
+                np.nanmax(np.abs(out[name].values - values)),
+            )
+            return False
+    return True
+
+
+def matches_pcm(
+    model: Inference,
+    pcm_object: pyxpcm.pcm,
+    ds: xr.Dataset,
+    dim: str = cst.Z_COORD,
+    atol: float = cst.INFERENCE_ATOL,
+) -> bool:
+    """
+    Whether the compiled model gives the same answer as pyxpcm on a dataset.
+
+    Args:
+        model (Inference): compiled from `pcm_object`.
+        pcm_object (pyxpcm.pcm): the pcm object which has already been trained.
+        ds (xr.Dataset): SALT and THETA, e.g. one month.
+        dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+        atol (float, optional): largest difference allowed in the PCA values
+            and i metric. Defaults to cst.INFERENCE_ATOL.
+
+    Returns:
+        bool: True if they agree, see `same_outputs`.
+    """
+    ds_pcm = pcm_object.find_i_metric(ds.copy(), inplace=True)
+    ds_pcm = pcm_object.add_pca_to_xarray(
+        ds_pcm, features=cst.FEATURES_D, dim=dim, inplace=True
+    )
+    ds_pcm["PCM_LABELS"] = pcm_object.predict(
+        ds.copy(), features=cst.FEATURES_D, dim=dim
+    )
+    return same_outputs(model.dataset(ds, dim=dim), ds_pcm, atol=atol)
@@ -0,0 +1,105 @@
+"""Compare class labels between two fits.
+
+The class numbers from two Gaussian mixture fits are arbitrary, so before
+comparing their maps the labels of one are matched to the other with the
+Hungarian algorithm on their confusion matrix, or, for fits that share
+their preprocessing, on the distances between their class means.
+
+Example:
+    Usage::
+        import src.models.labels as lab
+        mapping = lab.match_labels(ref_labels, new_labels, k_clusters)
+        lab.agreement(ref_labels, lab.relabel(new_labels, mapping))
+"""
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+def confusion(reference: np.ndarray, labels: np.ndarray, k_clusters: int) -> np.ndarray:
+    """Counts of each (reference, label) pair, ignoring NaN.
+
+    Args:
+        reference (np.ndarray): reference labels.
+        labels (np.ndarray): labels to compare, the same shape.
+        k_clusters (int): number of classes.
+
+    Returns:
+        np.ndarray: (k_clusters, k_clusters) counts, rows are reference.
+    """
+    valid = np.isfinite(reference) & np.isfinite(labels)
+    return np.bincount(
+        reference[valid].astype("int64") * k_clusters + labels[valid].astype("int64"),
+        minlength=k_clusters * k_clusters,
+    ).reshape(k_clusters, k_clusters)
+
+
+def match_labels(
+    reference: np.ndarray, labels: np.ndarray, k_clusters: int
+) -> np.ndarray:
+    """Relabelling of `labels` that best agrees with `reference`.
+
+    Args:
+        reference (np.ndarray): reference labels.
+        labels (np.ndarray): labels to relabel, the same shape.
+        k_clusters (int): number of classes.
+
+    Returns:
+        np.ndarray: mapping, so that `mapping[labels]` uses the reference's
+            class numbers.
+    """
+    counts = confusion(reference, labels, k_clusters)
+    ref_i, label_i = linear_sum_assignment(counts, maximize=True)
+    mapping = np.empty(k_clusters, dtype="int64")
+    mapping[label_i] = ref_i
+    return mapping
+
+
+def match_means(reference: np.ndarray, means: np.ndarray) -> np.ndarray:
+    """Relabelling of a fit whose class means are closest to the reference's.
+
+    Both sets of means must be in the same feature space, e.g. the reduced
+    features of two classifiers fitted on the same preprocessed matrix.
+
+    Args:
+        reference (np.ndarray): (k_clusters, features) reference class means.
+        means (np.ndarray): (k_clusters, features) class means to relabel.
+
+    Returns:
+        np.ndarray: mapping, so that `mapping[labels]` uses the reference's
+            class numbers.
+    """
+    distances = np.sum(np.square(reference[:, None, :] - means[None, :, :]), axis=-1)
+    ref_i, label_i = linear_sum_assignment(distances)
+    mapping = np.empty(len(means), dtype="int64")
+    mapping[label_i] = ref_i
+    return mapping
+
+
+def relabel(labels: np.ndarray, mapping: np.ndarray) -> np.ndarray:
+    """Apply a mapping from `match_labels`, keeping NaN as NaN.
+
+    Args:
+        labels (np.ndarray): labels.
+        mapping (np.ndarray): from `match_labels`.
+
+    Returns:
+        np.ndarray: relabelled (float, NaN where labels is NaN).
+    """
+    out = np.full(np.shape(labels), np.nan)
+    valid = np.isfinite(labels)
+    out[valid] = mapping[np.asarray(labels)[valid].astype("int64")]
+    return out
+
+
+def agreement(reference: np.ndarray, labels: np.ndarray) -> float:
+    """Fraction of the points defined in both where the labels are the same.
+
+    Args:
+        reference (np.ndarray): reference labels.
+        labels (np.ndarray): labels, already matched to the reference.
+
+    Returns:
+        float: between 0 and 1.
+    """
+    valid = np.isfinite(reference) & np.isfinite(labels)
+    return float(np.mean(reference[valid] == labels[valid]))
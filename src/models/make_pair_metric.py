@@ -1,12 +1,21 @@
 """To pair i metric."""
+import os
 from typing import Tuple, Sequence
 import numpy as np
 import xarray as xr
 import src.data_loading.xr_loader as xvl
+import src.data_loading.store as sto
+import src.data_loading.encoding as enc
 import src.constants as cst
+import src.time_wrapper as twr
 
 xr.set_options(keep_attrs=True)
 
+# rough peak bytes per grid cell per month in compact_pair_i_metric: the
+# float64 A_B (2 ranks) and its sorted copy, the float64 i metric, the int64
+# pair ids, the boolean masks and the int8/float32 outputs.
+_BYTES_PER_CELL: int = 96
+
 
 def make_all_pair_i_metric(
     cart_prod: list, i_metric: np.ndarray, sorted_version: np.ndarray, threshold: float
@@ -79,30 +88,130 @@ def make_one_pair_i_metric(
     return [pair, pair_i_npa, at_least_one_point]
 
 
-def pair_i_metric(ds: xr.Dataset, threshold: float = 0.05) -> xr.DataArray:
+def encode_pair_ids(sorted_version: np.ndarray, cart_prod: list) -> np.ndarray:
     """
-    Pair i metric.
+    Encode each cell's sorted (A, B) class pair as a single integer.
 
-    # new loading order (to be changed)
-    ds.A_B.values.shape (2, 12, 60, 240)
-    sorted_version.shape (2, 12, 60, 240)
-    i_metric (12, 60, 240)
-    list_no [0, 1, 2, 3, 4]
-    https://numpy.org/doc/stable/reference/generated/numpy.swapaxes.html
-    https://numpy.org/doc/stable/reference/generated/numpy.moveaxis.html
-    "time"].values.shape[0]),
-    ("rank", dataarray.coords["rank"].values.shape[0]),
-    ("x", dataarray.coords["XC"].values.shape[0]),
-    ("y", dataarray.coords["YC"]
+    Args:
+        sorted_version (np.ndarray): sorted class ranks (time, rank, YC, XC).
+        cart_prod (list): cartesian product of the class pairs, the pair id
+            is the position of the pair in this list.
+
+    Returns:
+        np.ndarray: pair ids (time, YC, XC), -1 where the cell matches no pair
+            (land, or A == B).
+    """
+    n_classes = int(max([max(pair) for pair in cart_prod], default=0)) + 1
+    lookup = np.full([n_classes, n_classes], -1, dtype="int64")
+    for pair_id, pair in enumerate(cart_prod):
+        lookup[pair[0], pair[1]] = pair_id
+
+    rank_a = sorted_version[:, 0, :, :]
+    rank_b = sorted_version[:, 1, :, :]
+    valid = (
+        np.isfinite(rank_a)
+        & np.isfinite(rank_b)
+        & (rank_a >= 0)
+        & (rank_b >= 0)
+        & (rank_a < n_classes)
+        & (rank_b < n_classes)
+    )
+    pair_ids = np.full(rank_a.shape, -1, dtype="int64")
+    pair_ids[valid] = lookup[
+        rank_a[valid].astype("int64"), rank_b[valid].astype("int64")
+    ]
+    return pair_ids
+
+
+def make_pair_ids(
+    cart_prod: list,
+    i_metric: np.ndarray,
+    sorted_version: np.ndarray,
+    threshold: float,
+    drop_empty: bool = True,
+) -> Tuple[np.ndarray, list]:
+    """
+    Make the label-coded pair i metric in a single pass over the grid.
+
+    Each cell's (A, B) pair is encoded once with `encode_pair_ids`, then
+    the cells below the threshold are dropped and the pairs which never
+    appear are removed from the numbering.
 
     Args:
-        ds (xr.Dataset): dataset.
-        threshold (float, optional): threshold to nan out below. Defaults to 0.05.
+        cart_prod (list): cartesian product of the class pairs.
+        i_metric (np.ndarray): i metric (time, YC, XC).
+        sorted_version (np.ndarray): sorted class ranks (time, rank, YC, XC).
+        threshold (float): threshold to nan things out below.
+        drop_empty (bool, optional): remove the pairs with no points. Keeping
+            them gives the same numbering for every block of time.
+            Defaults to True.
 
     Returns:
-        xr.DataArray: pair i metric dataset.
+        Tuple[np.ndarray, list]: pair_ids (time, YC, XC) indexing into
+            pair_list, with -1 where there is no front, and pair_list.
+    """
+    pair_ids = encode_pair_ids(sorted_version, cart_prod)
+    keep = (pair_ids >= 0) & (i_metric >= threshold)
+    present = np.bincount(pair_ids[keep], minlength=len(cart_prod)) > 0
+    if not drop_empty:
+        present[:] = True
+    # renumber so that the empty pairs do not take up a layer.
+    new_ids = np.cumsum(present) - 1
+    pair_list = [pair for pair, found in zip(cart_prod, present) if found]
+    pair_ids[keep] = new_ids[pair_ids[keep]]
+    pair_ids[~keep] = -1
+    print("pair_list", pair_list)
+
+    return pair_ids, pair_list
+
+
+def make_all_pair_i_metric_vec(
+    cart_prod: list, i_metric: np.ndarray, sorted_version: np.ndarray, threshold: float
+) -> Tuple[np.ndarray, list]:
+    """
+    Make all pair i metric in a single pass over the grid.
+
+    The i metric values above the threshold are scattered into all of the
+    pair layers together using the ids from `make_pair_ids`. This gives
+    the same values as `make_all_pair_i_metric`, but the cost no longer
+    grows with the number of pairs.
+
+    Args:
+        cart_prod (list): cartesian product of the class pairs.
+        i_metric (np.ndarray): i metric (time, YC, XC).
+        sorted_version (np.ndarray): sorted class ranks (time, rank, YC, XC).
+        threshold (float): threshold to nan things out below.
+
+    Returns:
+        Tuple[np.ndarray, list]: pair_i_metric_array (pair, time, YC, XC),
+            pair_list. Pairs with no points above the threshold are dropped.
+    """
+    pair_ids, pair_list = make_pair_ids(cart_prod, i_metric, sorted_version, threshold)
+    time_i, y_i, x_i = np.nonzero(pair_ids >= 0)
+    # float64 as in make_one_pair_i_metric.
+    pair_i_metric_array = np.full([len(pair_list)] + list(i_metric.shape), np.nan)
+    pair_i_metric_array[pair_ids[time_i, y_i, x_i], time_i, y_i, x_i] = i_metric[
+        time_i, y_i, x_i
+    ]
+
+    return pair_i_metric_array, pair_list
+
+
+def _sorted_inputs(
+    ds: xr.Dataset, k_clusters: int = None
+) -> Tuple[np.ndarray, np.ndarray, list]:
     """
+    Get the sorted class ranks, the i metric and the pairs from the dataset.
 
+    Args:
+        ds (xr.Dataset): dataset with `A_B` and `IMETRIC`.
+        k_clusters (int, optional): number of classes. Defaults to None, which
+            takes it from the largest class present in `ds`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, list]: sorted_version (time, rank, YC, XC),
+            i_metric (time, YC, XC), cart_prod.
+    """
     a_b_values = xvl.order_indexes(
         ds.A_B, [cst.T_COORD, "rank", cst.Y_COORD, cst.X_COORD]
     )
@@ -113,7 +222,9 @@ def pair_i_metric(ds: xr.Dataset, threshold: float = 0.05) -> xr.DataArray:
     print("i_metric", i_metric.shape)
     # i_metric (60, 588, 2160)
     # pylint: disable=unnecessary-comprehension
-    list_no = [i for i in range(int(np.nanmax(sorted_version)) + 1)]
+    if k_clusters is None:
+        k_clusters = int(np.nanmax(sorted_version)) + 1
+    list_no = [i for i in range(k_clusters)]
     print("list_no", list_no)
 
     cart_prod = [
@@ -121,28 +232,78 @@ def pair_i_metric(ds: xr.Dataset, threshold: float = 0.05) -> xr.DataArray:
     ]
     print("cart_prod", cart_prod)
 
-    pair_i_metric_list, pair_list = make_all_pair_i_metric(
-        cart_prod, i_metric, sorted_version, threshold
-    )
-    print("pair_i_metric_list", pair_i_metric_list)
-    print("pair_i_metric_list len", len(pair_i_metric_list))
-    print("pair_list", pair_list)
-    print("pair_list len", len(pair_list))
-    shape = np.shape(sorted_version)
-    # shape (60, 2, 588, 2160)
-    pair_i_metric_array = np.zeros(
-        [len(pair_i_metric_list), shape[0], shape[2], shape[3]]
-    )
+    return sorted_version, i_metric, cart_prod
+
+
+def _pair_names(pair_list: list) -> list:
+    """
+    Pair names, one indexed, e.g. "1 to 2".
+
+    Args:
+        pair_list (list): list of (A, B) pairs.
+
+    Returns:
+        list: list of strings.
+    """
+    return [str(pair[0] + 1) + " to " + str(pair[1] + 1) for pair in pair_list]
+
+
+def pair_i_metric(
+    ds: xr.Dataset,
+    threshold: float = cst.I_METRIC_THRESHOLD,
+    vectorized: bool = True,
+) -> xr.DataArray:
+    """
+    Pair i metric.
+
+    # new loading order (to be changed)
+    ds.A_B.values.shape (2, 12, 60, 240)
+    sorted_version.shape (2, 12, 60, 240)
+    i_metric (12, 60, 240)
+    list_no [0, 1, 2, 3, 4]
+    https://numpy.org/doc/stable/reference/generated/numpy.swapaxes.html
+    https://numpy.org/doc/stable/reference/generated/numpy.moveaxis.html
+    "time"].values.shape[0]),
+    ("rank", dataarray.coords["rank"].values.shape[0]),
+    ("x", dataarray.coords["XC"].values.shape[0]),
+    ("y", dataarray.coords["YC"]
 
-    for i in range(len(pair_i_metric_list)):
-        pair_i_metric_array[i, :, :, :] = pair_i_metric_list[i][:, :, :]
+    Args:
+        ds (xr.Dataset): dataset.
+        threshold (float, optional): threshold to nan out below.
+            Defaults to cst.I_METRIC_THRESHOLD.
+        vectorized (bool, optional): use the whole-array numpy engine rather
+            than the per-pixel loop. Defaults to True.
+
+    Returns:
+        xr.DataArray: pair i metric dataset.
+    """
 
-    pair_str_list = []
+    sorted_version, i_metric, cart_prod = _sorted_inputs(ds)
 
-    for i in range(len(pair_list)):
-        pair_str_list.append(
-            str(pair_list[i][0] + 1) + " to " + str(pair_list[i][1] + 1)
+    if vectorized:
+        pair_i_metric_array, pair_list = make_all_pair_i_metric_vec(
+            cart_prod, i_metric, sorted_version, threshold
         )
+        print("pair_list len", len(pair_list))
+    else:
+        pair_i_metric_list, pair_list = make_all_pair_i_metric(
+            cart_prod, i_metric, sorted_version, threshold
+        )
+        print("pair_i_metric_list", pair_i_metric_list)
+        print("pair_i_metric_list len", len(pair_i_metric_list))
+        print("pair_list", pair_list)
+        print("pair_list len", len(pair_list))
+        shape = np.shape(sorted_version)
+        # shape (60, 2, 588, 2160)
+        pair_i_metric_array = np.zeros(
+            [len(pair_i_metric_list), shape[0], shape[2], shape[3]]
+        )
+
+        for i in range(len(pair_i_metric_list)):
+            pair_i_metric_array[i, :, :, :] = pair_i_metric_list[i][:, :, :]
+
+    pair_str_list = _pair_names(pair_list)
 
     da = xr.DataArray(
         pair_i_metric_array,
@@ -156,3 +317,429 @@ def pair_i_metric(ds: xr.Dataset, threshold: float = 0.05) -> xr.DataArray:
     )
 
     return da
+
+
+class PairIMetric:
+    """
+    Label-coded pair i metric.
+
+    At most one pair is defined at each cell, so rather than a dense
+    (pair, time, YC, XC) array this stores an int8 pair id layer and a
+    float32 value layer, each (time, YC, XC). The dense per-pair arrays are
+    only made when a pair is selected with `isel(pair=...)`, so this can be
+    passed to the plotting functions in place of the `xr.DataArray` from
+    `pair_i_metric`.
+
+    Example:
+        Usage::
+            da = compact_pair_i_metric(ds, threshold=cst.I_METRIC_THRESHOLD)
+            da.to_netcdf("pair.nc")
+            da = PairIMetric.open("pair.nc")
+            da.isel(time=0).isel(pair=1).plot()
+    """
+
+    def __init__(self, ds: xr.Dataset) -> None:
+        """
+        Wrap the compact dataset.
+
+        Args:
+            ds (xr.Dataset): dataset with `cst.PAIR_ID_NAME`, `cst.PAIR_VALUE_NAME`
+                and a `cst.P_COORD` coordinate with the pair names.
+        """
+        self.ds = ds
+
+    def __repr__(self) -> str:
+        return "<PairIMetric>\n" + repr(self.ds)
+
+    @property
+    def coords(self) -> xr.core.coordinates.DatasetCoordinates:
+        """Coordinates, including the pair names."""
+        return self.ds.coords
+
+    @property
+    def sizes(self) -> dict:
+        """Sizes of each dimension, including pair."""
+        return dict(self.ds.sizes)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the compact layers."""
+        return self.ds.nbytes
+
+    def isel(self, indexers: dict = None, **indexers_kwargs):
+        """
+        Index like `xr.DataArray.isel`.
+
+        Args:
+            indexers (dict, optional): dimension to index. Defaults to None.
+
+        Returns:
+            Union[PairIMetric, xr.DataArray]: a dense `xr.DataArray` if the pair
+                dimension was indexed, otherwise a smaller `PairIMetric`.
+        """
+        indexers = dict(indexers or {}, **indexers_kwargs)
+        pair_index = indexers.pop(cst.P_COORD, None)
+        compact = PairIMetric(self.ds.isel(indexers))
+        if pair_index is None:
+            return compact
+        return compact.dense(pair_index)
+
+    def dense(self, pair_index=slice(None)) -> xr.DataArray:
+        """
+        Make the dense array for the chosen pairs.
+
+        Args:
+            pair_index (Union[int, slice, list], optional): pair positions.
+                Defaults to all of them.
+
+        Returns:
+            xr.DataArray: (time, YC, XC) for an integer, otherwise
+                (pair, time, YC, XC), NaN where the pair is not present.
+        """
+        pair_ids = self.ds[cst.PAIR_ID_NAME]
+        values = self.ds[cst.PAIR_VALUE_NAME]
+        positions = np.arange(self.ds.sizes[cst.P_COORD])[pair_index]
+
+        def one_pair(position: int) -> xr.DataArray:
+            da = values.where(pair_ids == position)
+            return da.assign_coords(
+                {cst.P_COORD: self.ds.coords[cst.P_COORD].values[position]}
+            )
+
+        if np.ndim(positions) == 0:
+            da = one_pair(int(positions))
+        else:
+            da = xr.concat([one_pair(int(i)) for i in positions], dim=cst.P_COORD)
+        da.name = None
+        da.attrs = {}
+        return da
+
+    def to_dataarray(self) -> xr.DataArray:
+        """
+        Make the dense array for all pairs, as `pair_i_metric` would.
+
+        Returns:
+            xr.DataArray: (pair, time, YC, XC).
+        """
+        return self.dense().transpose(
+            cst.P_COORD, cst.T_COORD, cst.Y_COORD, cst.X_COORD
+        )
+
+    @classmethod
+    def from_dataarray(cls, da: xr.DataArray, dtype: str = "float32") -> "PairIMetric":
+        """
+        Compact a dense pair i metric, e.g. from an old `pair.nc` file.
+
+        Args:
+            da (xr.DataArray): dense (pair, time, YC, XC) pair i metric.
+            dtype (str, optional): dtype for the values. Defaults to "float32".
+
+        Returns:
+            PairIMetric: the compact version.
+        """
+        found = da.notnull()
+        pair_ids = xr.where(found.any(cst.P_COORD), found.argmax(cst.P_COORD), -1)
+        return cls(
+            _compact_dataset(
+                pair_ids.transpose(cst.T_COORD, cst.Y_COORD, cst.X_COORD).values,
+                da.max(cst.P_COORD)
+                .transpose(cst.T_COORD, cst.Y_COORD, cst.X_COORD)
+                .values,
+                list(da.coords[cst.P_COORD].values),
+                da,
+                dtype,
+            )
+        )
+
+    def to_netcdf(self, path: str, **kwargs) -> None:
+        """
+        Save as NetCDF4, with the encoding policy from `enc.to_netcdf`.
+
+        Args:
+            path (str): file name.
+        """
+        enc.to_netcdf(self.ds, path, **kwargs)
+
+    def to_zarr(self, path: str, **kwargs) -> None:
+        """
+        Save as a zarr store (needs zarr installed).
+
+        Args:
+            path (str): store name.
+        """
+        self.ds.to_zarr(path, **kwargs)
+
+    @classmethod
+    def open(cls, path: str, **kwargs) -> "PairIMetric":
+        """
+        Open a saved pair i metric.
+
+        Paths ending in ".zarr" are opened with zarr, anything else as
+        NetCDF. Old files with the dense pair i metric are compacted.
+
+        Args:
+            path (str): file or store name.
+
+        Returns:
+            PairIMetric: the pair i metric.
+        """
+        if str(path).rstrip("/").endswith(".zarr"):
+            ds = xr.open_zarr(path, **kwargs)
+        else:
+            ds = xr.open_dataset(path, **kwargs)
+        if cst.PAIR_ID_NAME not in ds:
+            return cls.from_dataarray(ds.to_array().isel(variable=0, drop=True))
+        return cls(ds)
+
+
+def _compact_dataset(
+    pair_ids: np.ndarray,
+    values: np.ndarray,
+    pair_str_list: list,
+    format_obj: xr.Dataset,
+    dtype: str,
+) -> xr.Dataset:
+    """
+    Make the compact dataset behind `PairIMetric`.
+
+    Args:
+        pair_ids (np.ndarray): pair ids (time, YC, XC), -1 for no pair.
+        values (np.ndarray): i metric (time, YC, XC).
+        pair_str_list (list): pair names.
+        format_obj (xr.Dataset): object to take the coordinates from.
+        dtype (str): dtype for the values.
+
+    Returns:
+        xr.Dataset: compact dataset.
+    """
+    id_dtype = "int8" if len(pair_str_list) <= np.iinfo("int8").max else "int16"
+    dims = [cst.T_COORD, cst.Y_COORD, cst.X_COORD]
+    pair_ids = pair_ids.astype(id_dtype)
+    return xr.Dataset(
+        {
+            cst.PAIR_ID_NAME: (
+                dims,
+                pair_ids,
+                {
+                    "long_name": "Pair index",
+                    "units": "",
+                    "comment": "-1 where there is no pair",
+                },
+            ),
+            cst.PAIR_VALUE_NAME: (
+                dims,
+                np.where(pair_ids >= 0, values, np.nan).astype(dtype),
+                {"long_name": "Pair I-metric", "units": ""},
+            ),
+        },
+        coords={
+            cst.X_COORD: format_obj.coords[cst.X_COORD].values,
+            cst.Y_COORD: format_obj.coords[cst.Y_COORD].values,
+            cst.T_COORD: format_obj.coords[cst.T_COORD].values,
+            cst.P_COORD: pair_str_list,
+        },
+    )
+
+
+def compact_pair_i_metric(
+    ds: xr.Dataset,
+    threshold: float = cst.I_METRIC_THRESHOLD,
+    dtype: str = "float32",
+    k_clusters: int = None,
+) -> PairIMetric:
+    """
+    Pair i metric in the label-coded format.
+
+    Args:
+        ds (xr.Dataset): dataset with `A_B` and `IMETRIC`.
+        threshold (float, optional): threshold to nan out below.
+            Defaults to cst.I_METRIC_THRESHOLD.
+        dtype (str, optional): dtype for the values. Defaults to "float32".
+        k_clusters (int, optional): number of classes. If it is given all of the
+            pairs are kept, even if they have no points. Defaults to None.
+
+    Returns:
+        PairIMetric: pair i metric.
+    """
+    sorted_version, i_metric, cart_prod = _sorted_inputs(ds, k_clusters=k_clusters)
+    pair_ids, pair_list = make_pair_ids(
+        cart_prod,
+        i_metric,
+        sorted_version,
+        threshold,
+        drop_empty=k_clusters is None,
+    )
+    return PairIMetric(
+        _compact_dataset(pair_ids, i_metric, _pair_names(pair_list), ds, dtype)
+    )
+
+
+def time_block_size(
+    cells_per_month: int, memory_budget: float = cst.MEMORY_BUDGET
+) -> int:
+    """
+    Number of months to process at once within a memory budget.
+
+    Args:
+        cells_per_month (int): YC * XC.
+        memory_budget (float, optional): bytes. Defaults to cst.MEMORY_BUDGET.
+
+    Returns:
+        int: months per block, at least 1.
+    """
+    return max(1, int(memory_budget // (_BYTES_PER_CELL * cells_per_month)))
+
+
+@twr.timeit
+def chunked_pair_i_metric(
+    link_to_netcdf: str,
+    out_path: str,
+    k_clusters: int,
+    threshold: float = cst.I_METRIC_THRESHOLD,
+    memory_budget: float = cst.MEMORY_BUDGET,
+    dtype: str = "float32",
+    months: int = None,
+) -> PairIMetric:
+    """
+    Pair i metric streamed through a file a block of months at a time.
+
+    `A_B` and `IMETRIC` are read lazily from the merged i metric file in
+    blocks of time sized by `time_block_size`, and each block of the
+    compact pair i metric is written to `out_path` before the next one is
+    read, so peak memory is set by `memory_budget` rather than by the
+    length of the record. All the pairs for `k_clusters` are kept so that
+    the pair ids mean the same thing in every block.
+
+    Args:
+        link_to_netcdf (str): merged i metric file, e.g. `io.return_name(5, 3)`
+            + ".nc".
+        out_path (str): NetCDF4 file to write to, replaced if it exists.
+        k_clusters (int): number of classes in the model.
+        threshold (float, optional): threshold to nan out below.
+            Defaults to cst.I_METRIC_THRESHOLD.
+        memory_budget (float, optional): bytes. Defaults to cst.MEMORY_BUDGET.
+        dtype (str, optional): dtype for the values. Defaults to "float32".
+        months (int, optional): only do the first few months. Defaults to None.
+
+    Returns:
+        PairIMetric: the lazily opened output.
+    """
+    if os.path.isfile(out_path):
+        os.remove(out_path)
+
+    with xr.open_dataset(link_to_netcdf) as ds:
+        ds = ds[["A_B", "IMETRIC"]]
+        if months is not None:
+            ds = ds.isel({cst.T_COORD: slice(0, months)})
+        block = time_block_size(
+            ds.sizes[cst.Y_COORD] * ds.sizes[cst.X_COORD], memory_budget
+        )
+        print("months per block", block)
+        for start in range(0, ds.sizes[cst.T_COORD], block):
+            compact = compact_pair_i_metric(
+                ds.isel({cst.T_COORD: slice(start, start + block)}),
+                threshold=threshold,
+                dtype=dtype,
+                k_clusters=k_clusters,
+            )
+            sto.write_time_block(compact.ds, out_path, start=start)
+            del compact
+
+    return PairIMetric.open(out_path)
+
+
+@twr.timeit
+def pair_i_metric_sweep(
+    ds: xr.Dataset,
+    thresholds: Sequence[float],
+    summary: bool = False,
+    area: xr.DataArray = None,
+    k_clusters: int = None,
+) -> xr.DataArray:
+    """
+    Pair i metric for several thresholds from one sort and encode.
+
+    `A_B` is sorted and encoded into pair ids once, at the lowest threshold.
+    Every higher threshold only removes cells from that, so each extra
+    threshold is just a comparison against the values already found.
+
+    Example:
+        Usage::
+            area_da = pair_i_metric_sweep(
+                ds, np.linspace(0.01, 0.2, 20), summary=True, area=rA
+            )
+
+    Args:
+        ds (xr.Dataset): dataset with `A_B` and `IMETRIC`.
+        thresholds (Sequence[float]): thresholds to nan out below, at least
+            one.
+        summary (bool, optional): return the front area of each pair rather
+            than the maps. Defaults to False.
+        area (xr.DataArray, optional): area of each cell (YC, XC), e.g. `rA`
+            from BSOSE. Defaults to None, which counts cells instead.
+        k_clusters (int, optional): number of classes, if given all of the pairs
+            are kept. Defaults to None.
+
+    Returns:
+        xr.DataArray: (threshold, pair, time, YC, XC) pair i metric or, if
+            summary, (threshold, pair, time) front area.
+    """
+    if len(thresholds) == 0:
+        raise ValueError("thresholds must not be empty")
+    thresholds = np.sort(np.asarray(thresholds, dtype="float64"))
+    sorted_version, i_metric, cart_prod = _sorted_inputs(ds, k_clusters=k_clusters)
+    pair_ids, pair_list = make_pair_ids(
+        cart_prod,
+        i_metric,
+        sorted_version,
+        thresholds[0],
+        drop_empty=k_clusters is None,
+    )
+    pair_str_list = _pair_names(pair_list)
+    threshold_coord = (cst.THRESHOLD_COORD, thresholds)
+
+    if not summary:
+        compact = PairIMetric(
+            _compact_dataset(pair_ids, i_metric, pair_str_list, ds, i_metric.dtype)
+        )
+        dense = compact.to_dataarray()
+        thresholds_da = xr.DataArray(thresholds, coords=[threshold_coord])
+        return dense.where(dense >= thresholds_da).transpose(
+            cst.THRESHOLD_COORD, cst.P_COORD, cst.T_COORD, cst.Y_COORD, cst.X_COORD
+        )
+
+    # only the cells which pass the lowest threshold are ever needed.
+    time_i, y_i, x_i = np.nonzero(pair_ids >= 0)
+    values = i_metric[time_i, y_i, x_i]
+    n_time = i_metric.shape[0]
+    group = pair_ids[time_i, y_i, x_i] * n_time + time_i
+    if area is None:
+        weights = np.ones(values.shape)
+        units = "cells"
+    else:
+        area_values = xvl.order_indexes(area, [cst.Y_COORD, cst.X_COORD])
+        weights = area_values[y_i, x_i]
+        units = area.attrs.get("units", "")
+
+    # bin each cell by the highest threshold it passes, then a cell counts
+    # towards that threshold and all of the ones below it.
+    n_groups = len(pair_list) * n_time
+    highest = np.searchsorted(thresholds, values, side="right") - 1
+    binned = np.bincount(
+        highest * n_groups + group,
+        weights=weights,
+        minlength=len(thresholds) * n_groups,
+    ).reshape([len(thresholds), n_groups])
+    front_area = np.cumsum(binned[::-1], axis=0)[::-1]
+
+    return xr.DataArray(
+        front_area.reshape([len(thresholds), len(pair_list), n_time]),
+        dims=[cst.THRESHOLD_COORD, cst.P_COORD, cst.T_COORD],
+        coords={
+            cst.THRESHOLD_COORD: thresholds,
+            cst.P_COORD: pair_str_list,
+            cst.T_COORD: ds.coords[cst.T_COORD].values,
+        },
+        name="FRONT_AREA",
+        attrs={"long_name": "Front area", "units": units},
+    )
@@ -0,0 +1,183 @@
+"""Save and load the fitted state of a pcm object without pickle.
+
+The scalers, reducers, homogeniser and classifier of a trained pcm are
+written to a single `.npz` file as plain arrays, with a json header that
+records the format version, the settings the pcm was made with and the
+class of each estimator. Loading fills these back into an untrained pcm
+made with the same settings, so nothing is unpickled.
+
+Example:
+    Usage::
+        import src.models.pcm_io as pio
+        pio.save_state(pcm_object, "pcm.npz", config)
+        pcm_object = pio.load_state(tim.make_pcm(**config), "pcm.npz")
+"""
+import os
+import json
+import importlib
+from typing import Dict
+import numpy as np
+import pyxpcm
+
+FORMAT_VERSION: int = 1
+# only estimators from these packages are made when loading.
+_TRUSTED_MODULES: tuple = ("sklearn.", "pyxpcm.")
+
+
+def estimator_state(estimator: any) -> Dict[str, np.ndarray]:
+    """The fitted attributes of a scikit-learn style estimator as arrays.
+
+    Args:
+        estimator (any): fitted estimator.
+
+    Returns:
+        Dict[str, np.ndarray]: attribute name to value.
+    """
+    state = {}
+    for key, value in vars(estimator).items():
+        if (key.endswith("_") and not key.startswith("_")) or key == "fitted":
+            array = np.asarray(value)
+            if array.dtype != object:
+                state[key] = array
+    return state
+
+
+def set_estimator_state(estimator: any, state: Dict[str, np.ndarray]) -> any:
+    """Set the fitted attributes saved by `estimator_state` on an estimator.
+
+    Args:
+        estimator (any): estimator made with the same parameters.
+        state (Dict[str, np.ndarray]): attribute name to value.
+
+    Returns:
+        any: the fitted estimator.
+    """
+    for key, value in state.items():
+        setattr(estimator, key, value.item() if value.ndim == 0 else value)
+    return estimator
+
+
+def _class_name(obj: any) -> str:
+    return type(obj).__module__ + "." + type(obj).__qualname__
+
+
+def _make_estimator(class_name: str) -> any:
+    """Make an estimator from its class name, only from trusted packages."""
+    if not class_name.startswith(_TRUSTED_MODULES):
+        raise ValueError("Will not make an estimator of class " + class_name)
+    module_name, _, name = class_name.rpartition(".")
+    return getattr(importlib.import_module(module_name), name)()
+
+
+def _estimators(pcm_object: pyxpcm.pcm) -> Dict[str, any]:
+    """Every estimator in a pcm object, by the name it is saved under."""
+    # pylint: disable=protected-access
+    estimators = {"classifier": pcm_object._classifier}
+    for group, group_d in [
+        ("scaler", pcm_object._scaler),
+        ("reducer", pcm_object._reducer),
+    ]:
+        for feature, estimator in group_d.items():
+            estimators[group + "/" + feature] = estimator
+    return estimators
+
+
+def save_state(pcm_object: pyxpcm.pcm, path: str, config: dict) -> None:
+    """Save the fitted state of a pcm object.
+
+    Args:
+        pcm_object (pyxpcm.pcm): the pcm object which has already been trained.
+        path (str): `.npz` file name.
+        config (dict): json serialisable settings to make the pcm object with
+            again (e.g. the arguments of `tim.make_pcm`).
+    """
+    # pylint: disable=protected-access
+    arrays = {}
+    classes = {}
+    for name, estimator in _estimators(pcm_object).items():
+        classes[name] = _class_name(estimator)
+        for key, value in estimator_state(estimator).items():
+            arrays[name + "/" + key] = value
+    for feature, stats in pcm_object._homogeniser.items():
+        for key, value in stats.items():
+            arrays["homogeniser/" + feature + "/" + key] = np.asarray(value)
+    header = {
+        "version": FORMAT_VERSION,
+        "config": config,
+        "classes": classes,
+        "llh": float(pcm_object._props["llh"]),
+        "xlabel": list(getattr(pcm_object, "_xlabel", [])),
+        "scaler_props": pcm_object._scaler_props,
+    }
+    arrays["header"] = np.array(json.dumps(header))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as npz_file:
+        np.savez(npz_file, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_header(path: str) -> dict:
+    """Read the json header of a saved pcm object.
+
+    Args:
+        path (str): `.npz` file name.
+
+    Returns:
+        dict: version, config, classes, llh, xlabel and scaler_props.
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        return json.loads(str(npz["header"]))
+
+
+def load_state(pcm_object: pyxpcm.pcm, path: str) -> pyxpcm.pcm:
+    """Fill a saved fitted state into an untrained pcm object.
+
+    Args:
+        pcm_object (pyxpcm.pcm): untrained pcm object, made with the same
+            settings as the one that was saved.
+        path (str): `.npz` file name.
+
+    Returns:
+        pyxpcm.pcm: the trained pcm object.
+    """
+    # pylint: disable=protected-access
+    with np.load(path, allow_pickle=False) as npz:
+        header = json.loads(str(npz["header"]))
+        if header["version"] > FORMAT_VERSION:
+            raise ValueError(
+                path + " is format version " + str(header["version"]) + ", "
+                "which is newer than this code can read."
+            )
+        states = {}
+        for key in npz.files:
+            if key == "header":
+                continue
+            name, _, attr = key.rpartition("/")
+            states.setdefault(name, {})[attr] = npz[key]
+
+    estimators = _estimators(pcm_object)
+    for name, class_name in header["classes"].items():
+        estimator = estimators.get(name)
+        if estimator is None or _class_name(estimator) != class_name:
+            # e.g. a joint reducer that is only made during the fit.
+            estimator = _make_estimator(class_name)
+            group, _, feature = name.partition("/")
+            if group == "classifier":
+                pcm_object._classifier = estimator
+            else:
+                getattr(pcm_object, "_" + group)[feature] = estimator
+        set_estimator_state(estimator, states.get(name, {}))
+
+    for name, state in states.items():
+        if name.startswith("homogeniser/"):
+            feature = name.partition("/")[2]
+            pcm_object._homogeniser[feature] = {
+                key: value.item() if value.ndim == 0 else value
+                for key, value in state.items()
+            }
+    pcm_object._props["llh"] = header["llh"]
+    pcm_object._xlabel = header["xlabel"]
+    pcm_object._scaler_props.update(header["scaler_props"])
+    pcm_object.fitted = True
+    return pcm_object
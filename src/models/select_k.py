@@ -0,0 +1,261 @@
+"""Choose the number of classes K from the fit statistics.
+
+`cst.K_LIST` is set by hand. Here a Gaussian mixture is fitted for each K
+in a range on one reduced feature matrix: the interpolation, scaling and
+PCA are fitted once on the training months, and only the mixtures are
+fitted for each K, in parallel. For each K the table has:
+
+- BIC and AIC on the training profiles,
+- the mean log likelihood per profile on the training profiles and on
+  held out months (every `cst.HELD_OUT_EVERY`th month of the year, so
+  that neighbouring profiles from the same month do not leak into it),
+- the fit time, peak memory allocated by the fit (measured on a second,
+  separate fit, as tracing allocations slows the fit down), iterations and
+  whether it converged.
+
+Example:
+    Usage::
+        python3 src/models/select_k.py --workers 8
+"""
+import os
+import time
+import copy
+import argparse
+import tracemalloc
+from typing import Sequence, Tuple
+import numpy as np
+import pandas as pd
+import xarray as xr
+import matplotlib.pyplot as plt
+from sklearn.base import clone
+from sklearn.mixture import GaussianMixture
+import pyxpcm
+import src.constants as cst
+import src.parallel as par
+import src.time_wrapper as twr
+import src.models.train_pyxpcm as tim
+import src.plot.k_selection as pks
+
+def split_months(
+    ds: xr.Dataset, every: int = cst.HELD_OUT_EVERY
+) -> Tuple[xr.Dataset, xr.Dataset]:
+    """Hold out every `every`th month.
+
+    Args:
+        ds (xr.Dataset): training year.
+        every (int, optional): one month in this many is held out.
+            Defaults to cst.HELD_OUT_EVERY.
+
+    Returns:
+        Tuple[xr.Dataset, xr.Dataset]: the months to fit on, the held out months.
+    """
+    held_out = np.arange(ds.sizes[cst.T_COORD]) % every == every - 1
+    return (
+        ds.isel({cst.T_COORD: np.nonzero(~held_out)[0]}),
+        ds.isel({cst.T_COORD: np.nonzero(held_out)[0]}),
+    )
+
+
+def transformed_features(
+    pcm_object: pyxpcm.pcm,
+    ds: xr.Dataset,
+    features: dict = cst.FEATURES_D,
+    dim: str = cst.Z_COORD,
+) -> np.ndarray:
+    """Reduce new profiles with preprocessing already fitted by `tim.reduced_features`.
+
+    Args:
+        pcm_object (pyxpcm.pcm): pcm object with its preprocessing fitted.
+        ds (xr.Dataset): profiles to reduce.
+        features (dict, optional): features mapping. Defaults to cst.FEATURES_D.
+        dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+
+    Returns:
+        np.ndarray: (samples, features) reduced profiles.
+    """
+    # pyxpcm only refits the scaler and reducer until it is marked as fitted,
+    # and a copy leaves `pcm_object` as it was.
+    pcm_copy = copy.deepcopy(pcm_object)
+    pcm_copy.fitted = True
+    x_values, _ = pcm_copy.preprocessing(
+        ds, features=features, dim=dim, action="predict"
+    )
+    return np.asarray(x_values.values)
+
+
+def score_classifier(
+    classifier: GaussianMixture, x_train: np.ndarray = None, x_test: np.ndarray = None
+) -> dict:
+    """Fit a classifier and score it on the training and held out profiles.
+
+    The fit is timed without tracemalloc, which slows down every allocation,
+    and then an unfitted clone is fitted again under tracemalloc for the peak
+    memory, so the table takes about twice the fit time to make.
+
+    Args:
+        classifier (GaussianMixture): unfitted classifier.
+        x_train (np.ndarray, optional): reduced training profiles. Defaults to
+            the worker's.
+        x_test (np.ndarray, optional): reduced held out profiles. Defaults to
+            the worker's.
+
+    Returns:
+        dict: one row of the table of `select_k`.
+    """
+    if x_train is None:
+        x_train, x_test = par.worker_state("x_train"), par.worker_state("x_test")
+    unfitted = clone(classifier)
+    start = time.perf_counter()
+    classifier.fit(x_train)
+    fit_s = time.perf_counter() - start
+    tracemalloc.start()
+    unfitted.fit(x_train)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "k_clusters": classifier.n_components,
+        "bic": classifier.bic(x_train),
+        "aic": classifier.aic(x_train),
+        "train_llh": classifier.score(x_train),
+        "held_out_llh": classifier.score(x_test),
+        "fit_s": fit_s,
+        "fit_peak_mb": peak / 1e6,
+        "n_iter": classifier.n_iter_,
+        "converged": classifier.converged_,
+    }
+
+
+@twr.timeit
+def select_k(
+    pcm_object: pyxpcm.pcm,
+    ds: xr.Dataset,
+    k_list: Sequence[int] = cst.K_SELECTION_LIST,
+    every: int = cst.HELD_OUT_EVERY,
+    features: dict = cst.FEATURES_D,
+    dim: str = cst.Z_COORD,
+    workers: int = cst.N_WORKERS,
+    n_samples: int = cst.N_SAMPLES,
+) -> pd.DataFrame:
+    """Fit and score a Gaussian mixture for each K on one reduced matrix.
+
+    Args:
+        pcm_object (pyxpcm.pcm): untrained pcm object, which sets the
+            preprocessing and the classifier settings.
+        ds (xr.Dataset): training year.
+        k_list (Sequence[int], optional): numbers of clusters.
+            Defaults to cst.K_SELECTION_LIST.
+        every (int, optional): one month in this many is held out.
+            Defaults to cst.HELD_OUT_EVERY.
+        features (dict, optional): features mapping. Defaults to cst.FEATURES_D.
+        dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+        workers (int, optional): processes to fit the classifiers on.
+            Defaults to cst.N_WORKERS.
+        n_samples (int, optional): fit on a stratified subsample of this many
+            of the training profiles, None for every profile.
+            Defaults to cst.N_SAMPLES.
+
+    Returns:
+        pd.DataFrame: a row for each K, see `score_classifier`.
+    """
+    # pylint: disable=protected-access
+    ds_train, ds_test = split_months(ds, every=every)
+    x_train = tim.reduced_features(
+        pcm_object,
+        tim.fitting_data(ds_train, n_samples=n_samples),
+        features=features,
+        dim=dim,
+    )
+    x_test = transformed_features(pcm_object, ds_test, features=features, dim=dim)
+    print("fitting on", x_train.shape, "held out", x_test.shape)
+    # the largest K take longest, so they go first.
+    classifiers = [
+        clone(pcm_object._classifier).set_params(n_components=k_clusters)
+        for k_clusters in sorted(k_list, reverse=True)
+    ]
+    if workers <= 1:
+        rows = [score_classifier(clf, x_train, x_test) for clf in classifiers]
+    else:
+        with par.spawn_pool(
+            min(workers, len(classifiers)),
+            par.set_worker_state,
+            ({"x_train": x_train, "x_test": x_test},),
+        ) as executor:
+            rows = list(executor.map(score_classifier, classifiers))
+    return pd.DataFrame(rows).sort_values("k_clusters").reset_index(drop=True)
+
+
+@twr.timeit
+def run_selection(
+    k_list: Sequence[int] = cst.K_SELECTION_LIST,
+    time_i: int = cst.EXAMPLE_TIME_INDEX,
+    maxvar: int = cst.D_PCS,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    separate_pca: bool = False,
+    interp: bool = True,
+    remake: bool = cst.REMAKE,
+    workers: int = cst.N_WORKERS,
+    n_samples: int = cst.N_SAMPLES,
+) -> pd.DataFrame:
+    """Run `select_k` on the training year, save the table and the plot.
+
+    Args:
+        k_list (Sequence[int], optional): numbers of clusters.
+            Defaults to cst.K_SELECTION_LIST.
+        time_i (int, optional): time index. Defaults to cst.EXAMPLE_TIME_INDEX.
+        maxvar (int, optional): num pca. Defaults to cst.D_PCS.
+        min_depth (float, optional): minimum depth for column.
+            Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): maximum depth for column.
+            Defaults to cst.MAX_DEPTH.
+        separate_pca (bool, optional): separate the pca. Defaults to False.
+        interp (bool, optional): interpolate the training data onto a coarser
+            grid. Defaults to True.
+        remake (bool, optional): remake the training data. Defaults to cst.REMAKE.
+        workers (int, optional): processes to fit the classifiers on.
+            Defaults to cst.N_WORKERS.
+        n_samples (int, optional): fit on a stratified subsample of this many
+            profiles, None for every profile. Defaults to cst.N_SAMPLES.
+
+    Returns:
+        pd.DataFrame: from `select_k`.
+    """
+    ds = tim.interpolated_training_data(
+        time_i=time_i,
+        min_depth=min_depth,
+        max_depth=max_depth,
+        interp=interp,
+        remake=remake,
+    )
+    pcm_object = tim.make_pcm(
+        k_clusters=k_list[0],
+        maxvar=maxvar,
+        min_depth=min_depth,
+        max_depth=max_depth,
+        separate_pca=separate_pca,
+    )
+    selection_df = select_k(
+        pcm_object, ds, k_list=k_list, workers=workers, n_samples=n_samples
+    )
+    print(selection_df.to_string(index=False))
+    selection_df.to_csv(
+        os.path.join(cst.DATA_PATH, "RUN_" + cst.RUN_NAME + "_k_selection.csv"),
+        index=False,
+    )
+    pks.plot_k_selection(selection_df)
+    plt.savefig(
+        os.path.join(cst.FIGURE_PATH, "RUN_" + cst.RUN_NAME + "_k_selection")
+        + cst.FIGURE_TYPE
+    )
+    plt.clf()
+    return selection_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the fit of the pcm for each K."
+    )
+    parser.add_argument("--k", type=int, nargs="+", default=cst.K_SELECTION_LIST)
+    parser.add_argument("--workers", type=int, default=cst.N_WORKERS)
+    args = parser.parse_args()
+    run_selection(k_list=args.k, workers=args.workers)
@@ -0,0 +1,369 @@
+"""Train the pcm on the whole record, a few months at a time.
+
+`train_on_interpolated_year` loads one 12 month window into memory. Here
+the months are visited in turn, so memory is bounded by one month:
+
+1. the per level standard scalers are fitted with `partial_fit`,
+2. the per feature PCAs are fitted as `IncrementalPCA`,
+3. the reduced features are written to a memory mapped file on disk,
+   while the homogeniser means and standard deviations are accumulated,
+4. the Gaussian mixture is fitted with full batch EM, where each step
+   accumulates the sufficient statistics over chunks of that file.
+
+The fitted parts are put into a pcm object made with `separate_pca=True`
+(one scaler and one PCA per feature), so the rest of the pipeline can use
+it as before.
+
+Example:
+    Usage::
+        python3 src/models/stream_train.py
+"""
+import os
+import tempfile
+from typing import Dict, Iterator, Sequence, Tuple
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import linalg
+from sklearn.base import clone
+from sklearn.decomposition import IncrementalPCA
+from sklearn.mixture import GaussianMixture
+from sklearn.preprocessing import StandardScaler
+import pyxpcm
+import src.constants as cst
+import src.time_wrapper as twr
+import src.data_loading.xr_loader as xvl
+import src.models.labels as lab
+import src.models.train_pyxpcm as tim
+import src.preprocessing.regrid as rgd
+
+
+def month_profiles(
+    ds_month: xr.Dataset, features_pcm: Dict[str, np.ndarray], dim: str = cst.Z_COORD
+) -> Dict[str, np.ndarray]:
+    """Profiles on each feature axis, for the columns where all are defined.
+
+    Args:
+        ds_month (xr.Dataset): one month of SALT and THETA.
+        features_pcm (Dict[str, np.ndarray]): feature name to vertical axis.
+        dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+
+    Returns:
+        Dict[str, np.ndarray]: (n_samples, n_levels) for each feature.
+    """
+    profiles = {}
+    for feature, axis in features_pcm.items():
+        da = ds_month[feature].interp({dim: axis})
+        sampling_dims = [d for d in da.dims if d != dim]
+        profiles[feature] = (
+            da.stack(sampling=sampling_dims).transpose("sampling", dim).values
+        )
+    valid = np.all(
+        [np.all(np.isfinite(values), axis=1) for values in profiles.values()], axis=0
+    )
+    return {feature: values[valid] for feature, values in profiles.items()}
+
+
+def _set_gmm_params(
+    classifier: GaussianMixture,
+    weights: np.ndarray,
+    means: np.ndarray,
+    covariances: np.ndarray,
+) -> None:
+    """Set the parameters of a full covariance Gaussian mixture."""
+    precisions_cholesky = np.empty_like(covariances)
+    eye = np.eye(means.shape[1])
+    for k, covariance in enumerate(covariances):
+        cov_chol = linalg.cholesky(covariance, lower=True)
+        precisions_cholesky[k] = linalg.solve_triangular(cov_chol, eye, lower=True).T
+    classifier.weights_ = weights
+    classifier.means_ = means
+    classifier.covariances_ = covariances
+    classifier.precisions_cholesky_ = precisions_cholesky
+    classifier.precisions_ = np.einsum(
+        "kij,klj->kil", precisions_cholesky, precisions_cholesky
+    )
+
+
+@twr.timeit
+def fit_gmm_streaming(
+    classifier: GaussianMixture,
+    x_values: np.ndarray,
+    chunk_rows: int = 1_000_000,
+    max_iter: int = 100,
+    tol: float = 1e-4,
+    init_samples: int = 100_000,
+    seed: int = cst.SEED,
+) -> Tuple[GaussianMixture, float]:
+    """Fit a full covariance Gaussian mixture with EM, a chunk of rows at a time.
+
+    The mixture is started from a fit to a random subsample, and then every
+    EM step goes over all the rows, so the result is the full batch fit
+    while only `chunk_rows` rows are in memory at once.
+
+    Args:
+        classifier (GaussianMixture): unfitted, with covariance_type "full".
+        x_values (np.ndarray): (n_samples, n_features), e.g. a `np.memmap`.
+        chunk_rows (int, optional): rows per chunk. Defaults to 1_000_000.
+        max_iter (int, optional): most EM steps. Defaults to 100.
+        tol (float, optional): stop once the mean log likelihood changes by
+            less than this. Defaults to 1e-4.
+        init_samples (int, optional): rows to start from. Defaults to 100_000.
+        seed (int, optional): Random seed. Defaults to cst.SEED.
+
+    Returns:
+        Tuple[GaussianMixture, float]: fitted classifier, mean log likelihood.
+    """
+    if classifier.covariance_type != "full":
+        raise ValueError("Only full covariance mixtures can be fitted streaming.")
+    n_samples, n_features = x_values.shape
+    rng = np.random.default_rng(seed)
+    init_i = np.sort(
+        rng.choice(n_samples, size=min(n_samples, init_samples), replace=False)
+    )
+    classifier.fit(np.asarray(x_values[init_i]))
+
+    llh = -np.inf
+    for n_iter in range(1, max_iter + 1):
+        resp_sum = np.zeros(classifier.n_components)
+        x_sum = np.zeros((classifier.n_components, n_features))
+        xx_sum = np.zeros((classifier.n_components, n_features, n_features))
+        llh_sum = 0.0
+        for start in range(0, n_samples, chunk_rows):
+            x_chunk = np.asarray(x_values[start : start + chunk_rows], dtype="float64")
+            resp = classifier.predict_proba(x_chunk)
+            llh_sum += classifier.score_samples(x_chunk).sum()
+            resp_sum += resp.sum(axis=0)
+            x_sum += resp.T @ x_chunk
+            xx_sum += np.einsum("nk,ni,nj->kij", resp, x_chunk, x_chunk, optimize=True)
+        resp_sum += 10 * np.finfo(resp_sum.dtype).eps
+        means = x_sum / resp_sum[:, np.newaxis]
+        covariances = (
+            xx_sum / resp_sum[:, np.newaxis, np.newaxis]
+            - np.einsum("ki,kj->kij", means, means)
+            + classifier.reg_covar * np.eye(n_features)
+        )
+        _set_gmm_params(classifier, resp_sum / n_samples, means, covariances)
+        new_llh = llh_sum / n_samples
+        change, llh = new_llh - llh, new_llh
+        print("EM step", n_iter, "mean log likelihood", llh)
+        if abs(change) < tol:
+            break
+    classifier.n_iter_ = n_iter
+    classifier.converged_ = abs(change) < tol
+    classifier.lower_bound_ = llh
+    return classifier, llh
+
+
+def iterate_months(
+    bsose_ds: xr.Dataset, months: Sequence[int], mult_fact: int = 2
+) -> Iterator[xr.Dataset]:
+    """Load the months one at a time, on the same grid as the training year.
+
+    Args:
+        bsose_ds (xr.Dataset): lazily opened SALT and THETA.
+        months (Sequence[int]): time indices.
+        mult_fact (int, optional): resolution of the interpolated grid, as in
+            `tim.interpolated_training_data`. None keeps the BSOSE grid.
+            Defaults to 2.
+
+    Yields:
+        xr.Dataset: one month of SALT and THETA.
+    """
+    if mult_fact is not None:
+        lats_new, lons_new = rgd.coarse_grid(bsose_ds, mult_fact=mult_fact)
+        regridder = rgd.Regridder.from_grids(
+            bsose_ds.YC.values, bsose_ds.XC.values, lats_new, lons_new
+        )
+    for time_i in months:
+        ds_month = bsose_ds.isel({cst.T_COORD: time_i}).load()
+        if mult_fact is not None:
+            ds_month = regridder(ds_month)
+        yield ds_month
+
+
+@twr.timeit
+def stream_fit(
+    pcm_object: pyxpcm.pcm,
+    bsose_ds: xr.Dataset,
+    months: Sequence[int] = range(60),
+    mult_fact: int = 2,
+    chunk_rows: int = 1_000_000,
+    max_iter: int = 100,
+    tol: float = 1e-4,
+) -> pyxpcm.pcm:
+    """Fit a pcm object on many months, holding one month in memory at a time.
+
+    Args:
+        pcm_object (pyxpcm.pcm): untrained pcm object made with
+            `separate_pca=True`.
+        bsose_ds (xr.Dataset): lazily opened SALT and THETA.
+        months (Sequence[int], optional): time indices to train on.
+            Defaults to range(60).
+        mult_fact (int, optional): resolution of the interpolated grid.
+            None keeps the BSOSE grid. Defaults to 2.
+        chunk_rows (int, optional): rows per EM chunk. Defaults to 1_000_000.
+        max_iter (int, optional): most EM steps. Defaults to 100.
+        tol (float, optional): EM tolerance. Defaults to 1e-4.
+
+    Returns:
+        pyxpcm.pcm: the trained pcm object.
+    """
+    # pylint: disable=protected-access
+    features_pcm = pcm_object._props["features"]
+    maxvar = int(pcm_object._props["maxvar"])
+    scalers = {feature: StandardScaler() for feature in features_pcm}
+    reducers = {
+        feature: IncrementalPCA(n_components=maxvar) for feature in features_pcm
+    }
+
+    # pass 1: scalers and sample counts.
+    n_samples = 0
+    for ds_month in iterate_months(bsose_ds, months, mult_fact):
+        for feature, values in month_profiles(ds_month, features_pcm).items():
+            scalers[feature].partial_fit(values)
+        n_samples += len(values)
+    print("training on", n_samples, "profiles from", len(months), "months")
+
+    # pass 2: reducers.
+    for ds_month in iterate_months(bsose_ds, months, mult_fact):
+        for feature, values in month_profiles(ds_month, features_pcm).items():
+            if len(values) >= maxvar:
+                reducers[feature].partial_fit(scalers[feature].transform(values))
+
+    # pass 3: reduced features to disk, and the homogeniser statistics.
+    n_features = maxvar * len(features_pcm)
+    with tempfile.TemporaryDirectory() as direc:
+        x_values = np.memmap(
+            os.path.join(direc, "x.dat"),
+            dtype="float64",
+            mode="w+",
+            shape=(n_samples, n_features),
+        )
+        moments = {feature: np.zeros(3) for feature in features_pcm}
+        start = 0
+        for ds_month in iterate_months(bsose_ds, months, mult_fact):
+            blocks = []
+            for feature, values in month_profiles(ds_month, features_pcm).items():
+                reduced = reducers[feature].transform(
+                    scalers[feature].transform(values)
+                )
+                moments[feature] += [reduced.size, reduced.sum(), (reduced**2).sum()]
+                blocks.append(reduced)
+            x_values[start : start + len(reduced)] = np.concatenate(blocks, axis=1)
+            start += len(reduced)
+
+        homogeniser = {}
+        for feature, (count, total, total_sq) in moments.items():
+            mean = total / count
+            homogeniser[feature] = {
+                "mean": mean,
+                "std": np.sqrt(total_sq / count - mean**2),
+            }
+        if len(features_pcm) > 1:
+            # as in pyxpcm, each feature is made comparable by its own stats.
+            for i, feature in enumerate(features_pcm):
+                cols = slice(i * maxvar, (i + 1) * maxvar)
+                for block in range(0, n_samples, chunk_rows):
+                    rows = slice(block, block + chunk_rows)
+                    x_values[rows, cols] = (
+                        x_values[rows, cols] - homogeniser[feature]["mean"]
+                    ) / homogeniser[feature]["std"]
+
+        classifier, llh = fit_gmm_streaming(
+            clone(pcm_object._classifier),
+            x_values,
+            chunk_rows=chunk_rows,
+            max_iter=max_iter,
+            tol=tol,
+        )
+        del x_values
+
+    for feature in features_pcm:
+        pcm_object._scaler[feature] = scalers[feature]
+        pcm_object._reducer[feature] = reducers[feature]
+        pcm_object._homogeniser[feature] = homogeniser[feature]
+    pcm_object._classifier = classifier
+    pcm_object._props["llh"] = llh
+    pcm_object._xlabel = [
+        feature + "_" + str(i) for feature in features_pcm for i in range(maxvar)
+    ]
+    pcm_object.fitted = True
+    return pcm_object
+
+
+def compare_class_maps(
+    pcm_reference: pyxpcm.pcm,
+    pcm_new: pyxpcm.pcm,
+    bsose_ds: xr.Dataset,
+    months: Sequence[int],
+    k_clusters: int,
+    mult_fact: int = 2,
+) -> pd.DataFrame:
+    """Agreement of the class maps from two pcm objects, month by month.
+
+    The new labels are matched to the reference ones on all the months
+    together, so a class that moves in some months counts as disagreement.
+
+    Args:
+        pcm_reference (pyxpcm.pcm): e.g. the single year fit.
+        pcm_new (pyxpcm.pcm): e.g. the streaming fit.
+        bsose_ds (xr.Dataset): lazily opened SALT and THETA.
+        months (Sequence[int]): time indices to compare on.
+        k_clusters (int): number of classes.
+        mult_fact (int, optional): grid to compare on. Defaults to 2.
+
+    Returns:
+        pd.DataFrame: fraction of ocean points with the same class, per month.
+    """
+    ref_list, new_list = [], []
+    for ds_month in iterate_months(bsose_ds, months, mult_fact):
+        for pcm_object, label_list in [(pcm_reference, ref_list), (pcm_new, new_list)]:
+            label_list.append(
+                pcm_object.predict(
+                    ds_month, features=cst.FEATURES_D, dim=cst.Z_COORD
+                ).values.astype("float64")
+            )
+    mapping = lab.match_labels(np.stack(ref_list), np.stack(new_list), k_clusters)
+    return pd.DataFrame(
+        {
+            cst.T_COORD: list(months),
+            "agreement": [
+                lab.agreement(ref, lab.relabel(new, mapping))
+                for ref, new in zip(ref_list, new_list)
+            ],
+        }
+    )
+
+
+def compare_with_single_year(
+    k_clusters: int = cst.K_CLUSTERS,
+    pca: int = cst.D_PCS,
+    months: Sequence[int] = range(60),
+) -> pd.DataFrame:
+    """Train on every month streaming, and compare with the single year fit.
+
+    Args:
+        k_clusters (int, optional): number of classes. Defaults to cst.K_CLUSTERS.
+        pca (int, optional): number of principal components. Defaults to cst.D_PCS.
+        months (Sequence[int], optional): time indices. Defaults to range(60).
+
+    Returns:
+        pd.DataFrame: class map agreement per month.
+    """
+    pcm_reference, _ = tim.train_on_interpolated_year(
+        k_clusters=k_clusters, maxvar=pca, separate_pca=True
+    )
+    bsose_ds = xvl.open_salt_theta(chunks={cst.T_COORD: 1})
+    pcm_stream = stream_fit(
+        tim.make_pcm(k_clusters=k_clusters, maxvar=pca, separate_pca=True),
+        bsose_ds,
+        months=months,
+    )
+    return compare_class_maps(pcm_reference, pcm_stream, bsose_ds, months, k_clusters)
+
+
+if __name__ == "__main__":
+    compare_df = compare_with_single_year()
+    print(compare_df.to_string(index=False))
+    compare_df.to_csv(os.path.join(cst.DATA_PATH, "stream_vs_single_year.csv"))
@@ -5,17 +5,294 @@ Example:
         python3 src/models/train_pyxpcm.py
 """
 import os
-from typing import Tuple
+import copy
+from typing import Tuple, Dict, Sequence
 import numpy as np
 import xarray as xr
+from sklearn.base import clone
+from sklearn.mixture import GaussianMixture
 import pyxpcm
 from pyxpcm.models import pcm
 import src.constants as cst
+import src.parallel as par
 import src.time_wrapper as twr
+import src.data_loading.cache as cch
+import src.data_loading.encoding as enc
+import src.data_loading.manifest as mfs
+import src.data_loading.sampling as smp
+import src.data_loading.xr_loader as xvl
+import src.models.pcm_io as pio
+import src.preprocessing.regrid as rgd
 
 xr.set_options(keep_attrs=True)
 
 
+def training_params(
+    time_i: int = cst.EXAMPLE_TIME_INDEX,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    interp: bool = True,
+    mult_fact: int = 2,
+    salt_file: str = cst.SALT_FILE,
+    theta_file: str = cst.THETA_FILE,
+) -> dict:
+    """Everything that the interpolated training data depends on.
+
+    Args:
+        time_i (int, optional): first month. Defaults to cst.EXAMPLE_TIME_INDEX.
+        min_depth (float, optional): minimum depth for column.
+            Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): maximum depth for column.
+            Defaults to cst.MAX_DEPTH.
+        interp (bool, optional): interpolate onto a coarser grid.
+            Defaults to True.
+        mult_fact (int, optional): resolution of the interpolated grid.
+            Defaults to 2.
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
+
+    Returns:
+        dict: json serialisable parameters, including the BSOSE files' mtimes.
+    """
+    return {
+        "time_i": time_i,
+        "min_depth": min_depth,
+        "max_depth": max_depth,
+        "interp": interp,
+        "mult_fact": mult_fact,
+        "regrid": "bilinear",
+        "inputs": mfs.hash_files([salt_file, theta_file]),
+    }
+
+
+def interpolated_training_data(
+    time_i: int = cst.EXAMPLE_TIME_INDEX,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    interp: bool = True,
+    remake: bool = cst.REMAKE,
+    mult_fact: int = 2,
+) -> xr.Dataset:
+    """The year of SALT and THETA that the pcm is trained on.
+
+    It is cached in cst.INTERP_CACHE_DIR, under a hash of these arguments
+    and the BSOSE files' modification times, and reused unless remake is
+    True.
+
+    Args:
+        time_i (int, optional): first month. Defaults to cst.EXAMPLE_TIME_INDEX.
+        min_depth (float, optional): minimum depth for column. Only one level
+            above it is read. Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): maximum depth for column.
+            Defaults to cst.MAX_DEPTH.
+        interp (bool, optional): interpolate onto a coarser grid.
+            Defaults to True.
+        remake (bool, optional): remake the file even if it exists.
+            Defaults to cst.REMAKE.
+        mult_fact (int, optional): resolution of the interpolated grid, which
+            has 60 * mult_fact latitudes and 4 times as many longitudes.
+            Defaults to 2.
+
+    Returns:
+        xr.Dataset: 12 months of SALT and THETA.
+    """
+    fname = cch.entry_path(
+        "interp",
+        training_params(
+            time_i=time_i,
+            min_depth=min_depth,
+            max_depth=max_depth,
+            interp=interp,
+            mult_fact=mult_fact,
+        ),
+    )
+    if remake is True or not cch.has_entry(fname):
+        print("going to save to: ", fname)
+        both_nc = xvl.open_salt_theta(
+            time_i=slice(time_i, time_i + 12), max_depth=max_depth, min_depth=min_depth
+        )
+        if interp:
+            lats_new, lons_new = rgd.coarse_grid(both_nc, mult_fact=mult_fact)
+            ds = rgd.Regridder.from_grids(
+                both_nc.YC.values, both_nc.XC.values, lats_new, lons_new
+            )(both_nc)
+        else:
+            ds = both_nc
+        with cch.writing(fname) as tmp_name:
+            enc.to_netcdf(ds, tmp_name)
+    else:
+        ds = xr.open_dataset(fname)
+    return ds
+
+
+def make_pcm(
+    k_clusters: int = cst.K_CLUSTERS,
+    maxvar: int = cst.D_PCS,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    separate_pca: bool = False,
+) -> pyxpcm.pcm:
+    """Make an untrained pcm object on the depth levels between min and max depth.
+
+    Args:
+        k_clusters (int, optional): clusters. Defaults to cst.K_CLUSTERS.
+        maxvar (int, optional): num pca. Defaults to cst.D_PCS.
+        min_depth (float, optional): minimum depth for column.
+            Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): maximum depth for column.
+            Defaults to cst.MAX_DEPTH.
+        separate_pca (bool, optional): separate the pca. Defaults to False.
+
+    Returns:
+        pyxpcm.pcm: the untrained pcm object.
+    """
+    z = np.arange(-min_depth, -max_depth, -10.0)
+    features_pcm = dict()
+    for var in cst.VAR_NAME_LIST:
+        features_pcm[var] = z
+    # only the pyxpcm fork has separate_pca, so it is left out when False.
+    kwargs = {"separate_pca": True} if separate_pca else {}
+    return pcm(
+        K=k_clusters,
+        features=features_pcm,
+        maxvar=maxvar,
+        timeit=True,
+        timeit_verb=1,
+        **kwargs,
+    )
+
+
+def pcm_config(
+    k_clusters: int = cst.K_CLUSTERS,
+    maxvar: int = cst.D_PCS,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    separate_pca: bool = False,
+    time_i: int = cst.EXAMPLE_TIME_INDEX,
+    interp: bool = True,
+    n_samples: int = cst.N_SAMPLES,
+    salt_file: str = cst.SALT_FILE,
+    theta_file: str = cst.THETA_FILE,
+) -> dict:
+    """Everything that a trained pcm object depends on.
+
+    Args:
+        k_clusters (int, optional): clusters. Defaults to cst.K_CLUSTERS.
+        maxvar (int, optional): num pca. Defaults to cst.D_PCS.
+        min_depth (float, optional): minimum depth for column.
+            Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): maximum depth for column.
+            Defaults to cst.MAX_DEPTH.
+        separate_pca (bool, optional): separate the pca. Defaults to False.
+        time_i (int, optional): first month of the training year.
+            Defaults to cst.EXAMPLE_TIME_INDEX.
+        interp (bool, optional): whether the training data was interpolated.
+            Defaults to True.
+        n_samples (int, optional): size of the stratified subsample it was
+            fitted on, None for every profile. Defaults to cst.N_SAMPLES.
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
+
+    Returns:
+        dict: "pcm" (the arguments of `make_pcm`) and "training" (see
+            `training_params`, with "sample" added if it was subsampled).
+    """
+    config = {
+        "pcm": {
+            "k_clusters": k_clusters,
+            "maxvar": maxvar,
+            "min_depth": min_depth,
+            "max_depth": max_depth,
+            "separate_pca": separate_pca,
+        },
+        "training": training_params(
+            time_i=time_i,
+            min_depth=min_depth,
+            max_depth=max_depth,
+            interp=interp,
+            salt_file=salt_file,
+            theta_file=theta_file,
+        ),
+    }
+    if n_samples is not None:
+        # left out otherwise, so that the full fits keep their saved names.
+        config["training"]["sample"] = {
+            "n_samples": n_samples,
+            "band_width": cst.SUBSAMPLE_BAND_WIDTH,
+            "seed": cst.SEED,
+        }
+    return config
+
+
+def fitting_data(ds: xr.Dataset, n_samples: int = cst.N_SAMPLES) -> xr.Dataset:
+    """The profiles to fit on: all of `ds`, or a stratified subsample of it.
+
+    Args:
+        ds (xr.Dataset): training data.
+        n_samples (int, optional): subsample size, None for every profile.
+            Defaults to cst.N_SAMPLES.
+
+    Returns:
+        xr.Dataset: what to pass to `pcm.fit`.
+    """
+    if n_samples is None:
+        return ds
+    return smp.stratified_sample(
+        ds, n_samples, band_width=cst.SUBSAMPLE_BAND_WIDTH, seed=cst.SEED
+    )
+
+
+def pcm_path(config: dict) -> str:
+    """File name of a trained pcm object, from a hash of its config.
+
+    Args:
+        config (dict): from `pcm_config`.
+
+    Returns:
+        str: `.npz` file name in cst.PCM_DIR.
+    """
+    return os.path.join(
+        cst.PCM_DIR,
+        "pcm-k-"
+        + str(config["pcm"]["k_clusters"])
+        + "-"
+        + mfs.hash_config(**config)[:16]
+        + ".npz",
+    )
+
+
+def load_pcm(path: str) -> pyxpcm.pcm:
+    """Load a pcm object saved by `save_pcm`.
+
+    Args:
+        path (str): `.npz` file name.
+
+    Returns:
+        pyxpcm.pcm: the trained pcm object.
+    """
+    config = pio.read_header(path)["config"]
+    return pio.load_state(make_pcm(**config["pcm"]), path)
+
+
+def save_pcm(pcm_object: pyxpcm.pcm, config: dict, path: str = None) -> str:
+    """Save a trained pcm object under the hash of its config.
+
+    Args:
+        pcm_object (pyxpcm.pcm): the pcm object which has already been trained.
+        config (dict): from `pcm_config`.
+        path (str, optional): `.npz` file name. Defaults to None, which uses
+            `pcm_path(config)`.
+
+    Returns:
+        str: `.npz` file name.
+    """
+    if path is None:
+        path = pcm_path(config)
+    pio.save_state(pcm_object, path, config)
+    print("saved pcm object to: ", path)
+    return path
+
+
 @twr.timeit
 def train_on_interpolated_year(
     time_i: int = cst.EXAMPLE_TIME_INDEX,
@@ -27,6 +304,7 @@ def train_on_interpolated_year(
     separate_pca: bool = False,
     interp: bool = True,
     remake: bool = cst.REMAKE,
+    n_samples: int = cst.N_SAMPLES,
 ) -> Tuple[pyxpcm.pcm, xr.Dataset]:
     """Train on interpolated year.
 
@@ -40,50 +318,43 @@ def train_on_interpolated_year(
             Defaults to cst.MAX_DEPTH.
         separate_pca (bool, optional): separate the pca. Defaults to True.
         remove_init_var (bool, optional): remove initial variables. Defaults to True.
+        remake (bool, optional): refit even if a pcm object with the same
+            settings was saved before. Defaults to cst.REMAKE.
+        n_samples (int, optional): fit on a stratified subsample of this many
+            profiles (see `smp.stratified_sample`), None to fit on every
+            profile. The predictions are still made on every profile.
+            Defaults to cst.N_SAMPLES.
 
     Returns:
         Tuple[pyxpcm.pcm, xr.Dataset]: the fitted object and its corresponding dataset.
 
     """
-    z = np.arange(-min_depth, -max_depth, -10.0)
-    features_pcm = dict()
-    for var in cst.VAR_NAME_LIST:
-        features_pcm[var] = z
     features = cst.FEATURES_D
-    fname = cst.INTERP_FILE_NAME
-    if not os.path.isfile(fname) or remake is True:
-        if os.path.isfile(fname):
-            os.remove(fname)
-        print("going to save to: ", fname)
-        salt_nc = xr.open_dataset(cst.SALT_FILE).isel(time=slice(time_i, time_i + 12))
-        theta_nc = xr.open_dataset(cst.THETA_FILE).isel(time=slice(time_i, time_i + 12))
-        big_nc = xr.merge([salt_nc, theta_nc])
-        both_nc = big_nc.where(big_nc.coords[cst.DEPTH_NAME] > max_depth).drop(
-            cst.USELESS_LIST
-        )
-        if interp:
-            mult_fact = 2
-            lons_new = np.linspace(
-                both_nc.XC.min(), both_nc.XC.max(), 60 * 4 * mult_fact
-            )
-            lats_new = np.linspace(both_nc.YC.min(), both_nc.YC.max(), 60 * mult_fact)
-            ds = both_nc.interp(coords={cst.Y_COORD: lats_new, cst.X_COORD: lons_new})
-        else:
-            ds = both_nc
-        ds.to_netcdf(fname)
-    else:
-        ds = xr.open_dataset(fname)
-
-    pcm_object = pcm(
-        K=k_clusters,
-        features=features_pcm,
-        separate_pca=separate_pca,
+    ds = interpolated_training_data(
+        time_i=time_i,
+        min_depth=min_depth,
+        max_depth=max_depth,
+        interp=interp,
+        remake=remake,
+    )
+    config = pcm_config(
+        k_clusters=k_clusters,
         maxvar=maxvar,
-        timeit=True,
-        timeit_verb=1,
+        min_depth=min_depth,
+        max_depth=max_depth,
+        separate_pca=separate_pca,
+        time_i=time_i,
+        interp=interp,
+        n_samples=n_samples,
     )
-
-    pcm_object.fit(ds, features=features, dim=cst.Z_COORD)
+    if not remake and os.path.isfile(pcm_path(config)):
+        pcm_object = load_pcm(pcm_path(config))
+    else:
+        pcm_object = make_pcm(**config["pcm"])
+        pcm_object.fit(
+            fitting_data(ds, n_samples=n_samples), features=features, dim=cst.Z_COORD
+        )
+        save_pcm(pcm_object, config)
     pcm_object.add_pca_to_xarray(ds, features=features, dim=cst.Z_COORD, inplace=True)
     pcm_object.find_i_metric(ds, inplace=True)
     pcm_object.predict(ds, features=features, dim=cst.Z_COORD, inplace=True)
@@ -100,5 +371,208 @@ def train_on_interpolated_year(
     return pcm_object, ds
 
 
+def _fit_classifier(
+    classifier: GaussianMixture, x_values: np.ndarray = None
+) -> Tuple[GaussianMixture, float]:
+    """Fit one classifier, return it with its log likelihood on the training set."""
+    if x_values is None:
+        x_values = par.worker_state("x_values")
+    classifier.fit(x_values)
+    return classifier, classifier.score(x_values)
+
+
+def fit_classifiers(
+    classifiers: Sequence[GaussianMixture],
+    x_values: np.ndarray,
+    workers: int = cst.N_WORKERS,
+) -> list:
+    """Fit several classifiers on the same preprocessed matrix.
+
+    Args:
+        classifiers (Sequence[GaussianMixture]): unfitted classifiers.
+        x_values (np.ndarray): (samples, features) reduced training data.
+        workers (int, optional): processes to fit them on, each gets
+            `x_values` once. Defaults to cst.N_WORKERS.
+
+    Returns:
+        list: (fitted classifier, training log likelihood) for each.
+    """
+    if workers <= 1:
+        return [_fit_classifier(classifier, x_values) for classifier in classifiers]
+    with par.spawn_pool(
+        min(workers, len(classifiers)),
+        par.set_worker_state,
+        ({"x_values": x_values},),
+    ) as executor:
+        return list(executor.map(_fit_classifier, classifiers))
+
+
+def with_classifier(
+    pcm_object: pyxpcm.pcm, classifier: GaussianMixture, llh: float, n_samples: int
+) -> pyxpcm.pcm:
+    """Copy of a pcm object with its preprocessing fitted, and a fitted classifier.
+
+    Args:
+        pcm_object (pyxpcm.pcm): pcm object whose preprocessing was fitted.
+        classifier (GaussianMixture): fitted on its reduced features.
+        llh (float): log likelihood of the training set.
+        n_samples (int): number of training profiles.
+
+    Returns:
+        pyxpcm.pcm: the trained pcm object.
+    """
+    # pylint: disable=protected-access
+    pcm_new = copy.deepcopy(pcm_object)
+    pcm_new._classifier = classifier
+    pcm_new._props["K"] = classifier.n_components
+    pcm_new._props["llh"] = llh
+    pcm_new._fit_stats["score"] = llh
+    pcm_new._fit_stats["n_samples_seen_"] = n_samples
+    pcm_new._fit_stats["n_iter_"] = classifier.n_iter_
+    pcm_new.fitted = True
+    return pcm_new
+
+
+def reduced_features(
+    pcm_object: pyxpcm.pcm,
+    ds: xr.Dataset,
+    features: dict = cst.FEATURES_D,
+    dim: str = cst.Z_COORD,
+) -> np.ndarray:
+    """Fit the interpolation, scaling and reduction of a pcm object.
+
+    Args:
+        pcm_object (pyxpcm.pcm): untrained pcm object, fitted in place.
+        ds (xr.Dataset): training data.
+        features (dict, optional): features mapping. Defaults to cst.FEATURES_D.
+        dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+
+    Returns:
+        np.ndarray: (samples, features) matrix that the classifier is fitted on.
+    """
+    x_values, _ = pcm_object.preprocessing(ds, features=features, dim=dim, action="fit")
+    return np.asarray(x_values.values)
+
+
+@twr.timeit
+def fit_shared_preprocessing(
+    pcm_object: pyxpcm.pcm,
+    ds: xr.Dataset,
+    k_list: Sequence[int] = cst.K_LIST,
+    features: dict = cst.FEATURES_D,
+    dim: str = cst.Z_COORD,
+    workers: int = cst.N_WORKERS,
+) -> Dict[int, pyxpcm.pcm]:
+    """Fit one pcm for each K, sharing everything but the classifier.
+
+    The interpolation, scaling and reduction do not depend on K, so they
+    are fitted once on `pcm_object`, and only the Gaussian mixture is
+    fitted on the reduced features for each K.
+
+    Args:
+        pcm_object (pyxpcm.pcm): untrained pcm object, which sets the
+            preprocessing and the classifier settings.
+        ds (xr.Dataset): training data.
+        k_list (Sequence[int], optional): numbers of clusters.
+            Defaults to cst.K_LIST.
+        features (dict, optional): features mapping. Defaults to cst.FEATURES_D.
+        dim (str, optional): vertical dimension. Defaults to cst.Z_COORD.
+        workers (int, optional): processes to fit the classifiers on.
+            Defaults to cst.N_WORKERS.
+
+    Returns:
+        Dict[int, pyxpcm.pcm]: a trained pcm object for each K.
+    """
+    # pylint: disable=protected-access
+    x_values = reduced_features(pcm_object, ds, features=features, dim=dim)
+    classifiers = [
+        clone(pcm_object._classifier).set_params(n_components=k_clusters)
+        for k_clusters in k_list
+    ]
+    fits = fit_classifiers(classifiers, x_values, workers=workers)
+    return {
+        k_clusters: with_classifier(pcm_object, classifier, llh, x_values.shape[0])
+        for k_clusters, (classifier, llh) in zip(k_list, fits)
+    }
+
+
+@twr.timeit
+def train_multi_k_on_interpolated_year(
+    k_list: Sequence[int] = cst.K_LIST,
+    time_i: int = cst.EXAMPLE_TIME_INDEX,
+    maxvar: int = cst.D_PCS,
+    min_depth: float = cst.MIN_DEPTH,
+    max_depth: float = cst.MAX_DEPTH,
+    separate_pca: bool = False,
+    interp: bool = True,
+    remake: bool = cst.REMAKE,
+    workers: int = cst.N_WORKERS,
+    n_samples: int = cst.N_SAMPLES,
+) -> Dict[int, pyxpcm.pcm]:
+    """Train on interpolated year for several K at once.
+
+    Args:
+        k_list (Sequence[int], optional): numbers of clusters.
+            Defaults to cst.K_LIST.
+        time_i (int, optional): time index. Defaults to cst.EXAMPLE_TIME_INDEX.
+        maxvar (int, optional): num pca. Defaults to cst.D_PCS.
+        min_depth (float, optional): minimum depth for column.
+            Defaults to cst.MIN_DEPTH.
+        max_depth (float, optional): maximum depth for column.
+            Defaults to cst.MAX_DEPTH.
+        separate_pca (bool, optional): separate the pca. Defaults to False.
+        interp (bool, optional): interpolate the training data onto a coarser
+            grid. Defaults to True.
+        remake (bool, optional): remake the training data and refit, even if
+            pcm objects with the same settings were saved. Defaults to cst.REMAKE.
+        workers (int, optional): processes to fit the classifiers on.
+            Defaults to cst.N_WORKERS.
+        n_samples (int, optional): fit on a stratified subsample of this many
+            profiles, None for every profile. Defaults to cst.N_SAMPLES.
+
+    Returns:
+        Dict[int, pyxpcm.pcm]: a trained pcm object for each K.
+    """
+    configs = {
+        k_clusters: pcm_config(
+            k_clusters=k_clusters,
+            maxvar=maxvar,
+            min_depth=min_depth,
+            max_depth=max_depth,
+            separate_pca=separate_pca,
+            time_i=time_i,
+            interp=interp,
+            n_samples=n_samples,
+        )
+        for k_clusters in k_list
+    }
+    if not remake and all(
+        os.path.isfile(pcm_path(config)) for config in configs.values()
+    ):
+        # the scaler and pca fits are deterministic, so these still share
+        # their preprocessing even if they were trained separately.
+        return {
+            k_clusters: load_pcm(pcm_path(config))
+            for k_clusters, config in configs.items()
+        }
+    ds = interpolated_training_data(
+        time_i=time_i,
+        min_depth=min_depth,
+        max_depth=max_depth,
+        interp=interp,
+        remake=remake,
+    )
+    pcm_object = make_pcm(**configs[k_list[0]]["pcm"])
+    pcm_dict = fit_shared_preprocessing(
+        pcm_object,
+        fitting_data(ds, n_samples=n_samples),
+        k_list=k_list,
+        workers=workers,
+    )
+    for k_clusters, pcm_k in pcm_dict.items():
+        save_pcm(pcm_k, configs[k_clusters])
+    return pcm_dict
+
+
 if __name__ == "__main__":
     train_on_interpolated_year()
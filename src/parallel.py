@@ -0,0 +1,70 @@
+"""Process pools for the batch jobs, and what each worker is given once.
+
+Example:
+    Usage::
+        import src.parallel as par
+        with par.spawn_pool(4, par.set_worker_state, ({"x_values": x},)) as pool:
+            results = list(pool.map(fit, classifiers))
+        # and in fit, which runs in a worker:
+        x_values = par.worker_state("x_values")
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict
+
+# What each worker process was given by set_worker_state, by name.
+_WORKER_STATE: Dict[str, any] = {}
+
+
+def spawn_pool(
+    workers: int, initializer: Callable = None, initargs: tuple = ()
+) -> ProcessPoolExecutor:
+    """
+    A pool of worker processes that are spawned rather than forked.
+
+    HDF5, under NetCDF4, is not safe to use in a child forked while the
+    parent has files open, and the parent usually has the BSOSE files or an
+    output store open. A spawned worker starts a fresh interpreter instead,
+    so the functions it runs, and the initializer, have to be importable at
+    module level, and their arguments picklable.
+
+    Args:
+        workers (int): number of processes.
+        initializer (Callable, optional): run once in each worker as it
+            starts, e.g. `set_worker_state` or a function that opens the
+            files the worker reads. Defaults to None.
+        initargs (tuple, optional): arguments of the initializer.
+            Defaults to ().
+
+    Returns:
+        ProcessPoolExecutor: to use as a context manager.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initializer,
+        initargs=initargs,
+    )
+
+
+def set_worker_state(state: Dict[str, any]) -> None:
+    """
+    Keep some objects in this worker, so they are sent once per process.
+
+    Args:
+        state (Dict[str, any]): name to object, e.g. a training matrix.
+    """
+    _WORKER_STATE.update(state)
+
+
+def worker_state(name: str) -> any:
+    """
+    An object given to this worker by `set_worker_state`.
+
+    Args:
+        name (str): its name.
+
+    Returns:
+        any: the object.
+    """
+    return _WORKER_STATE[name]
@@ -0,0 +1,28 @@
+"""Plot the fit statistics for each K from `src.models.select_k`."""
+import pandas as pd
+import matplotlib.pyplot as plt
+import src.time_wrapper as twr
+
+
+@twr.timeit
+def plot_k_selection(selection_df: pd.DataFrame) -> None:
+    """
+    Plot BIC and AIC, and the training and held out log likelihood, against K.
+
+    Returns void (although matplotlib will be storing the figure).
+
+    Args:
+        selection_df (pd.DataFrame): table from `select_k.select_k`.
+    """
+    k_values = selection_df["k_clusters"]
+    _, axs = plt.subplots(1, 2, figsize=(10, 4))
+    for name, label in [("bic", "BIC"), ("aic", "AIC")]:
+        axs[0].plot(k_values, selection_df[name], "o-", label=label)
+    axs[0].set_ylabel("Information criterion")
+    for name, label in [("train_llh", "Training"), ("held_out_llh", "Held out")]:
+        axs[1].plot(k_values, selection_df[name], "o-", label=label)
+    axs[1].set_ylabel("Log likelihood per profile")
+    for ax in axs:
+        ax.set_xlabel("K")
+        ax.legend()
+    plt.tight_layout()
@@ -0,0 +1,281 @@
+"""Horizontal gradients in physical units, from cached grid metrics.
+
+Differentiating against XC and YC gives gradients per degree, and a degree
+of longitude shrinks towards the pole, so those are not comparable across
+the BSOSE grid. Here the distance (m) from each cell centre to the next one
+eastwards (dx) and northwards (dy) is worked out once for a grid and kept
+on disk in cst.METRICS_CACHE_DIR under a hash of the grid, and gradients are
+taken against those distances, giving e.g. kg m-4 for density.
+
+- The longitude wraps around when the grid covers the whole circle, so the
+  first and last columns have neighbours on both sides.
+- NaN (land) points are skipped: next to one, the one-sided difference
+  from the other side is used, and a point between two is NaN.
+- Any leading dimensions (time, Z, pca, ...) are differentiated at once.
+
+Example:
+    Usage::
+        import src.preprocessing.grid_metrics as gmt
+        metrics = gmt.GridMetrics.from_grids(ds.YC.values, ds.XC.values)
+        x_grad, y_grad = metrics.gradients(ds.PCA_VALUES)
+"""
+from typing import Tuple
+import numpy as np
+import xarray as xr
+import src.constants as cst
+import src.data_loading.cache as cch
+import src.data_loading.manifest as mfs
+
+
+def is_periodic(lons: np.ndarray) -> bool:
+    """Whether evenly spaced longitudes go the whole way around.
+
+    Args:
+        lons (np.ndarray): increasing longitudes (degrees).
+
+    Returns:
+        bool: True if the step from the last to the first (plus 360) is the
+            same as the other steps.
+    """
+    lons = np.asarray(lons, dtype="float64")
+    if len(lons) < 2:
+        return False
+    steps = np.diff(lons)
+    return bool(np.isclose(lons[0] + 360 - lons[-1], steps.mean(), rtol=1e-3))
+
+
+def gradient_along(values: np.ndarray, spacing: np.ndarray, axis: int) -> np.ndarray:
+    """Derivative along one axis, skipping NaN neighbours.
+
+    Second order (on an uneven grid) where both neighbours are defined, and
+    first order where only one is.
+
+    Args:
+        values (np.ndarray): field, e.g. (..., YC, XC).
+        spacing (np.ndarray): distance from each point to the next along
+            `axis`, broadcastable to `values`. Its last entry along `axis`
+            is the distance from the last point round to the first, NaN if
+            the axis does not wrap around.
+        axis (int): axis to differentiate along.
+
+    Returns:
+        np.ndarray: same shape, float32 for float32 input and float64
+            otherwise.
+    """
+    dtype = np.float32 if values.dtype == np.float32 else np.float64
+    values = values.astype(dtype, copy=False)
+    spacing = np.asarray(spacing, dtype=dtype)
+    # the slope from each point to the next, and from the one before to it.
+    forward = np.roll(values, -1, axis=axis)
+    forward -= values
+    forward /= spacing
+    backward = np.roll(forward, 1, axis=axis)
+    back_spacing = np.roll(spacing, 1, axis=axis)
+    with np.errstate(invalid="ignore"):
+        central = (back_spacing * forward + spacing * backward) / (
+            back_spacing + spacing
+        )
+    return np.where(
+        np.isnan(forward), backward, np.where(np.isnan(backward), forward, central)
+    )
+
+
+class GridMetrics:
+    """
+    Distances between neighbouring cell centres of a horizontal grid.
+
+    Example:
+        Usage::
+            metrics = GridMetrics.from_grids(lats, lons)
+            x_grad = metrics.x_gradient(values)
+    """
+
+    def __init__(
+        self, dx: np.ndarray, dy: np.ndarray, lats: np.ndarray, lons: np.ndarray
+    ) -> None:
+        """
+        Wrap the metric arrays.
+
+        These can also come from a model's own grid variables, such as
+        MITgcm's dxC and dyC moved to the cell that they start from.
+
+        Args:
+            dx (np.ndarray): (YC, XC) distance to the next cell east (m), the
+                last column's round to the first, NaN if XC does not wrap.
+            dy (np.ndarray): (YC, XC) distance to the next cell north (m),
+                NaN on the last row.
+            lats (np.ndarray): latitudes.
+            lons (np.ndarray): longitudes.
+        """
+        self.dx = np.asarray(dx, dtype="float64")
+        self.dy = np.asarray(dy, dtype="float64")
+        self.lats = np.asarray(lats)
+        self.lons = np.asarray(lons)
+
+    def __repr__(self) -> str:
+        return "<GridMetrics (%i, %i)%s>" % (
+            len(self.lats),
+            len(self.lons),
+            " periodic" if self.periodic else "",
+        )
+
+    @property
+    def periodic(self) -> bool:
+        """Whether the longitude wraps around."""
+        return bool(np.all(np.isfinite(self.dx[:, -1])))
+
+    @classmethod
+    def from_grids(
+        cls,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        periodic: bool = None,
+        radius: float = cst.EARTH_RADIUS,
+        cache_dir: str = cst.METRICS_CACHE_DIR,
+    ) -> "GridMetrics":
+        """
+        Load the metrics of a rectilinear grid on the sphere, or make and save them.
+
+        Args:
+            lats (np.ndarray): increasing latitudes (degrees).
+            lons (np.ndarray): increasing longitudes (degrees).
+            periodic (bool, optional): whether the longitude wraps around.
+                Defaults to None, which uses `is_periodic`.
+            radius (float, optional): of the sphere (m).
+                Defaults to cst.EARTH_RADIUS.
+            cache_dir (str, optional): where to keep the metrics, None not to
+                keep them. Defaults to cst.METRICS_CACHE_DIR.
+
+        Returns:
+            GridMetrics: for this grid.
+        """
+        lats = np.asarray(lats, dtype="float64")
+        lons = np.asarray(lons, dtype="float64")
+        if periodic is None:
+            periodic = is_periodic(lons)
+        path = None
+        if cache_dir is not None:
+            path = cch.entry_path(
+                "metrics",
+                {
+                    "grids": mfs.hash_state(lats, lons),
+                    "periodic": periodic,
+                    "radius": radius,
+                },
+                cache_dir=cache_dir,
+                suffix=".npz",
+            )
+            if cch.has_entry(path):
+                return cls.load(path)
+        lon_steps = np.append(
+            np.diff(lons), lons[0] + 360 - lons[-1] if periodic else np.nan
+        )
+        lat_steps = np.append(np.diff(lats), np.nan)
+        dx = (
+            radius
+            * np.cos(np.radians(lats))[:, np.newaxis]
+            * np.radians(lon_steps)[np.newaxis, :]
+        )
+        dy = np.repeat(
+            (radius * np.radians(lat_steps))[:, np.newaxis], len(lons), axis=1
+        )
+        metrics = cls(dx, dy, lats, lons)
+        if path is not None:
+            with cch.writing(path) as tmp_path:
+                metrics.save(tmp_path)
+        return metrics
+
+    def save(self, path: str) -> None:
+        """
+        Save the metrics to an `.npz` file.
+
+        Args:
+            path (str): file name.
+        """
+        with open(path, "wb") as npz_file:
+            np.savez(npz_file, dx=self.dx, dy=self.dy, lats=self.lats, lons=self.lons)
+
+    @classmethod
+    def load(cls, path: str) -> "GridMetrics":
+        """
+        Load metrics saved by `save`.
+
+        Args:
+            path (str): file name.
+
+        Returns:
+            GridMetrics: with those metrics.
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            return cls(npz["dx"], npz["dy"], npz["lats"], npz["lons"])
+
+    def isel_y(self, y_slice: slice) -> "GridMetrics":
+        """
+        The metrics of a band of latitudes, as if it were the whole grid.
+
+        Args:
+            y_slice (slice): latitudes, with a step of 1.
+
+        Returns:
+            GridMetrics: with no northern neighbour on its last row.
+        """
+        dy = self.dy[y_slice].copy()
+        dy[-1] = np.nan
+        return GridMetrics(self.dx[y_slice], dy, self.lats[y_slice], self.lons)
+
+    def x_gradient(self, values: np.ndarray) -> np.ndarray:
+        """
+        Eastward gradient of an array whose last two axes are (YC, XC).
+
+        Args:
+            values (np.ndarray): (..., YC, XC) field.
+
+        Returns:
+            np.ndarray: (..., YC, XC) per metre.
+        """
+        return gradient_along(values, self.dx, axis=-1)
+
+    def y_gradient(self, values: np.ndarray) -> np.ndarray:
+        """
+        Northward gradient of an array whose last two axes are (YC, XC).
+
+        Args:
+            values (np.ndarray): (..., YC, XC) field.
+
+        Returns:
+            np.ndarray: (..., YC, XC) per metre.
+        """
+        return gradient_along(values, self.dy, axis=-2)
+
+    def gradients(
+        self, da: xr.DataArray, units: str = None
+    ) -> Tuple[xr.DataArray, xr.DataArray]:
+        """
+        Eastward and northward gradients of a data array on this grid.
+
+        Args:
+            da (xr.DataArray): with YC and XC among its dimensions.
+            units (str, optional): units of the gradients, e.g. "kg m-4".
+                Defaults to None, which leaves them out.
+
+        Returns:
+            Tuple[xr.DataArray, xr.DataArray]: x_grad and y_grad, with the
+                same dimensions and coordinates as `da`.
+        """
+        grid_dims = (cst.Y_COORD, cst.X_COORD)
+        other = [dim for dim in da.dims if dim not in grid_dims]
+        da_t = da.transpose(*other, *grid_dims)
+        values = np.asarray(da_t.values)
+        out = []
+        for name, dim, grad in [
+            ("x_grad", cst.X_COORD, self.x_gradient(values)),
+            ("y_grad", cst.Y_COORD, self.y_gradient(values)),
+        ]:
+            grad_da = da_t.copy(data=grad).transpose(*da.dims).rename(name)
+            grad_da.attrs = {}
+            if da.name is not None:
+                grad_da.attrs["long_name"] = str(da.name) + " gradient along " + dim
+            if units is not None:
+                grad_da.attrs["units"] = units
+            out.append(grad_da)
+        return out[0], out[1]
@@ -1,61 +1,146 @@
 """Preprocessing script to transform to different quantities."""
-from typing import Tuple
+from collections import deque
+from typing import Dict, Sequence, Tuple
 import numpy as np
 import gsw
 import xarray as xr
 import src.constants as cst
+import src.parallel as par
+import src.time_wrapper as twr
+import src.data_loading.encoding as enc
+import src.data_loading.store as sto
+import src.data_loading.xr_loader as xvl
+import src.preprocessing.grid_metrics as gmt
 
 xr.set_options(keep_attrs=True)
 
-
-def return_density(
+# TODO Change so that all are more compliant to CMIP6 protocol etc.
+VAR_ATTRS: dict = {
+    "SALT": {
+        "units": "psu",
+        "long_name": "Salinity",
+        "other_name": "sea_water_salinity",
+        "standard_name": "SALT",
+        "comment": "This is practical salinity (see TEOS-10)",
+    },
+    "THETA": {
+        "units": "degC",
+        "long_name": "Potential Temperature",
+        "standard_name": "THETA",
+    },
+    "Pressure": {
+        "unit": "Pa",
+        "long_name": "Pressure at Model Full-Levels [Pa]",
+        "standard_name": "pfull",
+    },
+    "PCA_VALUES": {"long_name": "PCM Values", "units": ""},
+    "PCM_RANK": {"long_name": "PCM Rank", "units": ""},
+    "Density": {
+        "unit": "kg m-3",
+        "long_name": "Density",
+        "short_name": "rhopoto",
+        "standard_name": "sea_water_potential_density",
+    },
+    "ct": {
+        "units": "degC",
+        "long_name": "Sea Water Conservative Temperature [degC]",
+        "standard_name": "bigthetao",
+    },
+    "SA": {
+        "units": "g kg-1",
+        "long_name": "Absolute Salinity",
+        "standard_name": "sea_water_absolute_salinity",
+    },
+    "x_grad": {
+        "units": "kg m-4",
+        "long_name": "Eastward density gradient",
+    },
+    "y_grad": {
+        "units": "kg m-4",
+        "long_name": "Northward density gradient",
+    },
+}
+
+# variables that create_derived_netcdf can make.
+DERIVED_VARIABLES: tuple = ("SA", "ct", "Density", "x_grad", "y_grad")
+
+# float64 arrays of one level's size held at once by derived_block for the
+# density alone (SA, CT, rho and the masked SALT and THETA), each extra
+# variable adds one more.
+DENSITY_ARRAYS_PER_LEVEL: int = 6
+
+
+def teos10_fields(
     pt_values: np.ndarray,
     practical_salt_values: np.ndarray,
     lon_values: np.ndarray,
-    lat_values: np.ndrray,
+    lat_values: np.ndarray,
     z_values: np.ndarray,
-) -> Tuple[np.array, np.ndarray, np.ndarray]:
+) -> Dict[str, np.ndarray]:
     """
-    Wrapper around the gsw to make it work.
+    Absolute salinity, conservative temperature, density and pressure.
+
+    The pressure only depends on (Z, YC) and the longitude only on XC, so
+    they are passed to gsw as (Z, YC, 1) and (1, 1, XC) arrays, which it
+    broadcasts against the (Z, YC, XC) fields, rather than as full grids.
 
     Args:
-        pt_values (np.array): Potential temperature.
-        practical_salt_values (np.array): Salt values.
-        lon_values (np.array): Longitude values.
-        lat_values (np.array): Latitude values.
-        z_values (np.array): Height values.
+        pt_values (np.array): Potential temperature (Z, YC, XC).
+        practical_salt_values (np.array): Salt values (Z, YC, XC).
+        lon_values (np.array): Longitude values (XC).
+        lat_values (np.array): Latitude values (YC).
+        z_values (np.array): Height values (Z).
 
     Returns:
-        Tuple[np.array, np.array, np.array]: rho_values, ct_values, pressure_values
+        Dict[str, np.ndarray]: "SA", "ct" and "Density" (Z, YC, XC), and
+            "Pressure" (a read only broadcast view of the (Z, YC, 1) pressure).
     """
-
-    lat_mesh, z_mesh = np.meshgrid(lat_values, z_values)
+    z_column = np.asarray(z_values)[:, np.newaxis, np.newaxis]
+    lat_column = np.asarray(lat_values)[np.newaxis, :, np.newaxis]
+    lon_row = np.asarray(lon_values)[np.newaxis, np.newaxis, :]
 
     # pylint: disable=no-value-for-parameter
-    pressure_mesh = gsw.p_from_z(z_mesh, lat_mesh)
-    pressure_values = np.zeros(np.shape(pt_values))
-    lat_grid = np.zeros(np.shape(pt_values))
-    lon_grid = np.zeros(np.shape(pt_values))
-
-    # TODO these two loops could be vectorized
-
-    for i in range(np.shape(pt_values)[2]):
-        pressure_values[:, :, i] = pressure_mesh[:, :]
-        lat_grid[:, :, i] = lat_mesh[:, :]
-
-    for i in range(np.shape(pt_values)[0]):
-        for j in range(np.shape(pt_values)[1]):
-            lon_grid[i, j, :] = lon_values[:]
+    pressure_column = gsw.p_from_z(z_column, lat_column)
 
     absolute_salinity = gsw.SA_from_SP(
-        practical_salt_values, pressure_values, lon_grid, lat_grid
+        practical_salt_values, pressure_column, lon_row, lat_column
     )
     ct_values = gsw.conversions.CT_from_pt(absolute_salinity, pt_values)
-    rho_values = gsw.density.rho(absolute_salinity, ct_values, pressure_values)
+    rho_values = gsw.density.rho(absolute_salinity, ct_values, pressure_column)
+
+    return {
+        "SA": absolute_salinity,
+        "ct": ct_values,
+        "Density": rho_values,
+        "Pressure": np.broadcast_to(pressure_column, np.shape(pt_values)),
+    }
 
-    # print(np.shape(rho_values))
 
-    return rho_values, ct_values, pressure_values
+def return_density(
+    pt_values: np.ndarray,
+    practical_salt_values: np.ndarray,
+    lon_values: np.ndarray,
+    lat_values: np.ndarray,
+    z_values: np.ndarray,
+) -> Tuple[np.array, np.ndarray, np.ndarray]:
+    """
+    Wrapper around the gsw to make it work.
+
+    Args:
+        pt_values (np.array): Potential temperature (Z, YC, XC).
+        practical_salt_values (np.array): Salt values (Z, YC, XC).
+        lon_values (np.array): Longitude values (XC).
+        lat_values (np.array): Latitude values (YC).
+        z_values (np.array): Height values (Z).
+
+    Returns:
+        Tuple[np.array, np.array, np.array]: rho_values, ct_values,
+            pressure_values (see `teos10_fields`).
+    """
+    fields = teos10_fields(
+        pt_values, practical_salt_values, lon_values, lat_values, z_values
+    )
+    return fields["Density"], fields["ct"], fields["Pressure"]
 
 
 def create_datarray(
@@ -128,44 +213,9 @@ def create_known_dataarray(
     Returns:
         xr.DataArray: [description]
     """
-    # TODO Change so that all are more compliant to CMIP6 protocol etc.
-
-    v_attr_d_d = {
-        "SALT": {
-            "units": "psu",
-            "long_name": "Salinity",
-            "other_name": "sea_water_salinity",
-            "standard_name": "SALT",
-            "comment": "This is practical salinity (see TEOS-10)",
-        },
-        "THETA": {
-            "units": "degC",
-            "long_name": "Potential Temperature",
-            "standard_name": "THETA",
-        },
-        "Pressure": {
-            "unit": "Pa",
-            "long_name": "Pressure at Model Full-Levels [Pa]",
-            "standard_name": "pfull",
-        },
-        "PCA_VALUES": {"long_name": "PCM Values", "units": ""},
-        "PCM_RANK": {"long_name": "PCM Rank", "units": ""},
-        "Density": {
-            "unit": "kg m-3",
-            "long_name": "Density",
-            "short_name": "rhopoto",
-            "standard_name": "sea_water_potential_density",
-        },
-        "ct": {
-            "units": "degC",
-            "long_name": "Sea Water Conservative Temperature [degC]",
-            "standard_name": "bigthetao",
-        },
-    }
-
-    assert name in v_attr_d_d
+    assert name in VAR_ATTRS
 
-    return create_datarray(format_dataarray, values, name, v_attr_d_d[name])
+    return create_datarray(format_dataarray, values, name, VAR_ATTRS[name])
 
 
 def test_density_da(
@@ -201,146 +251,343 @@ def test_density_da(
     return density_da, ct_da, pressure_da, ds.THETA
 
 
-def create_whole_density_netcdf() -> None:
-    """Create density netcdf."""
-
-    main_dir = "/Users/simon/bsose_monthly/"
-    salt = main_dir + "bsose_i106_2008to2012_monthly_Salt.nc"
-    salt_nc = xr.open_dataset(salt)
-
-    for time_i in range(salt_nc.dims[cst.T_COORD]):
-
-        print(time_i)
+def open_density_inputs(
+    salt_file: str = cst.SALT_FILE, theta_file: str = cst.THETA_FILE
+) -> xr.Dataset:
+    """Lazily open SALT and THETA at every level, masked on land.
 
-        (density_da, _, _, _) = test_density_da(time_i=time_i, max_depth=0)
-
-        density_da = density_da.expand_dims(dim=cst.T_COORD, axis=None)
-
-        density_da = density_da.assign_coords(
-            {
-                cst.T_COORD: (
-                    cst.T_COORD,
-                    [salt_nc.isel(time=time_i).coords[cst.T_COORD].values],
-                )
-            }
-        )
-
-        density_da.coords[cst.T_COORD].attrs = salt_nc.coords[cst.T_COORD].attrs
-
-        density_da.to_netcdf("nc/rho/density_" + str(time_i) + ".nc", format="netcdf4")
-
-
-def merge_whole_density_netcdf() -> xr.DataArray:
-    """Merge whole density netcdf.
+    Args:
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
 
     Returns:
-        xr.DataArray: [description]
+        xr.Dataset: SALT and THETA, nothing read until a block is loaded.
     """
-
-    rho_da = xr.open_mfdataset(
-        "nc/rho/*.nc",
-        concat_dim="time",
-        combine="by_coords",
-        data_vars="minimal",
-        coords="minimal",
-        compat="override",
+    # a chunk per level, so that a block only reads its own levels.
+    return xvl.open_salt_theta(
+        max_depth=0,
+        min_depth=None,
+        chunks={cst.T_COORD: 1, cst.Z_COORD: 1},
+        salt_file=salt_file,
+        theta_file=theta_file,
     )
-    # this is too intense for memory
 
-    return rho_da
 
+def block_shape(
+    n_levels: int,
+    n_lat: int,
+    n_lon: int,
+    memory_budget: float = cst.DENSITY_MEMORY_BUDGET,
+    n_variables: int = 1,
+) -> Tuple[int, int]:
+    """Number of Z levels and latitudes of one month to work on at a time.
 
-def save_density_netcdf(rho_da: xr.DataArray) -> None:
-    """Passes in density datarray, saves it in a reasonable way.
+    Whole levels are taken while one fits in the budget, otherwise one
+    level is cut into bands of latitude.
 
     Args:
-        rho_da (xr.DataArray): [description]
-    """
-
-    xr.save_mfdataset([rho_da], ["nc/Density.nc"], format="NETCDF4")
+        n_levels (int): number of levels.
+        n_lat (int): number of latitudes.
+        n_lon (int): number of longitudes.
+        memory_budget (float, optional): bytes that one block may use.
+            Defaults to cst.DENSITY_MEMORY_BUDGET.
+        n_variables (int, optional): number of variables made.
+            Defaults to 1.
 
+    Returns:
+        Tuple[int, int]: levels and latitudes per block, each at least 1.
+    """
+    bytes_per_point = (DENSITY_ARRAYS_PER_LEVEL + n_variables - 1) * 8
+    bytes_per_level = bytes_per_point * n_lat * n_lon
+    if bytes_per_level <= memory_budget:
+        return min(n_levels, int(memory_budget // bytes_per_level)), n_lat
+    return 1, max(1, int(memory_budget // (bytes_per_point * n_lon)))
+
+
+def derived_block(
+    bsose_ds: xr.Dataset,
+    time_i: int,
+    z_slice: slice,
+    y_slice: slice = slice(None),
+    variables: Sequence[str] = DERIVED_VARIABLES,
+    dtypes: Dict[str, str] = None,
+    metrics: gmt.GridMetrics = None,
+) -> xr.Dataset:
+    """Derived variables on a block of levels and latitudes of one month.
+
+    SA, CT and density come straight from TEOS-10. The eastward and
+    northward gradients of density are in kg m-4, see `gmt.GridMetrics`.
+    Every block covers all the longitudes, so the longitude can wrap
+    around, and reads one latitude either side of `y_slice` (the halo), so
+    its northward gradient at the band edges is the same as on the whole
+    field.
 
-def reload_density_netcdf() -> xr.Dataset:
-    """Reload density netcdf.
+    Args:
+        bsose_ds (xr.Dataset): from `open_density_inputs`.
+        time_i (int): time index.
+        z_slice (slice): levels.
+        y_slice (slice, optional): latitudes, with a step of 1.
+            Defaults to slice(None), all of them.
+        variables (Sequence[str], optional): which of DERIVED_VARIABLES to
+            make. Defaults to all of them.
+        dtypes (Dict[str, str], optional): dtype of each variable. Defaults
+            to None, which uses `enc.VAR_DTYPES`.
+        metrics (gmt.GridMetrics, optional): of the whole grid of `bsose_ds`.
+            Defaults to None, which works them out.
 
     Returns:
-        xr.Dataset: open the density netcdf.
+        xr.Dataset: each variable (time, Z, YC, XC) with one time step.
     """
+    dtypes = dtypes or {}
+    n_lat = bsose_ds.sizes[cst.Y_COORD]
+    y_start, y_stop, _ = y_slice.indices(n_lat)
+    halo = slice(max(y_start - 1, 0), min(y_stop + 1, n_lat))
+    block = (
+        bsose_ds.isel({cst.T_COORD: time_i, cst.Z_COORD: z_slice, cst.Y_COORD: halo})
+        .transpose(cst.Z_COORD, cst.Y_COORD, cst.X_COORD)
+        .load()
+    )
+    fields = teos10_fields(
+        block.THETA.where(block.THETA != 0.0).values,
+        block.SALT.where(block.SALT != 0.0).values,
+        block.XC.values,
+        block.YC.values,
+        block.Z.values,
+    )
+    if {"x_grad", "y_grad"} & set(variables):
+        if metrics is None:
+            metrics = gmt.GridMetrics.from_grids(
+                bsose_ds.YC.values, bsose_ds.XC.values, cache_dir=None
+            )
+        block_metrics = metrics.isel_y(halo)
+        if "x_grad" in variables:
+            fields["x_grad"] = block_metrics.x_gradient(fields["Density"])
+        if "y_grad" in variables:
+            fields["y_grad"] = block_metrics.y_gradient(fields["Density"])
+    inner = slice(y_start - halo.start, y_stop - halo.start)
+    format_da = block.THETA.isel({cst.Y_COORD: inner})
+    data_vars = {}
+    for name in variables:
+        values = fields[name][:, inner].astype(
+            dtypes.get(name, enc.VAR_DTYPES[name]["dtype"])
+        )
+        data_vars[name] = (
+            create_known_dataarray(format_da, values, name)
+            .expand_dims(cst.T_COORD)
+            .assign_coords(
+                {cst.T_COORD: (cst.T_COORD, [block.coords[cst.T_COORD].values])}
+            )
+        )
+        data_vars[name].coords[cst.T_COORD].attrs = block.coords[cst.T_COORD].attrs
+    return xr.Dataset(data_vars)
 
-    return xr.open_dataset("nc/density.nc")
 
+def _init_density_worker(
+    salt_file: str, theta_file: str, metrics: gmt.GridMetrics = None
+) -> None:
+    """Open the inputs once in each worker process."""
+    par.set_worker_state(
+        {
+            "bsose_ds": open_density_inputs(salt_file=salt_file, theta_file=theta_file),
+            "metrics": metrics,
+        }
+    )
 
-def x_grad() -> None:
-    """
-    Save x grad.
-    """
-    density_da = xr.open_mfdataset("nc/density.nc", decode_cf=False).astype("float32")
-    grad_da = density_da.Density.differentiate(cst.X_COORD).astype("float32")
-    density_da["x_grad"] = grad_da
-    grad_ds = density_da.drop("Density").astype("float32")
-    xr.save_mfdataset([grad_ds], ["nc/density_grad_x.nc"], format="NETCDF4")
 
+def _derived_block_worker(
+    time_i: int,
+    z_slice: slice,
+    y_slice: slice,
+    variables: Sequence[str],
+    dtypes: Dict[str, str],
+) -> Tuple[int, slice, slice, xr.Dataset]:
+    """Run `derived_block` on the worker's inputs."""
+    return (
+        time_i,
+        z_slice,
+        y_slice,
+        derived_block(
+            par.worker_state("bsose_ds"),
+            time_i,
+            z_slice,
+            y_slice,
+            variables,
+            dtypes,
+            metrics=par.worker_state("metrics"),
+        ),
+    )
 
-def y_grad(set_ok: bool = False) -> None:
-    """Take y grad.
+
+@twr.timeit
+def create_derived_netcdf(
+    path: str = cst.DERIVED_FILE,
+    variables: Sequence[str] = DERIVED_VARIABLES,
+    dtypes: Dict[str, str] = None,
+    salt_file: str = cst.SALT_FILE,
+    theta_file: str = cst.THETA_FILE,
+    workers: int = cst.N_WORKERS,
+    memory_budget: float = cst.DENSITY_MEMORY_BUDGET,
+    months: Sequence[int] = None,
+    cache_dir: str = cst.METRICS_CACHE_DIR,
+) -> None:
+    """Make SA, CT, density and its horizontal gradients in one pass.
+
+    The record is cut into (time, Z, YC) blocks, each small enough for
+    `memory_budget`, and SALT and THETA are read once for each block (with
+    a one latitude halo, see `derived_block`). Every variable of a block is
+    worked out together and written straight into its region of one file,
+    so there is nothing to merge afterwards and the density is never read
+    back. The blocks are worked out on `workers` processes, and only this
+    process writes, in order, with at most two blocks per worker waiting.
 
     Args:
-        set (bool, optional): take y gradient of density. Defaults to False.
+        path (str, optional): file to make. Defaults to cst.DERIVED_FILE.
+        variables (Sequence[str], optional): which of DERIVED_VARIABLES to
+            make. Defaults to all of them.
+        dtypes (Dict[str, str], optional): dtype to store each variable in,
+            e.g. {"Density": "float64"}. Defaults to None, which uses
+            `enc.VAR_DTYPES`.
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
+        workers (int, optional): processes to run the blocks on. 1 runs them
+            in this process. Defaults to cst.N_WORKERS.
+        memory_budget (float, optional): bytes for each block.
+            Defaults to cst.DENSITY_MEMORY_BUDGET.
+        months (Sequence[int], optional): time indices to convert.
+            Defaults to None, the whole record.
+        cache_dir (str, optional): where to keep the grid metrics, None not
+            to keep them. Defaults to cst.METRICS_CACHE_DIR.
     """
-    density_da = xr.open_mfdataset(
-        "nc/density.nc", decode_cf=False, parallel=True
-    ).astype("float32")
-    grad_da = (
-        density_da.Density.astype("float32")
-        .differentiate(cst.Y_COORD)
-        .astype("float32")
+    variables = list(variables)
+    bsose_ds = open_density_inputs(salt_file=salt_file, theta_file=theta_file)
+    metrics = None
+    if {"x_grad", "y_grad"} & set(variables):
+        metrics = gmt.GridMetrics.from_grids(
+            bsose_ds.YC.values, bsose_ds.XC.values, cache_dir=cache_dir
+        )
+    if months is None:
+        months = range(bsose_ds.sizes[cst.T_COORD])
+    months = list(months)
+    n_levels, n_lat = bsose_ds.sizes[cst.Z_COORD], bsose_ds.sizes[cst.Y_COORD]
+    levels, rows = block_shape(
+        n_levels,
+        n_lat,
+        bsose_ds.sizes[cst.X_COORD],
+        memory_budget=memory_budget,
+        n_variables=len(variables),
     )
-    del density_da
-    if not set_ok:
-        grad_da.to_netcdf("nc/density_grad_y_da.nc", engine="netcdf4")
-    else:
-        grad_ds = grad_da.to_dataset().astype("float32")
-        # density_da['y_grad'] = grad_da
-        # grad_ds = density_da.drop('Density')
-        xr.save_mfdataset([grad_ds], ["nc/density_grad_y.nc"], format="NETCDF4")
-
-
-def take_derivative_density(
-    dimension: str = cst.Y_COORD, typ: str = "float32", engine: str = "h5netcdf"
+    blocks = [
+        (
+            time_i,
+            slice(z_start, min(z_start + levels, n_levels)),
+            slice(y_start, min(y_start + rows, n_lat)),
+        )
+        for time_i in months
+        for z_start in range(0, n_levels, levels)
+        for y_start in range(0, n_lat, rows)
+    ]
+    print("derived variables in", len(blocks), "blocks of", levels, "x", rows)
+
+    dtypes = dtypes or {}
+    template = xr.Dataset()
+    for name in variables:
+        template[name] = bsose_ds.THETA.isel({cst.T_COORD: months[:1]}).astype(
+            dtypes.get(name, enc.VAR_DTYPES[name]["dtype"])
+        )
+        template[name].attrs = dict(VAR_ATTRS[name])
+    # the chunking and compression of the policy, with the dtypes asked for.
+    encoding = enc.encoding_for(template, unlimited_dims=(cst.T_COORD,))
+    for name, dtype in dtypes.items():
+        encoding.setdefault(name, {})["dtype"] = dtype
+    sto.create_store(template, path, encoding=encoding)
+    store_index = {time_i: j for j, time_i in enumerate(months)}
+
+    def write_block(
+        time_i: int, z_slice: slice, y_slice: slice, ds: xr.Dataset
+    ) -> None:
+        sto.write_time_block(
+            ds,
+            path,
+            start=store_index[time_i],
+            region={cst.Z_COORD: z_slice, cst.Y_COORD: y_slice},
+        )
+
+    if workers <= 1:
+        for time_i, z_slice, y_slice in blocks:
+            write_block(
+                time_i,
+                z_slice,
+                y_slice,
+                derived_block(
+                    bsose_ds,
+                    time_i,
+                    z_slice,
+                    y_slice,
+                    variables,
+                    dtypes,
+                    metrics=metrics,
+                ),
+            )
+        return
+
+    pending = deque()
+    with par.spawn_pool(
+        workers, _init_density_worker, (salt_file, theta_file, metrics)
+    ) as executor:
+        for time_i, z_slice, y_slice in blocks:
+            pending.append(
+                executor.submit(
+                    _derived_block_worker,
+                    time_i,
+                    z_slice,
+                    y_slice,
+                    variables,
+                    dtypes,
+                )
+            )
+            if len(pending) >= 2 * workers:
+                write_block(*pending.popleft().result())
+        while pending:
+            write_block(*pending.popleft().result())
+
+
+def create_whole_density_netcdf(
+    path: str = cst.DENSITY_FILE,
+    salt_file: str = cst.SALT_FILE,
+    theta_file: str = cst.THETA_FILE,
+    workers: int = cst.N_WORKERS,
+    memory_budget: float = cst.DENSITY_MEMORY_BUDGET,
+    months: Sequence[int] = None,
 ) -> None:
-    """
-    Take derivative of density.
+    """Create density netcdf, see `create_derived_netcdf`.
 
     Args:
-        dimension (str, optional): [description]. Defaults to cst.Y_COORD.
-        typ (str, optional): [description]. Defaults to "float32".
-        engine (str, optional): [description]. Defaults to "h5netcdf".
+        path (str, optional): file to make. Defaults to cst.DENSITY_FILE.
+        salt_file (str, optional): Defaults to cst.SALT_FILE.
+        theta_file (str, optional): Defaults to cst.THETA_FILE.
+        workers (int, optional): processes to run the blocks on.
+            Defaults to cst.N_WORKERS.
+        memory_budget (float, optional): bytes for each block.
+            Defaults to cst.DENSITY_MEMORY_BUDGET.
+        months (Sequence[int], optional): time indices to convert.
+            Defaults to None, the whole record.
     """
-
-    chunk_d = {cst.T_COORD: 1, cst.Z_COORD: 52, cst.Y_COORD: 588, cst.X_COORD: 2160}
-
-    density_ds = xr.open_mfdataset(
-        "nc/density.nc",
-        # engine=engine,
-        # decode_cf=False,
-        chunks=chunk_d,
-        combine="by_coords",
-        data_vars="minimal",
-        coords="minimal",
-        compat="override",
-        engine=engine,
-        parallel=True,
-    ).astype(typ)
-
-    grad_da = density_ds.Density.differentiate(dimension)
-    # .astype(typ).chunk(chunks=chunk_d)
-
-    name = "Density_Gradient_" + dimension
-    grad_ds = grad_da.to_dataset().rename_vars({"Density": name})
-    grad_ds[name].attrs["long_name"] = "Density Gradient " + dimension
-    grad_ds[name].attrs["units"] = "kg m-3 box-1"
-
-    # .astype(typ).chunk(chunks=chunk_d)
-    xr.save_mfdataset(
-        [grad_ds], ["nc/density_grad_" + dimension + ".nc"], format="NETCDF4"
+    create_derived_netcdf(
+        path=path,
+        variables=["Density"],
+        salt_file=salt_file,
+        theta_file=theta_file,
+        workers=workers,
+        memory_budget=memory_budget,
+        months=months,
     )
+
+
+def reload_density_netcdf() -> xr.Dataset:
+    """Reload density netcdf.
+
+    Returns:
+        xr.Dataset: open the density netcdf.
+    """
+
+    return xr.open_dataset(cst.DENSITY_FILE)
@@ -0,0 +1,388 @@
+"""Lazily computed, memoized variables derived from BSOSE.
+
+Each derived variable declares the variables it is made from and a
+function that makes it from them. Asking a `Registry` for a variable on
+some indices, e.g. ``registry.get("Density", time=40, Z=slice(0, 10))``,
+reads and computes only that hyperslab, working through the inputs it
+needs (which are computed and kept in the same way), so density and CT
+asked for by different callers are only worked out once.
+
+- Results are kept in memory, the least recently used being dropped once
+  they are over `memory_budget` bytes.
+- With a `cache_dir` every result is also written there, keyed by the
+  source files, the variable and the indices, so that another process
+  (e.g. the figure scripts and an analysis notebook) reads it back rather
+  than computing it again (see `src.data_loading.cache`).
+- Variables that need their neighbours (the gradients) declare a halo:
+  their inputs are computed on the indices widened by that many points
+  (where the grid has them), and the result is cut back to the indices
+  asked for, so it matches the variable computed on the whole field.
+
+Example:
+    Usage::
+        import src.preprocessing.registry as reg
+        registry = reg.Registry.from_files()
+        density_da = registry.get("Density", time=40, Z=slice(0, 10))
+        # a trained model can be added in the same way.
+        registry.register(
+            "PCA_VALUES",
+            ("SALT", "THETA"),
+            lambda ds: model.dataset(ds, names=["PCA_VALUES"]).PCA_VALUES,
+        )
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, Sequence, Tuple, Union
+import numpy as np
+import gsw
+import xarray as xr
+import src.constants as cst
+import src.data_loading.cache as cch
+import src.data_loading.encoding as enc
+import src.data_loading.manifest as mfs
+import src.preprocessing.grid_metrics as gmt
+import src.preprocessing.gsw_transformations as gtr
+
+
+class DerivedVariable:
+    """How to make one variable from others."""
+
+    def __init__(
+        self,
+        name: str,
+        inputs: Sequence[str],
+        compute: Callable[[xr.Dataset], xr.DataArray],
+        halo: Dict[str, int] = None,
+    ) -> None:
+        """
+        Declare a variable.
+
+        Args:
+            name (str): variable name.
+            inputs (Sequence[str]): variables it is made from, either in the
+                source dataset or registered.
+            compute (Callable[[xr.Dataset], xr.DataArray]): makes it from a
+                dataset of its inputs, with the coordinates of the source.
+            halo (Dict[str, int], optional): points either side along each
+                dimension that it needs its inputs on. Defaults to None.
+        """
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.compute = compute
+        self.halo = halo or {}
+
+    def __repr__(self) -> str:
+        return "<DerivedVariable %s from (%s)>" % (self.name, ", ".join(self.inputs))
+
+
+def _masked(da: xr.DataArray) -> xr.DataArray:
+    """BSOSE fills the cells below the sea floor with 0."""
+    return da.where(da != 0.0)
+
+
+def _pressure(ds: xr.Dataset) -> xr.DataArray:
+    # pylint: disable=no-value-for-parameter
+    return gsw.p_from_z(ds.coords[cst.Z_COORD], ds.coords[cst.Y_COORD])
+
+
+def _absolute_salinity(ds: xr.Dataset) -> xr.DataArray:
+    return gsw.SA_from_SP(
+        _masked(ds.SALT), ds.Pressure, ds.coords[cst.X_COORD], ds.coords[cst.Y_COORD]
+    )
+
+
+def _conservative_temperature(ds: xr.Dataset) -> xr.DataArray:
+    return gsw.conversions.CT_from_pt(ds.SA, _masked(ds.THETA))
+
+
+def _density(ds: xr.Dataset) -> xr.DataArray:
+    return gsw.density.rho(ds.SA, ds.ct, ds.Pressure)
+
+
+def _density_gradient(ds: xr.Dataset, dim: str) -> xr.DataArray:
+    metrics = gmt.GridMetrics.from_grids(
+        ds.coords[cst.Y_COORD].values, ds.coords[cst.X_COORD].values, cache_dir=None
+    )
+    grid_dims = (cst.Y_COORD, cst.X_COORD)
+    other = [other_dim for other_dim in ds.Density.dims if other_dim not in grid_dims]
+    density = ds.Density.transpose(*other, *grid_dims)
+    gradient = metrics.x_gradient if dim == cst.X_COORD else metrics.y_gradient
+    return density.copy(data=gradient(density.values)).transpose(*ds.Density.dims)
+
+
+# the variables that every registry starts with, made from SALT and THETA.
+BSOSE_VARIABLES: Dict[str, DerivedVariable] = {
+    variable.name: variable
+    for variable in [
+        DerivedVariable("Pressure", (), _pressure),
+        DerivedVariable("SA", ("SALT", "Pressure"), _absolute_salinity),
+        DerivedVariable("ct", ("SA", "THETA"), _conservative_temperature),
+        DerivedVariable("Density", ("SA", "ct", "Pressure"), _density),
+        DerivedVariable(
+            "x_grad",
+            ("Density",),
+            lambda ds: _density_gradient(ds, cst.X_COORD),
+            halo={cst.X_COORD: 1},
+        ),
+        DerivedVariable(
+            "y_grad",
+            ("Density",),
+            lambda ds: _density_gradient(ds, cst.Y_COORD),
+            halo={cst.Y_COORD: 1},
+        ),
+    ]
+}
+
+
+class Registry:
+    """
+    Compute derived variables on demand, and remember them.
+
+    Example:
+        Usage::
+            registry = Registry.from_files(cache_dir=cst.REGISTRY_CACHE_DIR)
+            ct_da = registry.get("ct", time=40)
+    """
+
+    def __init__(
+        self,
+        source: xr.Dataset,
+        source_key: str = None,
+        memory_budget: float = cst.REGISTRY_MEMORY_BUDGET,
+        cache_dir: str = None,
+        cache_budget: float = cst.REGISTRY_CACHE_BUDGET,
+    ) -> None:
+        """
+        Start a registry with the BSOSE variables.
+
+        Args:
+            source (xr.Dataset): lazily opened variables to derive from, e.g.
+                from `gtr.open_density_inputs`.
+            source_key (str, optional): identifies `source` in the file
+                cache. Defaults to None, only allowed without a `cache_dir`.
+            memory_budget (float, optional): bytes of results to keep in
+                memory. Defaults to cst.REGISTRY_MEMORY_BUDGET.
+            cache_dir (str, optional): where to share results with other
+                processes, None not to. Defaults to None.
+            cache_budget (float, optional): bytes to keep in `cache_dir`.
+                Defaults to cst.REGISTRY_CACHE_BUDGET.
+        """
+        if cache_dir is not None and source_key is None:
+            raise ValueError("A source_key is needed to keep results in a cache_dir.")
+        self.source = source
+        self.source_key = source_key
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
+        self.cache_budget = cache_budget
+        self.variables: Dict[str, DerivedVariable] = dict(BSOSE_VARIABLES)
+        self._memory: "OrderedDict[tuple, xr.DataArray]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self) -> str:
+        return "<Registry %i variables, %i results, %.1f MB>" % (
+            len(self.variables),
+            len(self._memory),
+            self.nbytes / 1e6,
+        )
+
+    @classmethod
+    def from_files(
+        cls,
+        salt_file: str = cst.SALT_FILE,
+        theta_file: str = cst.THETA_FILE,
+        memory_budget: float = cst.REGISTRY_MEMORY_BUDGET,
+        cache_dir: str = None,
+        cache_budget: float = cst.REGISTRY_CACHE_BUDGET,
+    ) -> "Registry":
+        """
+        A registry over the BSOSE SALT and THETA files.
+
+        Args:
+            salt_file (str, optional): Defaults to cst.SALT_FILE.
+            theta_file (str, optional): Defaults to cst.THETA_FILE.
+            memory_budget (float, optional): bytes of results to keep in
+                memory. Defaults to cst.REGISTRY_MEMORY_BUDGET.
+            cache_dir (str, optional): where to share results with other
+                processes, e.g. cst.REGISTRY_CACHE_DIR, None not to.
+                Defaults to None.
+            cache_budget (float, optional): bytes to keep in `cache_dir`.
+                Defaults to cst.REGISTRY_CACHE_BUDGET.
+
+        Returns:
+            Registry: with the BSOSE variables.
+        """
+        return cls(
+            gtr.open_density_inputs(salt_file=salt_file, theta_file=theta_file),
+            source_key=mfs.hash_files([salt_file, theta_file]),
+            memory_budget=memory_budget,
+            cache_dir=cache_dir,
+            cache_budget=cache_budget,
+        )
+
+    def register(
+        self,
+        name: str,
+        inputs: Sequence[str],
+        compute: Callable[[xr.Dataset], xr.DataArray],
+        halo: Dict[str, int] = None,
+    ) -> None:
+        """
+        Add a variable, or replace one, forgetting what was made from it.
+
+        Args:
+            name (str): variable name.
+            inputs (Sequence[str]): variables it is made from.
+            compute (Callable[[xr.Dataset], xr.DataArray]): see
+                `DerivedVariable`.
+            halo (Dict[str, int], optional): see `DerivedVariable`.
+                Defaults to None.
+        """
+        self.variables[name] = DerivedVariable(name, inputs, compute, halo=halo)
+        self.clear()
+
+    def clear(self) -> None:
+        """Forget the results held in memory."""
+        self._memory.clear()
+        self.nbytes = 0
+
+    def selection(self, **indices: Union[int, slice, Sequence[int]]) -> Dict:
+        """
+        Indices along every dimension of the source, in one form.
+
+        Args:
+            **indices: `isel` style index for some dimensions. The others
+                are taken whole.
+
+        Returns:
+            Dict: an int, a slice with start, stop and step, or a tuple of
+                ints, for each dimension.
+        """
+        unknown = set(indices) - set(self.source.dims)
+        if unknown:
+            raise KeyError(", ".join(sorted(unknown)) + " not in the source.")
+        selection = {}
+        for dim, size in self.source.sizes.items():
+            index = indices.get(dim, slice(None))
+            if isinstance(index, slice):
+                index = slice(*index.indices(size))
+            elif np.ndim(index) == 0:
+                index = int(index) % size
+            else:
+                index = tuple(int(i) % size for i in index)
+            selection[dim] = index
+        return selection
+
+    def get(
+        self, name: str, **indices: Union[int, slice, Sequence[int]]
+    ) -> xr.DataArray:
+        """
+        A variable on some indices of the source, computed if it has to be.
+
+        Args:
+            name (str): a source or registered variable.
+            **indices: `isel` style index for some dimensions, e.g.
+                time=40, Z=slice(0, 10). The others are taken whole.
+
+        Returns:
+            xr.DataArray: loaded into memory. It is shared with later calls,
+                so copy it before changing it.
+        """
+        return self._get(name, self.selection(**indices))
+
+    def _get(self, name: str, selection: Dict) -> xr.DataArray:
+        """`get` with the indices from `selection`."""
+        key = _key(name, selection)
+        if key in self._memory:
+            self.hits += 1
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        self.misses += 1
+        path = self._cache_path(name, key)
+        if path is not None and cch.has_entry(path):
+            with xr.open_dataset(path) as cached_ds:
+                da = cached_ds[name].load()
+        else:
+            da = self._compute(name, selection)
+            if path is not None:
+                with cch.writing(path, budget=self.cache_budget) as tmp_path:
+                    enc.to_netcdf(da.to_dataset(name=name), tmp_path)
+        self._remember(key, da)
+        return da
+
+    def _compute(self, name: str, selection: Dict) -> xr.DataArray:
+        """Read a source variable, or make a registered one from its inputs."""
+        if name in self.variables:
+            variable = self.variables[name]
+            wide, inner = _widen(selection, variable.halo, self.source.sizes)
+            inputs_ds = self.source.drop_vars(list(self.source.data_vars)).isel(wide)
+            for input_name in variable.inputs:
+                inputs_ds[input_name] = self._get(input_name, wide)
+            da = variable.compute(inputs_ds)
+            da = da.isel({dim: index for dim, index in inner.items() if dim in da.dims})
+            if name in gtr.VAR_ATTRS:
+                da.attrs = dict(gtr.VAR_ATTRS[name])
+            return da.rename(name).load()
+        if name in self.source.data_vars:
+            return self.source[name].isel(selection).load()
+        raise KeyError(name + " is neither in the source nor registered.")
+
+    def _remember(self, key: tuple, da: xr.DataArray) -> None:
+        """Keep a result, dropping the least recently used to fit the budget."""
+        if da.nbytes > self.memory_budget:
+            return
+        self._memory[key] = da
+        self.nbytes += da.nbytes
+        while self.nbytes > self.memory_budget:
+            _, old = self._memory.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def _cache_path(self, name: str, key: tuple) -> str:
+        """File name of a result in the file cache, None without one."""
+        if self.cache_dir is None:
+            return None
+        return cch.entry_path(
+            "derived-" + name,
+            {"source": self.source_key, "key": repr(key)},
+            cache_dir=self.cache_dir,
+        )
+
+
+def _key(name: str, selection: Dict) -> tuple:
+    """Hashable key for a variable on a selection."""
+    return (name,) + tuple(
+        (
+            (dim, (index.start, index.stop, index.step))
+            if isinstance(index, slice)
+            else (dim, index)
+        )
+        for dim, index in sorted(selection.items())
+    )
+
+
+def _widen(
+    selection: Dict, halo: Dict[str, int], sizes: Dict[str, int]
+) -> Tuple[Dict, Dict]:
+    """Widen the slices of a selection by a halo, as far as the grid goes.
+
+    Args:
+        selection (Dict): from `Registry.selection`.
+        halo (Dict[str, int]): points to add either side of each dimension.
+        sizes (Dict[str, int]): size of each dimension.
+
+    Returns:
+        Tuple[Dict, Dict]: the widened selection, and the slice of it that is
+            the original selection.
+    """
+    wide, inner = dict(selection), {}
+    for dim, points in halo.items():
+        index = selection.get(dim)
+        if not isinstance(index, slice) or index.step < 0 or points <= 0:
+            continue
+        n_points = len(range(index.start, index.stop, index.step))
+        before = min(points, index.start // index.step)
+        start = index.start - before * index.step
+        stop = min(index.start + (n_points + points) * index.step, sizes[dim])
+        wide[dim] = slice(start, stop, index.step)
+        inner[dim] = slice(before, before + n_points)
+    return wide, inner
@@ -0,0 +1,409 @@
+"""Horizontal regridding with precomputed sparse weights.
+
+BSOSE and all the target grids here are rectilinear (1D latitudes and 1D
+longitudes), so both bilinear and conservative regridding are separable:
+the weights are one sparse matrix along YC and one along XC, and a field
+is regridded by applying the two in turn to every level and month at once.
+The weights are built once for each pair of grids and kept on disk in
+cst.REGRID_CACHE_DIR under a hash of the grids and the method.
+
+- "bilinear" gives the same values as `ds.interp(YC=..., XC=...)`, NaN
+  where any of the cells around the target point that it uses is NaN.
+  (`interp` also gives NaN on a source row or column next to a NaN that
+  has no weight there.)
+- "conservative" averages the source cells overlapping each target cell,
+  weighted by their overlapping area and ignoring NaN cells, which is what
+  is wanted for statistics on an equal-area grid.
+
+Example:
+    Usage::
+        import src.preprocessing.regrid as rgd
+        lats_new, lons_new = rgd.coarse_grid(both_nc, mult_fact=2)
+        regridder = rgd.Regridder.from_grids(
+            both_nc.YC.values, both_nc.XC.values, lats_new, lons_new
+        )
+        ds = regridder(both_nc)
+"""
+from typing import Tuple, Union
+import numpy as np
+import scipy.sparse as sparse
+import xarray as xr
+import src.constants as cst
+import src.data_loading.cache as cch
+import src.data_loading.manifest as mfs
+
+METHODS: tuple = ("bilinear", "conservative")
+
+
+def linear_weights(src: np.ndarray, dst: np.ndarray) -> sparse.csr_matrix:
+    """1D linear interpolation from `src` points to `dst` points.
+
+    Args:
+        src (np.ndarray): source coordinates, in either order.
+        dst (np.ndarray): target coordinates.
+
+    Returns:
+        sparse.csr_matrix: (len(dst), len(src)), with an empty row for
+            targets outside the source range.
+    """
+    src = np.asarray(src, dtype="float64")
+    dst = np.asarray(dst, dtype="float64")
+    order = np.argsort(src)
+    src_sorted = src[order]
+    inside = np.nonzero((dst >= src_sorted[0]) & (dst <= src_sorted[-1]))[0]
+    upper = np.clip(
+        np.searchsorted(src_sorted, dst[inside], side="left"), 1, len(src) - 1
+    )
+    lower = upper - 1
+    weight = (dst[inside] - src_sorted[lower]) / (src_sorted[upper] - src_sorted[lower])
+    rows = np.concatenate([inside, inside])
+    cols = order[np.concatenate([lower, upper])]
+    values = np.concatenate([1 - weight, weight])
+    keep = values != 0
+    return sparse.csr_matrix(
+        (values[keep], (rows[keep], cols[keep])), shape=(len(dst), len(src))
+    )
+
+
+def cell_bounds(centres: np.ndarray) -> np.ndarray:
+    """Cell edges halfway between the centres, extended at either end.
+
+    Args:
+        centres (np.ndarray): increasing cell centres.
+
+    Returns:
+        np.ndarray: len(centres) + 1 edges.
+    """
+    centres = np.asarray(centres, dtype="float64")
+    mids = (centres[1:] + centres[:-1]) / 2
+    return np.concatenate(
+        [[2 * centres[0] - mids[0]], mids, [2 * centres[-1] - mids[-1]]]
+    )
+
+
+def overlap_weights(
+    src: np.ndarray, dst: np.ndarray, latitude: bool = False
+) -> sparse.csr_matrix:
+    """1D conservative weights, the overlap of each target cell with each source cell.
+
+    Args:
+        src (np.ndarray): increasing source cell centres.
+        dst (np.ndarray): increasing target cell centres.
+        latitude (bool, optional): measure lengths in sin(latitude), so that
+            the product with longitude overlaps is proportional to area.
+            Defaults to False.
+
+    Returns:
+        sparse.csr_matrix: (len(dst), len(src)), each row summing to 1 where
+            the target cell overlaps the source grid.
+    """
+    src_edges = cell_bounds(src)
+    dst_edges = cell_bounds(dst)
+    if latitude:
+        src_edges = np.sin(np.radians(np.clip(src_edges, -90, 90)))
+        dst_edges = np.sin(np.radians(np.clip(dst_edges, -90, 90)))
+    # the source cells that each target cell can touch.
+    first = np.clip(
+        np.searchsorted(src_edges, dst_edges[:-1], side="right") - 1, 0, None
+    )
+    last = np.clip(
+        np.searchsorted(src_edges, dst_edges[1:], side="left"), None, len(src)
+    )
+    rows = np.repeat(np.arange(len(dst)), last - first)
+    cols = np.concatenate(
+        [np.arange(start, stop) for start, stop in zip(first, last)]
+    ).astype("int64")
+    overlap = np.minimum(dst_edges[rows + 1], src_edges[cols + 1]) - np.maximum(
+        dst_edges[rows], src_edges[cols]
+    )
+    keep = overlap > 0
+    weights = sparse.csr_matrix(
+        (overlap[keep], (rows[keep], cols[keep])), shape=(len(dst), len(src))
+    )
+    totals = np.asarray(weights.sum(axis=1)).ravel()
+    with np.errstate(divide="ignore"):
+        scale = np.where(totals > 0, 1 / totals, 0.0)
+    return sparse.diags(scale) @ weights
+
+
+def equal_area_grid(
+    lat_min: float, lat_max: float, n_lat: int, n_lon: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """A global grid whose cells all have the same area.
+
+    Args:
+        lat_min (float): southern edge (degrees).
+        lat_max (float): northern edge (degrees).
+        n_lat (int): number of latitudes, evenly spaced in sin(latitude).
+        n_lon (int): number of longitudes, evenly spaced over 0 to 360.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: latitude and longitude cell centres.
+    """
+    sin_edges = np.linspace(
+        np.sin(np.radians(lat_min)), np.sin(np.radians(lat_max)), n_lat + 1
+    )
+    lats = np.degrees(np.arcsin((sin_edges[1:] + sin_edges[:-1]) / 2))
+    lons = (np.arange(n_lon) + 0.5) * 360.0 / n_lon
+    return lats, lons
+
+
+def coarse_grid(ds: xr.Dataset, mult_fact: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """The coarser grid that the pcm is trained on.
+
+    Args:
+        ds (xr.Dataset): dataset on the BSOSE grid.
+        mult_fact (int, optional): 60 * mult_fact latitudes and 4 times as
+            many longitudes, spanning the BSOSE grid. Defaults to 2.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: latitudes and longitudes.
+    """
+    lons_new = np.linspace(ds.XC.min(), ds.XC.max(), 60 * 4 * mult_fact)
+    lats_new = np.linspace(ds.YC.min(), ds.YC.max(), 60 * mult_fact)
+    return lats_new, lons_new
+
+
+class Regridder:
+    """
+    Regrid from one rectilinear grid to another with sparse weights.
+
+    Example:
+        Usage::
+            regridder = Regridder.from_grids(src_lats, src_lons, lats, lons)
+            ds_new = regridder(ds)
+    """
+
+    def __init__(
+        self,
+        weights_y: sparse.csr_matrix,
+        weights_x: sparse.csr_matrix,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        method: str = "bilinear",
+    ) -> None:
+        """
+        Wrap the weights.
+
+        Args:
+            weights_y (sparse.csr_matrix): (target YC, source YC) weights.
+            weights_x (sparse.csr_matrix): (target XC, source XC) weights.
+            lats (np.ndarray): target latitudes.
+            lons (np.ndarray): target longitudes.
+            method (str, optional): "bilinear" or "conservative".
+                Defaults to "bilinear".
+        """
+        if method not in METHODS:
+            raise ValueError(method + " is not one of " + ", ".join(METHODS))
+        self.weights_y = weights_y.tocsr()
+        self.weights_x = weights_x.tocsr()
+        self.lats = np.asarray(lats)
+        self.lons = np.asarray(lons)
+        self.method = method
+        # target rows that no source point reaches are NaN.
+        self.outside_y = np.asarray(self.weights_y.sum(axis=1)).ravel() == 0
+        self.outside_x = np.asarray(self.weights_x.sum(axis=1)).ravel() == 0
+
+    def __repr__(self) -> str:
+        return "<Regridder %s (%i, %i) -> (%i, %i)>" % (
+            self.method,
+            self.weights_y.shape[1],
+            self.weights_x.shape[1],
+            len(self.lats),
+            len(self.lons),
+        )
+
+    @classmethod
+    def from_grids(
+        cls,
+        src_lats: np.ndarray,
+        src_lons: np.ndarray,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        method: str = "bilinear",
+        cache_dir: str = cst.REGRID_CACHE_DIR,
+    ) -> "Regridder":
+        """
+        Load the weights between two grids, or build and save them.
+
+        Args:
+            src_lats (np.ndarray): source latitudes.
+            src_lons (np.ndarray): source longitudes.
+            lats (np.ndarray): target latitudes.
+            lons (np.ndarray): target longitudes.
+            method (str, optional): "bilinear" or "conservative".
+                Defaults to "bilinear".
+            cache_dir (str, optional): where to keep the weights, None not
+                to keep them. Defaults to cst.REGRID_CACHE_DIR.
+
+        Returns:
+            Regridder: for these grids.
+        """
+        grids = [
+            np.asarray(grid, dtype="float64")
+            for grid in [src_lats, src_lons, lats, lons]
+        ]
+        path = None
+        if cache_dir is not None:
+            path = cch.entry_path(
+                "regrid-" + method,
+                {"method": method, "grids": mfs.hash_state(*grids)},
+                cache_dir=cache_dir,
+                suffix=".npz",
+            )
+            if cch.has_entry(path):
+                return cls.load(path)
+        if method == "bilinear":
+            weights_y = linear_weights(grids[0], grids[2])
+            weights_x = linear_weights(grids[1], grids[3])
+        elif method == "conservative":
+            weights_y = overlap_weights(grids[0], grids[2], latitude=True)
+            weights_x = overlap_weights(grids[1], grids[3])
+        else:
+            raise ValueError(method + " is not one of " + ", ".join(METHODS))
+        regridder = cls(weights_y, weights_x, grids[2], grids[3], method=method)
+        if path is not None:
+            with cch.writing(path) as tmp_path:
+                regridder.save(tmp_path)
+        return regridder
+
+    def save(self, path: str) -> None:
+        """
+        Save the weights to an `.npz` file.
+
+        Args:
+            path (str): file name.
+        """
+        arrays = {"lats": self.lats, "lons": self.lons, "method": np.array(self.method)}
+        for name, weights in [("y", self.weights_y), ("x", self.weights_x)]:
+            arrays.update(
+                {
+                    name + "_data": weights.data,
+                    name + "_indices": weights.indices,
+                    name + "_indptr": weights.indptr,
+                    name + "_shape": np.array(weights.shape),
+                }
+            )
+        with open(path, "wb") as npz_file:
+            np.savez(npz_file, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "Regridder":
+        """
+        Load weights saved by `save`.
+
+        Args:
+            path (str): file name.
+
+        Returns:
+            Regridder: with those weights.
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            weights = {
+                name: sparse.csr_matrix(
+                    (
+                        npz[name + "_data"],
+                        npz[name + "_indices"],
+                        npz[name + "_indptr"],
+                    ),
+                    shape=tuple(npz[name + "_shape"]),
+                )
+                for name in ["y", "x"]
+            }
+            return cls(
+                weights["y"],
+                weights["x"],
+                npz["lats"],
+                npz["lons"],
+                method=str(npz["method"]),
+            )
+
+    def regrid_values(self, values: np.ndarray) -> np.ndarray:
+        """
+        Regrid an array whose last two axes are (YC, XC).
+
+        Args:
+            values (np.ndarray): (..., YC, XC) on the source grid.
+
+        Returns:
+            np.ndarray: (..., lats, lons), float32 for float32 input and
+                float64 otherwise.
+        """
+        dtype = np.float32 if values.dtype == np.float32 else np.float64
+        lead = values.shape[:-2]
+        n_y, n_x = values.shape[-2:]
+        values = values.reshape(-1, n_y, n_x)
+        if self.method == "conservative":
+            # average over the defined cells only.
+            defined = np.isfinite(values).astype(dtype)
+            values = self._apply(np.where(defined > 0, values, 0).astype(dtype))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values = values / self._apply(defined)
+        else:
+            values = self._apply(values.astype(dtype, copy=False))
+        values[:, self.outside_y, :] = np.nan
+        values[:, :, self.outside_x] = np.nan
+        return values.reshape(*lead, len(self.lats), len(self.lons))
+
+    def _apply(self, values: np.ndarray) -> np.ndarray:
+        """Apply the XC weights, then the YC weights, to (n, YC, XC) values."""
+        n_fields, n_y, n_x = values.shape
+        weights_x = self.weights_x.astype(values.dtype)
+        weights_y = self.weights_y.astype(values.dtype)
+        along_x = (weights_x @ values.reshape(-1, n_x).T).T
+        along_x = along_x.reshape(n_fields, n_y, -1).transpose(1, 0, 2)
+        along_y = weights_y @ along_x.reshape(n_y, -1)
+        return np.ascontiguousarray(
+            along_y.reshape(len(self.lats), n_fields, -1).transpose(1, 0, 2)
+        )
+
+    def __call__(
+        self, data: Union[xr.Dataset, xr.DataArray]
+    ) -> Union[xr.Dataset, xr.DataArray]:
+        """
+        Regrid every variable that has both YC and XC.
+
+        Each variable is read and regridded one step of its first other
+        dimension (e.g. one month) at a time, so only the regridded fields
+        are held whole.
+
+        Args:
+            data (Union[xr.Dataset, xr.DataArray]): on the source grid.
+
+        Returns:
+            Union[xr.Dataset, xr.DataArray]: on the target grid, with the
+                same dimension order.
+        """
+        if isinstance(data, xr.DataArray):
+            return self(data.to_dataset(name="_regrid"))["_regrid"].rename(data.name)
+        grid_dims = (cst.Y_COORD, cst.X_COORD)
+        new_vars = {}
+        for name, var in data.variables.items():
+            if name in grid_dims or not set(grid_dims) <= set(var.dims):
+                continue
+            other = [dim for dim in var.dims if dim not in grid_dims]
+            var_t = var.transpose(*other, *grid_dims)
+            shape = var_t.shape[:-2] + (len(self.lats), len(self.lons))
+            out = np.empty(
+                shape, dtype=np.float32 if var.dtype == np.float32 else np.float64
+            )
+            if other and var_t.ndim > 3:
+                for i in range(var_t.shape[0]):
+                    out[i] = self.regrid_values(np.asarray(var_t[i].values))
+            else:
+                out[...] = self.regrid_values(np.asarray(var_t.values))
+            new_vars[name] = xr.Variable(
+                (*other, *grid_dims), out, attrs=var.attrs
+            ).transpose(*var.dims)
+        ds = data.drop_vars(list(new_vars)).drop_dims(list(grid_dims))
+        coords = {
+            cst.Y_COORD: (cst.Y_COORD, self.lats, data[cst.Y_COORD].attrs),
+            cst.X_COORD: (cst.X_COORD, self.lons, data[cst.X_COORD].attrs),
+        }
+        ds = ds.assign_coords(coords)
+        for name, var in new_vars.items():
+            if name in data.coords:
+                ds = ds.assign_coords({name: var})
+            else:
+                ds[name] = var
+        return ds[list(data.data_vars)]
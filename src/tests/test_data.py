@@ -1,10 +1,108 @@
 """Test data loading scripts."""
+import os
+import tempfile
 import unittest
+import numpy as np
+import xarray as xr
+import src.data_loading.synthetic as syn
+import src.data_loading.store as sto
+import src.data_loading.encoding as enc
+import src.data_loading.cache as cch
+import src.data_loading.xr_loader as xvl
+import src.data_loading.sampling as smp
+import src.data_loading.io_names as io
 
 
 class TestCase(unittest.TestCase):
     def test_upper(self):
         self.assertEqual("foo".upper(), "FOO")
 
+    def test_write_time_block(self):
+        ds = syn.make_i_metric_dataset(time=5, yc=4, xc=6)
+        with tempfile.TemporaryDirectory() as direc:
+            path = os.path.join(direc, "store.nc")
+            sto.write_time_block(ds.isel(time=slice(0, 2)), path)
+            sto.write_time_block(ds.isel(time=4), path, start=4)
+            self.assertEqual(sto.time_length(path), 5)
+            sto.write_time_block(ds.isel(time=slice(2, 4)), path, start=2)
+            with xr.open_dataset(path) as reloaded:
+                # IMETRIC is stored as float32 by the encoding policy.
+                xr.testing.assert_identical(
+                    ds.assign(IMETRIC=ds.IMETRIC.astype("float32")), reloaded.load()
+                )
+
+    def test_encoding_access(self):
+        ds = syn.make_i_metric_dataset(time=4, yc=30, xc=50)
+        with tempfile.TemporaryDirectory() as direc:
+            for access, chunks in [
+                ("time_slice", [1, 1, 30, 50]),
+                ("point_series", [4, 1, 24, 24]),
+            ]:
+                path = os.path.join(direc, access + ".nc")
+                enc.to_netcdf(ds, path, access=access)
+                with xr.open_dataset(path) as reloaded:
+                    self.assertEqual(reloaded.A_B.encoding["dtype"], np.int8)
+                    self.assertEqual(
+                        list(reloaded.IMETRIC.encoding["chunksizes"]), chunks
+                    )
+                    xr.testing.assert_equal(ds.A_B, reloaded.A_B)
+                    np.testing.assert_allclose(ds.IMETRIC, reloaded.IMETRIC, rtol=1e-6)
+
+    def test_cache_lru(self):
+        with tempfile.TemporaryDirectory() as direc:
+            paths = [
+                cch.entry_path("interp", {"time_i": time_i}, cache_dir=direc)
+                for time_i in range(3)
+            ]
+            self.assertEqual(len(set(paths)), 3)
+            for path in paths[:2]:
+                with cch.writing(path, budget=1000) as tmp_path:
+                    with open(tmp_path, "wb") as file:
+                        file.write(bytes(400))
+            # use the first entry, so the second is now the oldest.
+            os.utime(paths[1], (0, 0))
+            self.assertTrue(cch.has_entry(paths[0]))
+            with cch.writing(paths[2], budget=1000) as tmp_path:
+                with open(tmp_path, "wb") as file:
+                    file.write(bytes(400))
+            self.assertEqual(
+                [os.path.isfile(path) for path in paths], [True, False, True]
+            )
+
+    def test_depth_band(self):
+        z_values = -np.arange(50.0, 3000.0, 100.0)
+        band = xvl.depth_band(z_values, min_depth=300, max_depth=2000)
+        depths = -z_values[band]
+        self.assertEqual((depths[0], depths[-1]), (250.0, 2050.0))
+        self.assertEqual(xvl.depth_band(z_values, 0, 5000), slice(0, len(z_values)))
+
+    def test_stratified_sample(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=4, yc=40, xc=60)
+            area = xr.open_dataset(salt_file)["rA"].load()
+            ds = xvl.open_salt_theta(salt_file=salt_file, theta_file=theta_file)
+            ds = ds.load()
+        sample = smp.stratified_sample(ds, 400, band_width=10, area=area)
+        self.assertEqual(sample.sizes[smp.SAMPLE_DIM], 400)
+        self.assertTrue(np.all(np.isfinite(sample.SALT.values)))
+        points = set(zip(sample.time.values, sample.YC.values, sample.XC.values))
+        self.assertEqual(len(points), 400)
+        # the same number from each month, as each has the same ocean.
+        _, per_month = np.unique(sample.time.values, return_counts=True)
+        self.assertEqual(list(per_month), [100] * 4)
+        xr.testing.assert_identical(
+            sample, smp.stratified_sample(ds, 400, band_width=10, area=area)
+        )
+        self.assertEqual(
+            list(smp.allocate([1, 2, 3, 0], [100, 1, 100, 5], 50)), [13, 1, 36, 0]
+        )
+
+    def test_pair_name_threshold(self):
+        # pylint: disable=protected-access
+        default = io._return_pair_name(5, 3)
+        self.assertEqual(default, io._return_pair_name(5, 3, threshold=0.05))
+        self.assertNotEqual(default, io._return_pair_name(5, 3, threshold=0.3))
+        self.assertTrue(io._return_pair_name(5, 3, threshold=0.3).endswith("-0.3"))
+
 
 suite = unittest.TestLoader().loadTestsFromTestCase(TestCase)
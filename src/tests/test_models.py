@@ -1,5 +1,164 @@
 """Test models scripts."""
+import os
+import copy
+import tempfile
 import unittest
+import multiprocessing
+from typing import Tuple
+import numpy as np
+import xarray as xr
+from sklearn.decomposition import PCA
+from sklearn.mixture import GaussianMixture
+from sklearn.preprocessing import StandardScaler
+import pyxpcm
+import src.constants as cst
+import src.data_loading.synthetic as syn
+import src.data_loading.manifest as mfs
+import src.data_loading.store as sto
+import src.data_loading.xr_loader as xvl
+import src.models.make_pair_metric as tpi
+import src.models.pcm_io as pio
+import src.models.labels as lab
+import src.models.stream_train as stt
+import src.models.inference as inf
+import src.models.ensemble as ens
+import src.models.select_k as sk
+import src.models.convergence as cvg
+import src.models.batch_i_metric as bim
+import src.models.train_pyxpcm as tim
+
+
+def _pyxpcm_works() -> bool:
+    """Whether the pyxpcm installed can make a pcm object with this numpy."""
+    try:
+        tim.make_pcm(k_clusters=2)
+    except AttributeError:
+        # PyPI pyxpcm 0.4.1 uses np.int, which numpy 1.24 removed.
+        return False
+    return True
+
+
+PYXPCM_WORKS = _pyxpcm_works()
+# the pyxpcm fork the pcm objects are trained with, which adds find_i_metric,
+# add_pca_to_xarray and separate_pca to pyxpcm.
+PYXPCM_FORK = hasattr(pyxpcm.pcm, "find_i_metric")
+
+
+def _permuted(classifier: GaussianMixture, order: list) -> GaussianMixture:
+    """A copy of a fitted mixture with its classes numbered in another order."""
+    permuted = copy.deepcopy(classifier)
+    for name in [
+        "weights_",
+        "means_",
+        "covariances_",
+        "precisions_",
+        "precisions_cholesky_",
+    ]:
+        setattr(permuted, name, getattr(classifier, name)[order])
+    return permuted
+
+
+def _synthetic_inference(
+    salt_file: str, theta_file: str, k_clusters: int = 3, order: list = None
+) -> inf.Inference:
+    """Fit a small model with a joint PCA on the first synthetic month.
+
+    With order, the classes are numbered in that order instead.
+    """
+    ds = xvl.open_salt_theta(time_i=0, salt_file=salt_file, theta_file=theta_file)
+    ds = ds.load()
+    axis = np.arange(-cst.MIN_DEPTH, -cst.MAX_DEPTH, -10.0)
+    axes, scalers, scaled = {}, {}, []
+    for feature in ["SALT", "THETA"]:
+        values = (
+            ds[feature].stack(profile=(cst.Y_COORD, cst.X_COORD)).transpose().values
+        )
+        values = values[np.all(np.isfinite(values), axis=1)]
+        interp = np.stack([np.interp(axis, ds.Z.values[::-1], v[::-1]) for v in values])
+        axes[feature] = axis
+        scalers[feature] = StandardScaler().fit(interp)
+        scaled.append(scalers[feature].transform(interp))
+    scaled = np.concatenate(scaled, axis=1)
+    reducer = PCA(n_components=2).fit(scaled)
+    classifier = GaussianMixture(n_components=k_clusters, random_state=0).fit(
+        reducer.transform(scaled)
+    )
+    if order is not None:
+        classifier = _permuted(classifier, order)
+    return inf.Inference(axes, scalers, {"joint": reducer}, {}, classifier)
+
+
+def _synthetic_pcm(direc: str) -> Tuple[pyxpcm.pcm, xr.Dataset, dict]:
+    """Fit a pcm object on one month of synthetic BSOSE files."""
+    salt_file, theta_file = syn.make_bsose_files(direc, time=1, yc=20, xc=40)
+    ds = xvl.open_salt_theta(time_i=0, salt_file=salt_file, theta_file=theta_file)
+    ds = ds.load()
+    config = tim.pcm_config(
+        k_clusters=3,
+        maxvar=2,
+        n_samples=None,
+        salt_file=salt_file,
+        theta_file=theta_file,
+    )
+    pcm_object = tim.make_pcm(**config["pcm"])
+    pcm_object.fit(ds, features=cst.FEATURES_D, dim=cst.Z_COORD)
+    return pcm_object, ds, config
+
+
+def _pcm_outputs(pcm_object: pyxpcm.pcm, ds: xr.Dataset) -> Tuple[np.ndarray, ...]:
+    """Labels and probabilities of the profiles, as `pcm.predict` finds them.
+
+    Without pcm.predict's check_is_fitted, which PyPI pyxpcm fails with
+    recent sklearn.
+    """
+    x_values = sk.transformed_features(pcm_object, ds)
+    # pylint: disable=protected-access
+    return (
+        pcm_object._classifier.predict(x_values),
+        pcm_object._classifier.predict_proba(x_values),
+    )
+
+
+def _run_synthetic_months(
+    files: tuple,
+    pcm_dict: dict,
+    resume: bool = True,
+    kill_at: int = None,
+) -> list:
+    """Run the batch on 6 synthetic months, dying once month kill_at is written."""
+    salt_file, theta_file, direc = files
+    if kill_at is not None:
+        mark_done = mfs.Manifest.mark_done
+
+        def mark_or_die(manifest, k_clusters, pca, time_i, model, inputs):
+            if time_i == kill_at:
+                os._exit(1)
+            mark_done(manifest, k_clusters, pca, time_i, model, inputs)
+
+        mfs.Manifest.mark_done = mark_or_die
+    return bim.run_months(
+        pcm_dict,
+        pca=2,
+        workers=1,
+        resume=resume,
+        months=range(6),
+        salt_file=salt_file,
+        theta_file=theta_file,
+        store_paths={3: os.path.join(direc, "k3.nc")},
+        manifest_path=os.path.join(direc, "manifest.json"),
+    )
+
+
+def _killed_run(files: tuple, pcm_dict: dict, resume: bool, kill_at: int) -> int:
+    """Run `_run_synthetic_months` in a spawned process, return its exit code."""
+    process = multiprocessing.get_context("spawn").Process(
+        target=_run_synthetic_months,
+        args=(files, pcm_dict),
+        kwargs={"resume": resume, "kill_at": kill_at},
+    )
+    process.start()
+    process.join()
+    return process.exitcode
 
 
 class TestCase(unittest.TestCase):
@@ -12,5 +171,441 @@ class TestCase(unittest.TestCase):
             # for j in range(int(10e3)):
             print(i)
 
+    def test_pair_i_metric_vectorized(self):
+        for k_clusters in [2, 4, 10]:
+            with self.subTest(k_clusters=k_clusters):
+                ds = syn.make_i_metric_dataset(
+                    k_clusters=k_clusters, time=3, yc=8, xc=12
+                )
+                da_loop = tpi.pair_i_metric(ds, threshold=0.05, vectorized=False)
+                da_vec = tpi.pair_i_metric(ds, threshold=0.05, vectorized=True)
+                xr.testing.assert_identical(da_loop, da_vec)
+                self.assertEqual(da_loop.dtype, da_vec.dtype)
+                self.assertEqual(da_loop.values.tobytes(), da_vec.values.tobytes())
+
+    def test_compact_pair_i_metric(self):
+        ds = syn.make_i_metric_dataset(k_clusters=5, time=3, yc=8, xc=12)
+        da = tpi.pair_i_metric(ds, threshold=0.05)
+        compact = tpi.compact_pair_i_metric(ds, threshold=0.05, dtype="float64")
+        self.assertEqual(compact.ds[cst.PAIR_ID_NAME].dtype, "int8")
+        xr.testing.assert_identical(da, compact.to_dataarray())
+        xr.testing.assert_identical(
+            da.isel(time=1).isel(pair=2), compact.isel(time=1).isel(pair=2)
+        )
+        xr.testing.assert_identical(
+            compact.ds, tpi.PairIMetric.from_dataarray(da, dtype="float64").ds
+        )
+
+    def test_compact_pair_i_metric_round_trip(self):
+        ds = syn.make_i_metric_dataset(k_clusters=5, time=3, yc=8, xc=12)
+        compact = tpi.compact_pair_i_metric(ds, threshold=0.05)
+        self.assertEqual(compact.ds[cst.PAIR_VALUE_NAME].dtype, "float32")
+        with tempfile.TemporaryDirectory() as direc:
+            for name in ["pair.nc", "pair.zarr"]:
+                path = os.path.join(direc, name)
+                if name.endswith(".zarr"):
+                    compact.to_zarr(path)
+                else:
+                    compact.to_netcdf(path)
+                reloaded = tpi.PairIMetric.open(path)
+                self.assertEqual(reloaded.ds[cst.PAIR_ID_NAME].dtype, "int8")
+                xr.testing.assert_equal(compact.to_dataarray(), reloaded.to_dataarray())
+
+    def test_chunked_pair_i_metric(self):
+        ds = syn.make_i_metric_dataset(k_clusters=5, time=7, yc=8, xc=12)
+        compact = tpi.compact_pair_i_metric(ds, threshold=0.05, k_clusters=5)
+        with tempfile.TemporaryDirectory() as direc:
+            link_to_netcdf = os.path.join(direc, "i-metric.nc")
+            ds.to_netcdf(link_to_netcdf)
+            # a budget of two months per block, so the last block is short.
+            budget = 2 * 8 * 12 * tpi._BYTES_PER_CELL
+            self.assertEqual(tpi.time_block_size(8 * 12, budget), 2)
+            chunked = tpi.chunked_pair_i_metric(
+                link_to_netcdf,
+                os.path.join(direc, "pair.nc"),
+                5,
+                threshold=0.05,
+                memory_budget=budget,
+            )
+            xr.testing.assert_equal(compact.ds, chunked.ds.load())
+            chunked.ds.close()
+
+    def test_pair_i_metric_sweep(self):
+        ds = syn.make_i_metric_dataset(k_clusters=5, time=3, yc=8, xc=12)
+        thresholds = [0.3, 0.05, 0.9]
+        sweep = tpi.pair_i_metric_sweep(ds, thresholds)
+        with self.assertRaises(ValueError):
+            tpi.pair_i_metric_sweep(ds, [])
+        front_area = tpi.pair_i_metric_sweep(ds, thresholds, summary=True)
+        self.assertEqual(
+            list(sweep.coords[cst.THRESHOLD_COORD].values), [0.05, 0.3, 0.9]
+        )
+        for threshold in thresholds:
+            da = tpi.pair_i_metric(ds, threshold=threshold)
+            one = sweep.sel(threshold=threshold, drop=True)
+            xr.testing.assert_identical(da, one.sel(pair=da.coords[cst.P_COORD]))
+            xr.testing.assert_equal(
+                one.notnull().sum([cst.Y_COORD, cst.X_COORD]).astype("float64"),
+                front_area.sel(threshold=threshold, drop=True).rename(None),
+            )
+
+    def test_estimator_state_round_trip(self):
+        x_values = np.random.default_rng(cst.SEED).normal(size=(500, 8))
+        fitted = [
+            StandardScaler().fit(x_values),
+            PCA(n_components=3, svd_solver="full").fit(x_values),
+            GaussianMixture(n_components=4, random_state=0).fit(x_values[:, :3]),
+        ]
+        with tempfile.TemporaryDirectory() as direc:
+            path = os.path.join(direc, "state.npz")
+            np.savez(
+                path,
+                **{
+                    str(i) + "/" + key: value
+                    for i, estimator in enumerate(fitted)
+                    for key, value in pio.estimator_state(estimator).items()
+                },
+            )
+            with np.load(path, allow_pickle=False) as npz:
+                loaded = [
+                    pio.set_estimator_state(
+                        type(estimator)(**estimator.get_params()),
+                        {
+                            key.split("/")[1]: npz[key]
+                            for key in npz.files
+                            if key.startswith(str(i) + "/")
+                        },
+                    )
+                    for i, estimator in enumerate(fitted)
+                ]
+        for old, new in zip(fitted[:2], loaded[:2]):
+            np.testing.assert_array_equal(
+                old.transform(x_values), new.transform(x_values)
+            )
+        np.testing.assert_array_equal(
+            fitted[2].predict_proba(x_values[:, :3]),
+            loaded[2].predict_proba(x_values[:, :3]),
+        )
+
+    @unittest.skipUnless(PYXPCM_WORKS, "pyxpcm cannot make a pcm with this numpy")
+    def test_pcm_round_trip(self):
+        # pylint: disable=protected-access
+        with tempfile.TemporaryDirectory() as direc:
+            pcm_object, ds, config = _synthetic_pcm(direc)
+            path = tim.save_pcm(pcm_object, config, path=os.path.join(direc, "pcm.npz"))
+            self.assertEqual(pio.read_header(path)["config"], config)
+            loaded = tim.load_pcm(path)
+        np.testing.assert_equal(loaded._props, pcm_object._props)
+        np.testing.assert_equal(loaded._homogeniser, pcm_object._homogeniser)
+        for feature, axis in pcm_object._props["features"].items():
+            np.testing.assert_array_equal(
+                axis, np.arange(-cst.MIN_DEPTH, -cst.MAX_DEPTH, -10.0), feature
+            )
+        for old, new in zip(_pcm_outputs(pcm_object, ds), _pcm_outputs(loaded, ds)):
+            np.testing.assert_array_equal(old, new)
+
+    def test_fit_gmm_streaming(self):
+        rng = np.random.default_rng(cst.SEED)
+        centres = np.array([[0.0, 0.0], [5.0, 5.0], [0.0, 6.0]])
+        x_values = np.concatenate(
+            [rng.normal(centre, 1.0, size=(1000, 2)) for centre in centres]
+        )
+        full = GaussianMixture(n_components=3, random_state=0).fit(x_values)
+        streamed, llh = stt.fit_gmm_streaming(
+            GaussianMixture(n_components=3, random_state=0),
+            x_values,
+            chunk_rows=700,
+            init_samples=300,
+        )
+        self.assertAlmostEqual(llh, full.score(x_values), places=3)
+        labels = streamed.predict(x_values).astype("float64")
+        reference = full.predict(x_values).astype("float64")
+        mapping = lab.match_labels(reference, labels, 3)
+        self.assertGreater(lab.agreement(reference, lab.relabel(labels, mapping)), 0.99)
+
+    def test_inference(self):
+        rng = np.random.default_rng(cst.SEED)
+        z_values = -np.arange(250.0, 2100.0, 50.0)
+        axis = np.arange(-300.0, -2000.0, -10.0)
+        north = rng.random(3000)[:, None] > 0.5
+        decay = np.exp(z_values / 1000.0)[None, :]
+        profiles = {
+            "SALT": 34.5 + 0.2 * north * decay + rng.normal(0, 0.01, (3000, 1)),
+            "THETA": 2 + 3 * north * decay + rng.normal(0, 0.2, (3000, 1)),
+        }
+        profiles["SALT"][:10, -3] = np.nan
+        axes, scalers, reducers, homogeniser, reduced = {}, {}, {}, {}, []
+        for feature, values in profiles.items():
+            interp = np.stack(
+                [np.interp(axis, z_values[::-1], v[::-1]) for v in values[10:]]
+            )
+            axes[feature] = axis
+            scalers[feature] = StandardScaler().fit(interp)
+            reducers[feature] = PCA(n_components=2).fit(
+                scalers[feature].transform(interp)
+            )
+            x_values = reducers[feature].transform(scalers[feature].transform(interp))
+            homogeniser[feature] = {"mean": x_values.mean(), "std": x_values.std()}
+            reduced.append(
+                (x_values - homogeniser[feature]["mean"]) / homogeniser[feature]["std"]
+            )
+        reduced = np.concatenate(reduced, axis=1)
+        classifier = GaussianMixture(n_components=3, random_state=0).fit(reduced)
+        proba = np.sort(classifier.predict_proba(reduced), axis=1)
+        for dtype, atol in [("float64", 1e-8), ("float32", 1e-3)]:
+            with self.subTest(dtype=dtype):
+                model = inf.Inference(
+                    axes, scalers, reducers, homogeniser, classifier, dtype, 700
+                )
+                out = model.predict(profiles, z_values)
+                self.assertTrue(np.all(np.isnan(out["IMETRIC"][:10])))
+                np.testing.assert_allclose(out["PCA_VALUES"][10:], reduced, atol=atol)
+                np.testing.assert_allclose(
+                    out["IMETRIC"][10:], 1 - (proba[:, -1] - proba[:, -2]), atol=atol
+                )
+                np.testing.assert_array_equal(
+                    out["PCM_LABELS"][10:], classifier.predict(reduced)
+                )
+
+    def test_same_outputs(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=1, yc=8, xc=12)
+            model = _synthetic_inference(salt_file, theta_file)
+            swapped = _synthetic_inference(salt_file, theta_file, order=[1, 0, 2])
+            ds = xvl.open_salt_theta(
+                time_i=0, salt_file=salt_file, theta_file=theta_file
+            ).load()
+        out = model.dataset(ds)
+        self.assertTrue(inf.same_outputs(out, out.transpose(*reversed(list(out.dims)))))
+        self.assertTrue(inf.same_outputs(out, out.assign(IMETRIC=out.IMETRIC + 1e-4)))
+        # the same classes numbered differently: the PCA values and i metric
+        # agree, but A_B and the labels do not.
+        out_swapped = swapped.dataset(ds)
+        np.testing.assert_allclose(
+            out_swapped.IMETRIC, out.IMETRIC, atol=cst.INFERENCE_ATOL
+        )
+        self.assertFalse(inf.same_outputs(out_swapped, out))
+        self.assertFalse(
+            inf.same_outputs(out_swapped.assign(PCM_LABELS=out.PCM_LABELS), out)
+        )
+
+    @unittest.skipUnless(PYXPCM_WORKS, "pyxpcm cannot make a pcm with this numpy")
+    def test_inference_from_pcm(self):
+        with tempfile.TemporaryDirectory() as direc:
+            pcm_object, ds, _ = _synthetic_pcm(direc)
+        model = inf.Inference.from_pcm(pcm_object, dtype="float64")
+        labels, proba = _pcm_outputs(pcm_object, ds)
+        out = model.dataset(ds).stack(profile=(cst.Y_COORD, cst.X_COORD))
+        valid = np.isfinite(out.PCM_LABELS.values)
+        np.testing.assert_array_equal(out.PCM_LABELS.values[valid], labels)
+        top_two = np.sort(proba, axis=1)[:, -2:]
+        np.testing.assert_allclose(
+            out.IMETRIC.isel(Imetric=0).values[valid],
+            1 - (top_two[:, 1] - top_two[:, 0]),
+            atol=cst.INFERENCE_ATOL,
+        )
+
+    @unittest.skipUnless(PYXPCM_FORK, "needs the pyxpcm fork with find_i_metric")
+    def test_matches_pcm(self):
+        # pylint: disable=protected-access
+        with tempfile.TemporaryDirectory() as direc:
+            pcm_object, ds, _ = _synthetic_pcm(direc)
+        model = inf.Inference.from_pcm(pcm_object)
+        self.assertIs(bim.checked_model(model, pcm_object, ds), model)
+        # numbering the classes differently makes pyxpcm be used instead.
+        swapped = inf.Inference(
+            pcm_object._props["features"],
+            pcm_object._scaler,
+            pcm_object._reducer,
+            pcm_object._homogeniser,
+            _permuted(pcm_object._classifier, [1, 0, 2]),
+        )
+        self.assertFalse(inf.matches_pcm(swapped, pcm_object, ds))
+        self.assertIs(bim.checked_model(swapped, pcm_object, ds), pcm_object)
+
+    def test_ensemble_alignment(self):
+        rng = np.random.default_rng(cst.SEED)
+        centres = np.array([[0.0, 0.0], [4.0, 4.0], [0.0, 5.0], [5.0, 0.0]])
+        x_values = np.concatenate(
+            [rng.normal(centre, 1.0, size=(500, 2)) for centre in centres]
+        )
+        classifiers = [
+            GaussianMixture(n_components=4, random_state=seed).fit(x_values)
+            for seed in ens.member_seeds(4)
+        ]
+        labels = np.stack(
+            [
+                lab.relabel(
+                    classifier.predict(x_values).astype("float64"),
+                    lab.match_means(classifiers[0].means_, classifier.means_),
+                )
+                for classifier in classifiers
+            ]
+        )
+        labels[:, :5] = np.nan
+        for member in labels[1:]:
+            self.assertGreater(lab.agreement(labels[0], member), 0.99)
+        i_metric = np.stack(
+            [
+                1 - np.ptp(np.sort(classifier.predict_proba(x_values))[:, -2:], axis=1)
+                for classifier in classifiers
+            ]
+        )
+        stats = ens.ensemble_statistics(labels, i_metric, 4)
+        self.assertTrue(np.all(np.isnan(stats["LABEL_AGREEMENT"][:5])))
+        self.assertGreater(np.nanmean(stats["LABEL_AGREEMENT"]), 0.99)
+        self.assertLess(np.nanmax(stats["IMETRIC_SPREAD"]), 0.5)
+        np.testing.assert_array_equal(stats["ENSEMBLE_LABELS"][5:], labels[0, 5:])
+
+    def test_convergence(self):
+        rng = np.random.default_rng(cst.SEED)
+        shape = (2, 3, 5)  # time, YC, XC
+        ds = xr.Dataset(
+            {
+                var: ((cst.T_COORD, cst.Z_COORD, cst.Y_COORD, cst.X_COORD), values)
+                for var, values in [
+                    ("SALT", rng.normal(34.5, 0.2, (2, 4, 3, 5))),
+                    ("THETA", rng.normal(2.0, 1.0, (2, 4, 3, 5))),
+                ]
+            }
+        )
+        labels = rng.integers(0, 3, size=shape)
+        labels[0, 0, :3] = [0, 1, 2]
+        # 0.7 on the class, 0.2 on the next one, so the i metric is 0.5.
+        proba = np.zeros(shape + (3,))
+        np.put_along_axis(proba, labels[..., None], 0.7, axis=-1)
+        np.put_along_axis(proba, (labels[..., None] + 1) % 3, 0.2, axis=-1)
+        proba[proba == 0] = 0.1
+        proba[1, 2, 4] = np.nan
+        found, i_metric = cvg.labels_and_i_metric(proba)
+        expected = labels.astype("float64")
+        expected[1, 2, 4] = np.nan
+        np.testing.assert_array_equal(found, expected)
+        np.testing.assert_allclose(i_metric, np.where(np.isnan(expected), np.nan, 0.5))
+        means = cvg.class_means(ds, found, 3)
+        for k_cluster in range(3):
+            profiles = ds.SALT.transpose("time", "YC", "XC", "Z").values[
+                found == k_cluster
+            ]
+            np.testing.assert_allclose(means["SALT"][k_cluster], profiles.mean(axis=0))
+        # the full fit against itself, and with its classes numbered differently.
+        for other in [proba, proba[..., [2, 0, 1]]]:
+            row = cvg.compare_fit(ds, other, proba, 3)
+            self.assertEqual(row["agreement"], 1.0)
+            for name in ["SALT_mean_rms", "THETA_mean_rms", "imetric_rms"]:
+                self.assertEqual(row[name], 0.0, name)
+        # a fit that moves one profile to another class.
+        moved = proba.copy()
+        moved[0, 0, 0] = moved[0, 0, 0, [1, 0, 2]]
+        row = cvg.compare_fit(ds, moved, proba, 3)
+        self.assertAlmostEqual(row["agreement"], 1 - 1 / 29)
+        self.assertGreater(row["SALT_mean_rms"], 0)
+        self.assertEqual(row["imetric_max"], 0.0)
+
+    def test_select_k(self):
+        ds = xr.Dataset(
+            {"SALT": (cst.T_COORD, np.arange(12.0))},
+            coords={cst.T_COORD: np.arange(12)},
+        )
+        ds_train, ds_test = sk.split_months(ds, every=4)
+        np.testing.assert_array_equal(ds_test.SALT.values, [3, 7, 11])
+        self.assertEqual(ds_train.sizes[cst.T_COORD], 9)
+
+        rng = np.random.default_rng(cst.SEED)
+        centres = np.array([[0.0, 0.0], [6.0, 6.0], [0.0, 6.0]])
+        x_values = np.concatenate(
+            [rng.normal(centre, 1.0, size=(600, 2)) for centre in centres]
+        )
+        rng.shuffle(x_values)
+        rows = [
+            sk.score_classifier(
+                GaussianMixture(n_components=k, random_state=0),
+                x_values[:1200],
+                x_values[1200:],
+            )
+            for k in [1, 3]
+        ]
+        self.assertLess(rows[1]["bic"], rows[0]["bic"])
+        self.assertGreater(rows[1]["held_out_llh"], rows[0]["held_out_llh"])
+        self.assertGreater(rows[1]["fit_peak_mb"], 0)
+
+    def test_run_months_workers(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=4, yc=8, xc=12)
+            pcm_dict = {3: _synthetic_inference(salt_file, theta_file)}
+            stores = {}
+            for workers in [1, 2]:
+                store_paths = {3: os.path.join(direc, "k3-%i.nc" % workers)}
+                todo = bim.run_months(
+                    pcm_dict,
+                    pca=2,
+                    workers=workers,
+                    months=range(4),
+                    salt_file=salt_file,
+                    theta_file=theta_file,
+                    store_paths=store_paths,
+                    manifest_path=os.path.join(direc, "manifest-%i.json" % workers),
+                )
+                self.assertEqual(todo, [0, 1, 2, 3])
+                with open(store_paths[3], "rb") as store:
+                    stores[workers] = store.read()
+            # the months are written in the same order, so the same bytes.
+            self.assertTrue(stores[1] == stores[2])
+
+    def test_run_months_later_start(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=4, yc=8, xc=12)
+            kwargs = {
+                "pca": 2,
+                "workers": 1,
+                "salt_file": salt_file,
+                "theta_file": theta_file,
+                "store_paths": {3: os.path.join(direc, "k3.nc")},
+                "manifest_path": os.path.join(direc, "manifest.json"),
+            }
+            pcm_dict = {3: _synthetic_inference(salt_file, theta_file)}
+            with self.assertRaises(ValueError):
+                bim.run_months(pcm_dict, months=range(2, 4), **kwargs)
+            self.assertFalse(os.path.isfile(kwargs["store_paths"][3]))
+            # a store that has the first months can carry on from there.
+            self.assertEqual(
+                bim.run_months(pcm_dict, months=range(2), **kwargs), [0, 1]
+            )
+            self.assertEqual(
+                bim.run_months(pcm_dict, months=range(2, 4), resume=True, **kwargs),
+                [2, 3],
+            )
+            self.assertEqual(sto.time_length(kwargs["store_paths"][3]), 4)
+            with self.assertRaises(ValueError):
+                bim.run_months(pcm_dict, months=range(2, 4), **kwargs)
+            self.assertEqual(sto.time_length(kwargs["store_paths"][3]), 4)
+
+    def test_resume_after_kill(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=6, yc=8, xc=12)
+            pcm_dict = {3: _synthetic_inference(salt_file, theta_file)}
+            reference = (salt_file, theta_file, os.path.join(direc, "reference"))
+            files = (salt_file, theta_file, os.path.join(direc, "killed"))
+            for path in [reference[2], files[2]]:
+                os.mkdir(path)
+            _run_synthetic_months(reference, pcm_dict, resume=False)
+            store_path = os.path.join(files[2], "k3.nc")
+            # month 4 is written, but the batch dies before recording it.
+            self.assertEqual(_killed_run(files, pcm_dict, resume=False, kill_at=4), 1)
+            self.assertEqual(sto.time_length(store_path), 5)
+            self.assertEqual(_run_synthetic_months(files, pcm_dict), [4, 5])
+            self.assertEqual(_run_synthetic_months(files, pcm_dict), [])
+            with xr.open_dataset(store_path) as resumed:
+                with xr.open_dataset(os.path.join(reference[2], "k3.nc")) as whole:
+                    xr.testing.assert_identical(resumed.load(), whole.load())
+            # without resume the store is started again, so only month 0 is
+            # left when it dies recording it.
+            self.assertEqual(_killed_run(files, pcm_dict, resume=False, kill_at=0), 1)
+            self.assertEqual(sto.time_length(store_path), 1)
+            self.assertEqual(_run_synthetic_months(files, pcm_dict), list(range(6)))
+            # a different model makes every month stale.
+            retrained = {3: _synthetic_inference(salt_file, theta_file, k_clusters=4)}
+            self.assertEqual(_run_synthetic_months(files, retrained), list(range(6)))
+
 
 suite = unittest.TestLoader().loadTestsFromTestCase(TestCase)
@@ -1,10 +1,274 @@
 """Test preprocessing scripts."""
+import os
+import tempfile
 import unittest
+import numpy as np
+import gsw
+import xarray as xr
+import src.constants as cst
+import src.data_loading.synthetic as syn
+import src.data_loading.xr_loader as xvl
+import src.preprocessing.regrid as rgd
+import src.preprocessing.grid_metrics as gmt
+import src.preprocessing.registry as reg
+import src.preprocessing.gsw_transformations as gtr
 
 
 class TestCase(unittest.TestCase):
     def test_upper(self):
         self.assertEqual("foo".upper(), "FOO")
 
+    def test_regrid(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=2, yc=30, xc=60)
+            ds = xvl.open_salt_theta(salt_file=salt_file, theta_file=theta_file)
+            ds = ds.load()
+            # inside the grid, away from the rows and columns that .interp
+            # treats differently.
+            lats, lons = np.linspace(-77, -31, 17), np.linspace(3, 355, 33)
+            regridder = rgd.Regridder.from_grids(
+                ds.YC.values, ds.XC.values, lats, lons, cache_dir=direc
+            )
+            reloaded = rgd.Regridder.from_grids(
+                ds.YC.values, ds.XC.values, lats, lons, cache_dir=direc
+            )
+        expected = ds.interp(YC=lats, XC=lons)
+        for regridder_i in [regridder, reloaded]:
+            regridded = regridder_i(ds)
+            self.assertEqual(regridded.THETA.dims, ds.THETA.dims)
+            self.assertEqual(regridded.THETA.dtype, np.float32)
+            xr.testing.assert_allclose(
+                regridded.astype("float64"), expected, rtol=1e-6, atol=1e-5
+            )
+
+        # an equal area average keeps the area weighted mean of a full field.
+        field = xr.ones_like(ds.THETA.isel(time=0, Z=0)).astype("float64")
+        field = field * np.cos(np.radians(field.YC)) + field.XC / 360
+        lats, lons = rgd.equal_area_grid(-78.5, -29.5, 10, 30)
+        averaged = rgd.Regridder.from_grids(
+            ds.YC.values, ds.XC.values, lats, lons, "conservative", cache_dir=None
+        )(field)
+        self.assertAlmostEqual(
+            float(averaged.mean()),
+            float(field.weighted(np.cos(np.radians(field.YC))).mean()),
+            places=2,
+        )
+
+    def test_return_density(self):
+        rng = np.random.default_rng(0)
+        shape = (6, 5, 7)
+        args = (
+            rng.uniform(-1.5, 15.0, size=shape),
+            rng.uniform(33.5, 35.0, size=shape),
+            np.linspace(0.0, 360.0, shape[2], endpoint=False),
+            np.linspace(-78.0, -30.0, shape[1]),
+            -np.linspace(2.0, 5500.0, shape[0]),
+        )
+        z_grid, lat_grid, lon_grid = np.meshgrid(
+            args[4], args[3], args[2], indexing="ij"
+        )
+        pressure = gsw.p_from_z(z_grid, lat_grid)
+        absolute_salinity = gsw.SA_from_SP(args[1], pressure, lon_grid, lat_grid)
+        ct_values = gsw.CT_from_pt(absolute_salinity, args[0])
+        expected = (
+            gsw.rho(absolute_salinity, ct_values, pressure),
+            ct_values,
+            pressure,
+        )
+        for new, old in zip(gtr.return_density(*args), expected):
+            self.assertEqual(new.shape, shape)
+            np.testing.assert_allclose(new, old, rtol=1e-12)
+
+    def test_whole_density_netcdf(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=3, yc=10, xc=20)
+            path = os.path.join(direc, "density.nc")
+            # 3 levels per block, so each month is written in 18 regions.
+            gtr.create_whole_density_netcdf(
+                path,
+                salt_file,
+                theta_file,
+                workers=1,
+                memory_budget=3 * gtr.DENSITY_ARRAYS_PER_LEVEL * 8 * 10 * 20,
+            )
+            ds = gtr.open_density_inputs(salt_file, theta_file)
+            with xr.open_dataset(path) as density_ds:
+                self.assertEqual(density_ds.Density.dtype, np.float32)
+                self.assertEqual(density_ds.Density.attrs["unit"], "kg m-3")
+                for time_i in range(3):
+                    month = ds.isel(time=time_i).load()
+                    rho_values, _, _ = gtr.return_density(
+                        month.THETA.where(month.THETA != 0.0).values,
+                        month.SALT.where(month.SALT != 0.0).values,
+                        month.XC.values,
+                        month.YC.values,
+                        month.Z.values,
+                    )
+                    np.testing.assert_allclose(
+                        density_ds.Density.isel(time=time_i).values,
+                        rho_values,
+                        rtol=1e-6,
+                    )
+                    self.assertEqual(density_ds.time.values[time_i], month.time.values)
+            ds.close()
+
+    def test_derived_netcdf(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=2, yc=10, xc=20)
+            path = os.path.join(direc, "derived.nc")
+            bytes_per_row = (gtr.DENSITY_ARRAYS_PER_LEVEL + 4) * 8 * 20
+            # one level and 3 latitudes per block, so the halo is needed.
+            gtr.create_derived_netcdf(
+                path,
+                dtypes={"Density": "float64"},
+                salt_file=salt_file,
+                theta_file=theta_file,
+                workers=1,
+                memory_budget=3 * bytes_per_row,
+                cache_dir=direc,
+            )
+            ds = gtr.open_density_inputs(salt_file, theta_file)
+            with xr.open_dataset(path) as derived_ds:
+                self.assertEqual(derived_ds.Density.dtype, np.float64)
+                self.assertEqual(derived_ds.y_grad.dtype, np.float32)
+                self.assertEqual(derived_ds.y_grad.attrs["units"], "kg m-4")
+                metrics = gmt.GridMetrics.from_grids(
+                    ds.YC.values, ds.XC.values, cache_dir=None
+                )
+                for time_i in range(2):
+                    month = ds.isel(time=time_i).load()
+                    fields = gtr.teos10_fields(
+                        month.THETA.where(month.THETA != 0.0).values,
+                        month.SALT.where(month.SALT != 0.0).values,
+                        month.XC.values,
+                        month.YC.values,
+                        month.Z.values,
+                    )
+                    expected = {
+                        "SA": fields["SA"],
+                        "ct": fields["ct"],
+                        "Density": fields["Density"],
+                        "x_grad": metrics.x_gradient(fields["Density"]),
+                        "y_grad": metrics.y_gradient(fields["Density"]),
+                    }
+                    for name, values in expected.items():
+                        np.testing.assert_allclose(
+                            derived_ds[name]
+                            .isel(time=time_i)
+                            .transpose("Z", "YC", "XC")
+                            .values,
+                            values,
+                            rtol=1e-5,
+                            err_msg=name,
+                        )
+            ds.close()
+
+    def test_grid_metrics(self):
+        lats = np.linspace(-70, -30, 9)
+        lons = np.arange(0, 360, 10) + 5.0
+        to_metres = np.radians(1) * cst.EARTH_RADIUS
+        with tempfile.TemporaryDirectory() as direc:
+            metrics = gmt.GridMetrics.from_grids(lats, lons, cache_dir=direc)
+            reloaded = gmt.GridMetrics.from_grids(lats, lons, cache_dir=direc)
+        self.assertTrue(metrics.periodic)
+        np.testing.assert_array_equal(metrics.dx, reloaded.dx)
+        # sin(lon) on a wrapped grid, with a time dimension in front.
+        field = xr.DataArray(
+            np.sin(np.radians(lons))[None, None, :] * np.ones((2, len(lats), 1)),
+            dims=("time", "YC", "XC"),
+            coords={"YC": lats, "XC": lons},
+            name="field",
+        )
+        x_grad, y_grad = metrics.gradients(field.transpose("XC", "time", "YC"))
+        self.assertEqual(x_grad.dims, ("XC", "time", "YC"))
+        exact = np.cos(np.radians(lons))[None, :] / (
+            cst.EARTH_RADIUS * np.cos(np.radians(lats))[:, None]
+        )
+        np.testing.assert_allclose(
+            x_grad.isel(time=1).transpose("YC", "XC").values,
+            exact,
+            atol=0.02 * np.abs(exact).max(),
+        )
+        np.testing.assert_allclose(y_grad.values, 0, atol=1e-20)
+        # without the wrap, the same as xarray's per degree gradient, scaled.
+        open_metrics = gmt.GridMetrics.from_grids(
+            lats, lons, periodic=False, cache_dir=None
+        )
+        np.testing.assert_allclose(
+            open_metrics.x_gradient(field.values),
+            field.differentiate("XC").values
+            / (to_metres * np.cos(np.radians(lats))[:, None]),
+            rtol=1e-10,
+        )
+        np.testing.assert_allclose(
+            open_metrics.y_gradient(field.values * lats[:, None]),
+            (field * field.YC).differentiate("YC").values / to_metres,
+            rtol=1e-10,
+            atol=1e-20,
+        )
+        # land is skipped, the neighbours use the difference from their
+        # other side, and a point between two land points is NaN.
+        values = field.values.copy()
+        values[:, :, [3, 5]] = np.nan
+        x_grad = metrics.x_gradient(values)
+        self.assertTrue(np.isnan(x_grad[:, :, 4]).all())
+        np.testing.assert_allclose(
+            x_grad[:, :, 2], (values[:, :, 2] - values[:, :, 1]) / metrics.dx[:, 1]
+        )
+        self.assertEqual(np.isnan(x_grad).sum(), 3 * 2 * len(lats))
+
+    def test_registry(self):
+        with tempfile.TemporaryDirectory() as direc:
+            salt_file, theta_file = syn.make_bsose_files(direc, time=2, yc=10, xc=20)
+            cache_dir = os.path.join(direc, "derived")
+            registry = reg.Registry.from_files(
+                salt_file, theta_file, cache_dir=cache_dir
+            )
+            month = registry.source.isel(time=1).load()
+            fields = gtr.teos10_fields(
+                month.THETA.where(month.THETA != 0.0).values,
+                month.SALT.where(month.SALT != 0.0).values,
+                month.XC.values,
+                month.YC.values,
+                month.Z.values,
+            )
+            metrics = gmt.GridMetrics.from_grids(
+                month.YC.values, month.XC.values, cache_dir=None
+            )
+            index = {"time": 1, "Z": slice(0, 3), "YC": slice(3, 6), "XC": slice(5, 9)}
+            inner = (slice(0, 3), slice(3, 6), slice(5, 9))
+            expected = {
+                "ct": fields["ct"],
+                "Density": fields["Density"],
+                "x_grad": metrics.x_gradient(fields["Density"]),
+                "y_grad": metrics.y_gradient(fields["Density"]),
+            }
+            # the gradients are asked for first, so their halos are used.
+            for name in ["y_grad", "x_grad", "Density", "ct"]:
+                da = registry.get(name, **index)
+                self.assertEqual(da.dims, ("Z", "YC", "XC"))
+                np.testing.assert_allclose(
+                    da.values, expected[name][inner], rtol=1e-10, err_msg=name
+                )
+            self.assertEqual(registry.get("y_grad", **index).attrs["units"], "kg m-4")
+            misses = registry.misses
+            self.assertIs(registry.get("ct", **index), registry.get("ct", **index))
+            self.assertEqual(registry.misses, misses)
+            # a second process reads the results back from the file cache.
+            n_entries = len(os.listdir(cache_dir))
+            other = reg.Registry.from_files(salt_file, theta_file, cache_dir=cache_dir)
+            np.testing.assert_allclose(
+                other.get("y_grad", **index).values, expected["y_grad"][inner]
+            )
+            self.assertEqual(other.misses, 1)
+            self.assertEqual(len(os.listdir(cache_dir)), n_entries)
+            # only what fits in memory is kept.
+            small = reg.Registry(registry.source, memory_budget=1.5 * da.nbytes)
+            for z_level in range(3):
+                small.get("ct", time=0, Z=slice(z_level, z_level + 3))
+            self.assertLessEqual(small.nbytes, 1.5 * da.nbytes)
+            registry.source.close()
+            other.source.close()
+
 
 suite = unittest.TestLoader().loadTestsFromTestCase(TestCase)